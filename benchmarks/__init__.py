@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmarks of the jwzthreading package.
+
+Run them with
+
+    python -m benchmarks --sizes 1000 10000 100000 --output bench.json
+
+from the root of the repository. See benchmarks/bench.py for the list of
+benchmarks and benchmarks/corpus.py for the synthetic mailboxes they use.
+"""
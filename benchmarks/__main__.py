@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+
+from .bench import main
+
+main()
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+"""bench.py
+
+Timed benchmarks of the parsing and threading functions, run on
+synthetic corpora of increasing sizes.
+
+Every benchmark is a function registered with the `benchmark` decorator,
+which receives a Corpus and returns a `(setup, run)` pair: `setup()`
+builds the arguments of `run`, and only `run(*args)` is timed. Results
+are written to a JSON file, so that runs of different versions of the
+package can be compared.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+from collections import OrderedDict
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from timeit import default_timer
+
+from jwzthreading import (Message, thread, prune_container, sort_threads,
+                          sort_forest, __version__)
+from jwzthreading.jwzthreading import _link_message
+from jwzthreading.utils import parse_mailbox
+
+from .corpus import generate_corpus, make_messages, write_mbox
+
+BENCHMARKS = OrderedDict()
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+
+def benchmark(name):
+    """Register a benchmark function under `name`"""
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+
+class Corpus(object):
+    """Synthetic corpus of a given size, with the derived data needed by
+    the benchmarks built on first use.
+
+    Arguments:
+        n_messages (int): number of messages
+        seed (int): seed of the corpus generator
+        tmpdir (str): directory where the mbox file is written
+    """
+
+    def __init__(self, n_messages, seed, tmpdir):
+        self.n_messages = n_messages
+        self.seed = seed
+        self.tmpdir = tmpdir
+        self.items = generate_corpus(n_messages, seed=seed)
+        self._mbox = None
+        self._emails = None
+
+    @property
+    def mbox(self):
+        """Path of the gzip mbox file of the corpus"""
+        if self._mbox is None:
+            self._mbox = os.path.join(
+                self.tmpdir, 'corpus-%d-%d.txt.gz' % (self.n_messages,
+                                                      self.seed))
+            write_mbox(self.items, self._mbox)
+        return self._mbox
+
+    @property
+    def emails(self):
+        """Parsed email.message.Message objects of the mbox file"""
+        if self._emails is None:
+            self._emails = parse_mailbox(self.mbox, headersonly=True)
+        return self._emails
+
+    def messages(self):
+        """Fresh list of Message objects"""
+        return make_messages(self.items)
+
+
+@benchmark('parse_mailbox')
+def bench_parse_mailbox(corpus):
+    filename = corpus.mbox
+    return (lambda: (filename,),
+            lambda filename: parse_mailbox(filename, headersonly=True))
+
+
+@benchmark('Message')
+def bench_message(corpus):
+    emails = corpus.emails
+
+    def run(emails):
+        return [Message(el, message_idx=idx) for idx, el in enumerate(emails)]
+    return lambda: (emails,), run
+
+
+@benchmark('thread')
+def bench_thread(corpus):
+    return (lambda: (corpus.messages(),),
+            lambda messages: thread(messages, group_by_subject=False))
+
+
+@benchmark('thread_group_by_subject')
+def bench_thread_group_by_subject(corpus):
+    return (lambda: (corpus.messages(),),
+            lambda messages: thread(messages, group_by_subject=True))
+
+
+@benchmark('prune_container')
+def bench_prune_container(corpus):
+    def setup():
+        # unpruned root set, as obtained after step 2
+        id_table = OrderedDict()
+        for msg in corpus.messages():
+            _link_message(id_table, msg)
+        return ([ctr for ctr in id_table.values() if ctr.parent is None],)
+
+    def run(root_set):
+        for ctr in root_set:
+            prune_container(ctr)
+    return setup, run
+
+
+@benchmark('sort_threads')
+def bench_sort_threads(corpus):
+    threads = thread(corpus.messages(), group_by_subject=False)
+    return (lambda: (threads,),
+            lambda threads: sort_threads(threads, key='message_idx'))
+
+
+@benchmark('sort_forest')
+def bench_sort_forest(corpus):
+    threads = thread(corpus.messages(), group_by_subject=False)
+    return (lambda: (threads,),
+            lambda threads: sort_forest(threads, key='message_idx',
+                                        latest_activity=True))
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, names=None, repeat=3, seed=0,
+                   verbose=True):
+    """Run the benchmarks
+
+    Arguments:
+        sizes ([int]): number of messages of the corpora
+        names ([str]): benchmarks to run, all of them by default
+        repeat (int): number of timed runs of every benchmark
+        seed (int): seed of the corpus generator
+        verbose (bool): print the timings as they are measured
+
+    Returns:
+        dict: the results, see write_results
+    """
+    if names is None:
+        names = list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            raise ValueError('Unknown benchmark: {}'.format(name))
+
+    results = []
+    tmpdir = tempfile.mkdtemp(prefix='jwzthreading-bench-')
+    try:
+        for n_messages in sizes:
+            corpus = Corpus(n_messages, seed, tmpdir)
+            for name in names:
+                setup, run = BENCHMARKS[name](corpus)
+                times = []
+                for _ in range(repeat):
+                    args = setup()
+                    t0 = default_timer()
+                    run(*args)
+                    times.append(default_timer() - t0)
+                res = OrderedDict([('name', name),
+                                   ('n_messages', n_messages),
+                                   ('repeat', repeat),
+                                   ('best', min(times)),
+                                   ('mean', sum(times) / len(times)),
+                                   ('times', times)])
+                results.append(res)
+                if verbose:
+                    print('{:<26} {:>9} messages: {:9.4f} s'.format(
+                          name, n_messages, res['best']))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return OrderedDict([('version', __version__),
+                        ('python', platform.python_version()),
+                        ('platform', platform.platform()),
+                        ('date', time.strftime('%Y-%m-%dT%H:%M:%S')),
+                        ('seed', seed),
+                        ('results', results)])
+
+
+def write_results(results, filename):
+    """Write the results of run_benchmarks to a JSON file"""
+    with open(filename, 'w') as fh:
+        json.dump(results, fh, indent=2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description='Benchmark the jwzthreading package.')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=DEFAULT_SIZES,
+                        help='number of messages, e.g. 1000 1000000')
+    parser.add_argument('--bench', nargs='+', choices=list(BENCHMARKS),
+                        help='benchmarks to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_results.json',
+                        help='JSON file where results are written')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.sizes, args.bench, repeat=args.repeat,
+                             seed=args.seed)
+    write_results(results, args.output)
+    print('Results written to {}'.format(args.output), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+"""corpus.py
+
+Deterministic generator of synthetic mailboxes, used by the benchmarks.
+
+A corpus is a list of `Item` tuples, made of a number of threads of
+different kinds, interleaved by date as they would be in an archive:
+
+  chain      deep chains, every message replying to the previous one
+  wide       a single announcement with a very large number of replies
+  tree       random trees of moderate size
+  broken     trees with a missing root and truncated References headers
+  cycle      messages lying about their references, forming loops
+  duplicate  trees where some messages reuse an earlier Message-ID
+  subject    messages without any reference, only related by subject
+
+The same arguments always produce the same corpus, which can be turned
+into a list of Message objects with make_messages, or written to a gzip
+mbox file with write_mbox.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import namedtuple
+from email.utils import formatdate
+import gzip
+import random
+import time
+
+from jwzthreading import Message
+
+__all__ = ['Item', 'THREAD_KINDS', 'generate_corpus', 'make_messages',
+           'write_mbox']
+
+Item = namedtuple('Item', ['message_id', 'references', 'subject', 'date'])
+
+# thread kind -> (relative frequency, minimum size, maximum size)
+THREAD_KINDS = {
+    'chain': (1, 20, 300),
+    'wide': (0.5, 50, 1000),
+    'tree': (40, 1, 30),
+    'broken': (10, 2, 30),
+    'cycle': (5, 2, 6),
+    'duplicate': (10, 2, 20),
+    'subject': (10, 2, 50),
+}
+
+# mail clients truncate long References headers, keeping the first
+# message of the thread and the last few ones
+REFERENCES_LIMIT = 20
+
+LIST_TAG = '[bench-list] '
+
+# dates of the generated messages start at 2010-01-01
+START_DATE = 1262304000
+
+
+def _domain(seed):
+    return 'bench%d.example.org' % seed
+
+
+def _truncate(references):
+    if len(references) > REFERENCES_LIMIT:
+        references = references[:1] + references[1 - REFERENCES_LIMIT:]
+    return references
+
+
+def _reply_subject(rng, subject):
+    prefix = 'Re: ' * rng.randint(1, 3)
+    if rng.random() < 0.3:
+        prefix = LIST_TAG + prefix
+    return prefix + subject
+
+
+def _thread(rng, kind, size, thread_id, domain):
+    """Generate (message_id, references, subject) tuples of a thread"""
+    ids = ['%d.%d@%s' % (thread_id, idx, domain) for idx in range(size)]
+    subject = 'Thread %d about %s' % (thread_id, kind)
+
+    if kind == 'subject':
+        for idx in range(size):
+            yield (ids[idx], [],
+                   _reply_subject(rng, subject) if idx else subject)
+        return
+
+    if kind == 'cycle':
+        # every message pretends to reply to the next one
+        for idx in range(size):
+            references = [ids[(idx + 1) % size]]
+            if idx == 0:
+                references.append(ids[0])
+            yield ids[idx], references, _reply_subject(rng, subject)
+        return
+
+    # full list of ancestors of every message
+    paths = []
+    for idx in range(size):
+        if idx == 0:
+            if kind == 'broken':
+                # the root of the thread was never archived
+                references = ['missing.%d@%s' % (thread_id, domain)]
+            else:
+                references = []
+        else:
+            if kind == 'chain':
+                parent = idx - 1
+            elif kind == 'wide':
+                parent = 0
+            else:
+                parent = rng.randrange(idx)
+            references = paths[parent] + [ids[parent]]
+        paths.append(references)
+
+        references = _truncate(references)
+        if kind == 'broken' and rng.random() < 0.3 and len(references) > 2:
+            # some mail clients only keep the In-Reply-To header
+            references = references[-1:]
+        message_id = ids[idx]
+        if kind == 'duplicate' and idx > 1 and rng.random() < 0.2:
+            message_id = ids[rng.randrange(idx)]
+        yield (message_id, references,
+               _reply_subject(rng, subject) if idx else subject)
+
+
+def generate_corpus(n_messages, seed=0, kinds=None):
+    """Generate a synthetic corpus of messages.
+
+    Arguments:
+        n_messages (int): number of messages
+        seed (int): seed of the random number generator
+        kinds ([str]): kinds of threads to generate, all the keys of
+            THREAD_KINDS by default
+
+    Returns:
+        list of Item, sorted by date
+    """
+    if kinds is None:
+        kinds = sorted(THREAD_KINDS)
+    for kind in kinds:
+        if kind not in THREAD_KINDS:
+            raise ValueError('Unknown thread kind: {}'.format(kind))
+
+    rng = random.Random(seed)
+    domain = _domain(seed)
+    weights = [THREAD_KINDS[kind][0] for kind in kinds]
+    total = sum(weights)
+
+    # the corpus spans about one year, whatever its size
+    span = 365 * 24 * 3600
+
+    dated = []
+    thread_id = 0
+    while len(dated) < n_messages:
+        pick = rng.random() * total
+        for kind, weight in zip(kinds, weights):
+            pick -= weight
+            if pick < 0:
+                break
+        _, min_size, max_size = THREAD_KINDS[kind]
+        size = min(rng.randint(min_size, max_size), n_messages - len(dated))
+
+        date = START_DATE + rng.random() * span
+        for message_id, references, subject in _thread(rng, kind, size,
+                                                       thread_id, domain):
+            dated.append((int(date), len(dated),
+                          message_id, references, subject))
+            date += rng.expovariate(1 / 3600.)
+        thread_id += 1
+
+    dated.sort()
+    return [Item(message_id, references, subject, date)
+            for date, _, message_id, references, subject in dated]
+
+
+def make_messages(items):
+    """Convert a corpus to a list of Message objects
+
+    Arguments:
+        items ([Item]): the corpus
+
+    Returns:
+        list of Message
+    """
+    messages = []
+    for idx, item in enumerate(items):
+        msg = Message(None)
+        msg.message_idx = idx
+        msg.message_id = item.message_id
+        msg.references = list(item.references)
+        msg.subject = item.subject
+        messages.append(msg)
+    return messages
+
+
+def write_mbox(items, filename):
+    """Write a corpus to a gzip mbox file, that can be read with
+    jwzthreading.utils.parse_mailbox
+
+    Arguments:
+        items ([Item]): the corpus
+        filename (str): path of the .txt.gz file
+    """
+    with gzip.open(filename, 'wb') as fh:
+        for item in items:
+            lines = [
+                'From sender at bench.example.org  %s' % time.strftime(
+                    '%a %b %d %H:%M:%S %Y', time.gmtime(item.date)),
+                'From: sender at bench.example.org',
+                'Date: %s' % formatdate(item.date),
+                'Subject: %s' % item.subject,
+                'Message-ID: <%s>' % item.message_id]
+            if item.references:
+                lines.append('In-Reply-To: <%s>' % item.references[-1])
+                lines.append('References: %s' % ' '.join(
+                    '<%s>' % ref for ref in item.references))
+            lines += ['', 'Message body of %s.' % item.message_id, '', '']
+            fh.write('\n'.join(lines).encode('utf-8'))
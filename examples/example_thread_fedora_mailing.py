@@ -16,7 +16,7 @@ from __future__ import unicode_literals
 import os
 
 from jwzthreading import (Message, thread, print_container,
-                          sort_threads)
+                          sort_forest)
 from jwzthreading.utils import parse_mailbox
 
 data_path = os.path.join('..', "jwzthreading", "tests", "data",
@@ -30,9 +30,10 @@ threads = thread([Message(el, message_idx=idx)
                   for idx, el in enumerate(msglist)],
                  group_by_subject=False)
 """
-Let's sort the resulting threads alphabetically by subject,
+Let's sort the resulting threads, and the replies within each thread,
+by date,
 """
-threads = sort_threads(threads, key='subject', missing='Z')
+threads = sort_forest(threads, key='date')
 
 """
 We can visualize the first 20 threads,
@@ -44,9 +45,7 @@ for container in threads[:20]:
 and compare with `the threading done by Mailman
  <https://www.redhat.com/archives/fedora-devel-list/2010-January/thread.html>`_.
 
-The sorting of threads is not the same (we would need to extend the
-``Message`` class to store the message date in order to also sort by date)
-however generally the agreement if fairly good.
+Generally the agreement if fairly good.
 
 The most noticeable differences is that Mailman,
  * has a maximum email depth of 2 (presumably for better visualization)
@@ -5,8 +5,22 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import sys
+
 from .jwzthreading import Message, thread, unique, Container  # noqa
+from .jwzthreading import CompactMessage, MessageIdTable  # noqa
+from .jwzthreading import JwzContainer, ThreadNode  # noqa
 from .jwzthreading import print_container, prune_container  # noqa
-from .jwzthreading import sort_threads, __version__  # noqa
+from .jwzthreading import normalize_subject, parse_date  # noqa
+from .jwzthreading import sort_threads, sort_forest, Threader, __version__  # noqa
+from .jwzthreading import ThreadIndex  # noqa
+from .jwzthreading import ThreadingStats  # noqa
+from .arrays import ArrayForest, thread_arrays  # noqa
+from .storage import ThreadStore  # noqa
+from .parallel import thread_parallel  # noqa
+from .streaming import thread_windowed  # noqa
+
+if sys.version_info >= (3, 6):
+    from .aio import athread  # noqa
 
 from . import utils  # noqa
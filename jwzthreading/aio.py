@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""aio.py
+
+asyncio interface, threading messages as they are received from an
+asynchronous source (requires Python 3.6 or later).
+
+Example:
+
+    async for threads in athread(source):
+        # threads created or modified by the latest messages
+        ...
+"""
+
+import asyncio
+
+from .jwzthreading import Threader
+from .utils import _check_errors, _make_message, _skip_message
+
+__all__ = ['athread']
+
+
+def _parse_messages(items, encoding, decode_header, first_idx):
+    """Extract the threading headers of raw messages, in an executor
+
+    A message that cannot be threaded is replaced by the ValueError it
+    raised, handled by the event loop according to `errors`."""
+    messages = []
+    for idx, item in enumerate(items, first_idx):
+        raw = item.encode(encoding) if isinstance(item, str) else item
+        try:
+            msg = _make_message(raw, encoding, message_idx=idx,
+                                decode_header=decode_header)
+        except ValueError as exc:
+            messages.append(exc)
+            continue
+        msg.message = item
+        messages.append(msg)
+    return messages
+
+
+def _add_messages(threader, messages):
+    threader.add(messages)
+    return threader.updated_threads()
+
+
+async def athread(source, group_by_subject=True, encoding='utf-8',
+                  decode_header=False, executor=None, max_batch=1000,
+                  threader=None, errors='warn'):
+    """Thread messages received from an asynchronous iterator.
+
+    The items of `source` are either Message (or CompactMessage) objects,
+    or raw messages (bytes or str) whose threading headers are extracted
+    in `executor`.
+    Items are processed in batches of those received while the previous
+    batch was processed, so that the latency stays low under a light
+    load and the throughput high under a heavy one. After each batch,
+    the threads created or modified by the batch are yielded.
+
+    Arguments:
+        source: asynchronous iterator of messages
+        group_by_subject (bool): Group root set by subject
+               (optional) step 5 of the JWZ algorithm.
+        encoding (str): encoding of the raw messages
+        decode_header (bool): decode RFC 2047 encoded subjects
+        executor (concurrent.futures.Executor): executor parsing the raw
+               messages, the default executor of the event loop if None
+        max_batch (int): maximum number of messages in a batch, and of
+               messages received but not processed yet
+        threader (Threader): threading state to continue from, a new
+               Threader by default
+        errors (str): raw messages without a Message-ID are dropped with
+               a warning ('warn'), silently ('skip'), or end the
+               iteration with a ValueError ('raise')
+
+    Yields:
+        list of containers, as returned by Threader.updated_threads. The
+        Message objects built from raw messages have consecutive
+        `message_idx` starting at 0, and the raw message as `message`.
+    """
+    _check_errors(errors)
+    loop = asyncio.get_event_loop()
+    if threader is None:
+        threader = Threader(group_by_subject=group_by_subject)
+
+    queue = asyncio.Queue(maxsize=max_batch)
+    done = object()
+
+    async def receive():
+        try:
+            async for item in source:
+                await queue.put(item)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            await queue.put(done)
+            raise
+        await queue.put(done)
+
+    receiver = asyncio.ensure_future(receive())
+    message_idx = 0
+    try:
+        finished = False
+        while not finished:
+            items = [await queue.get()]
+            while len(items) < max_batch and not queue.empty():
+                items.append(queue.get_nowait())
+            if items[-1] is done:
+                items.pop()
+                finished = True
+
+            raw = [item for item in items if isinstance(item, (bytes, str))]
+            if raw:
+                parsed = await loop.run_in_executor(
+                    executor, _parse_messages, raw, encoding, decode_header,
+                    message_idx)
+                for idx, msg in enumerate(parsed, message_idx):
+                    if isinstance(msg, ValueError):
+                        _skip_message(idx, msg, errors)
+                message_idx += len(raw)
+                parsed = iter(parsed)
+                items = [next(parsed) if isinstance(item, (bytes, str))
+                         else item for item in items]
+                items = [item for item in items
+                         if not isinstance(item, ValueError)]
+
+            # the threader is only used by one executor thread at a time
+            updated = await loop.run_in_executor(None, _add_messages,
+                                                 threader, items)
+            if updated:
+                yield updated
+        # raise the exceptions of the source
+        await receiver
+    finally:
+        if not receiver.done():
+            receiver.cancel()
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+
+"""arrays.py
+
+Array-backed implementation of steps 1 to 4 of the JWZ threading
+algorithm.
+
+Instead of creating one Container per Message-ID, every Message-ID
+(including the ids of referenced but missing messages) is mapped to a
+dense integer node id, and the forest is stored in flat integer arrays:
+
+  parent[node]        parent node, or -1 for a root
+  first_child[node]   first child node, or -1
+  last_child[node]    last child node, or -1
+  next_sibling[node]  next node in the parent's children list, or -1
+  prev_sibling[node]  previous node in the parent's children list, or -1
+  message[node]       index of the Message in the input sequence,
+                      or -1 for a dummy node
+
+Children are kept in an intrusive doubly linked list so that both
+appending and unlinking a child are O(1).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from array import array
+from timeit import default_timer
+
+from .jwzthreading import ThreadNode
+
+__all__ = ['ArrayForest', 'thread_arrays']
+
+# array typecode used for node ids, 4 bytes per entry
+NODE_TYPECODE = str('i')
+
+
+class ArrayForest(object):
+    """A forest of threads stored in flat integer arrays.
+
+    Attributes:
+        messages ([Message]): the threaded messages, in input order
+        roots (array): node ids of the root set, after pruning
+        parent, first_child, last_child, next_sibling, prev_sibling (array):
+            tree links, indexed by node id (-1 when missing)
+        message (array): index in `messages` of the message held by each
+            node, -1 for dummy nodes
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.roots = array(NODE_TYPECODE)
+        self.parent = array(NODE_TYPECODE)
+        self.first_child = array(NODE_TYPECODE)
+        self.last_child = array(NODE_TYPECODE)
+        self.next_sibling = array(NODE_TYPECODE)
+        self.prev_sibling = array(NODE_TYPECODE)
+        self.message = array(NODE_TYPECODE)
+
+    def __len__(self):
+        return len(self.roots)
+
+    def __repr__(self):
+        return '<%s: %d threads, %d nodes>' % (self.__class__.__name__,
+                                               len(self.roots),
+                                               len(self.parent))
+
+    def new_node(self):
+        """Append a dummy node and return its id"""
+        for arr in (self.parent, self.first_child, self.last_child,
+                    self.next_sibling, self.prev_sibling, self.message):
+            arr.append(-1)
+        return len(self.parent) - 1
+
+    def children(self, node):
+        """Iterate over the children of a node, in order"""
+        child = self.first_child[node]
+        next_sibling = self.next_sibling
+        while child != -1:
+            yield child
+            child = next_sibling[child]
+
+    def get_message(self, node):
+        """Return the Message held by a node, or None for a dummy node"""
+        idx = self.message[node]
+        if idx == -1:
+            return None
+        return self.messages[idx]
+
+    def add_child(self, node, child):
+        """Append `child` to the children of `node`, unlinking it from
+        its current parent first"""
+        if self.parent[child] != -1:
+            self.remove_child(child)
+        last = self.last_child[node]
+        if last == -1:
+            self.first_child[node] = child
+        else:
+            self.next_sibling[last] = child
+        self.prev_sibling[child] = last
+        self.next_sibling[child] = -1
+        self.last_child[node] = child
+        self.parent[child] = node
+
+    def remove_child(self, child):
+        """Unlink `child` from its parent in O(1)"""
+        node = self.parent[child]
+        prev_sibling = self.prev_sibling[child]
+        next_sibling = self.next_sibling[child]
+        if prev_sibling == -1:
+            self.first_child[node] = next_sibling
+        else:
+            self.next_sibling[prev_sibling] = next_sibling
+        if next_sibling == -1:
+            self.last_child[node] = prev_sibling
+        else:
+            self.prev_sibling[next_sibling] = prev_sibling
+        self.parent[child] = -1
+        self.prev_sibling[child] = -1
+        self.next_sibling[child] = -1
+
+    def is_ancestor(self, node, other):
+        """Check if `node` is `other` or one of its ancestors, in O(depth)"""
+        parent = self.parent
+        while other != -1:
+            if other == node:
+                return True
+            other = parent[other]
+        return False
+
+    def iter_subtree(self, node):
+        """Iterate over a subtree in depth-first pre-order"""
+        first_child = self.first_child
+        next_sibling = self.next_sibling
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            yield node
+            child = first_child[node]
+            children = []
+            while child != -1:
+                children.append(child)
+                child = next_sibling[child]
+            stack.extend(reversed(children))
+
+    def prune(self, stats=None):
+        """Prune empty containers, as described in step 4 of the algorithm.
+
+        This has the same effect as calling prune_container on every
+        container of the root set: nodes are visited in post-order and
+        dummy nodes are either dropped or replaced in place by their
+        children.
+
+        Arguments:
+            stats (ThreadingStats): optional, counts the pruned nodes
+                and the promoted children
+        """
+        parent = self.parent
+        first_child = self.first_child
+        last_child = self.last_child
+        next_sibling = self.next_sibling
+        prev_sibling = self.prev_sibling
+        message = self.message
+
+        new_roots = array(NODE_TYPECODE)
+        for root in self.roots:
+            order = array(NODE_TYPECODE, self.iter_subtree(root))
+            # reversed pre-order visits every node after its descendants
+            for node in reversed(order):
+                if message[node] != -1:
+                    continue
+                head = first_child[node]
+                if node == root:
+                    break
+                # step 4 (a) and (b) - splice the children of a non-root
+                # dummy node into its parent, at its position
+                if stats is not None:
+                    stats.pruned += 1
+                if head == -1:
+                    self.remove_child(node)
+                    continue
+                tail = last_child[node]
+                node_parent = parent[node]
+                child = head
+                while child != -1:
+                    parent[child] = node_parent
+                    child = next_sibling[child]
+                    if stats is not None:
+                        stats.promoted += 1
+                before = prev_sibling[node]
+                after = next_sibling[node]
+                prev_sibling[head] = before
+                next_sibling[tail] = after
+                if before == -1:
+                    first_child[node_parent] = head
+                else:
+                    next_sibling[before] = head
+                if after == -1:
+                    last_child[node_parent] = tail
+                else:
+                    prev_sibling[after] = tail
+                parent[node] = -1
+                first_child[node] = last_child[node] = -1
+                prev_sibling[node] = next_sibling[node] = -1
+
+            if message[root] != -1:
+                new_roots.append(root)
+                continue
+            head = first_child[root]
+            if head == -1:
+                # step 4 (a) - nuke empty containers
+                if stats is not None:
+                    stats.pruned += 1
+                continue
+            elif next_sibling[head] == -1:
+                # step 4 (b) - promote the only child
+                self.remove_child(head)
+                new_roots.append(head)
+                if stats is not None:
+                    stats.pruned += 1
+                    stats.promoted += 1
+            else:
+                new_roots.append(root)
+        self.roots = new_roots
+
+    def to_containers(self, container_class=ThreadNode):
+        """Convert the root set to a list of Container trees.
+
+        Returns:
+            list of containers, in the order of the root set
+        """
+        out = []
+        first_child = self.first_child
+        next_sibling = self.next_sibling
+        for root in self.roots:
+            root_container = container_class(message=self.get_message(root))
+            stack = [(root, root_container)]
+            while stack:
+                node, container = stack.pop()
+                child = first_child[node]
+                pending = []
+                while child != -1:
+                    child_container = container_class(
+                        message=self.get_message(child))
+                    container.add_child(child_container)
+                    pending.append((child, child_container))
+                    child = next_sibling[child]
+                stack.extend(pending)
+            out.append(root_container)
+        return out
+
+
+def thread_arrays(messages, stats=None, ids=None):
+    """Thread a list of mail items into an ArrayForest.
+
+    Runs steps 1 to 4 of the JWZ algorithm (no subject grouping)
+    over flat integer arrays. The resulting forest has the same
+    structure as the one returned by
+    ``thread(messages, group_by_subject=False)``.
+
+    Arguments:
+        messages ([Message]): List of Message items
+        stats (ThreadingStats): optional, collects the wall time of
+            every step and counters of the operations on the nodes
+        ids (MessageIdTable): table which interned the Message-IDs of
+            all the messages, which are then looked up by indexing a
+            list instead of hashing
+
+    Returns:
+        ArrayForest
+    """
+    if stats is not None:
+        t0 = default_timer()
+
+    forest = ArrayForest()
+    messages_out = forest.messages
+    parent = forest.parent
+    first_child = forest.first_child
+    message = forest.message
+    new_node = forest.new_node
+    add_child = forest.add_child
+    is_ancestor = forest.is_ancestor
+
+    # step one
+    if ids is None:
+        id_table = {}
+        lookup = id_table.get
+    else:
+        id_table = [None] * len(ids)
+        lookup = id_table.__getitem__
+
+    for msg in messages:
+        # step one (a)
+        this_node = lookup(msg.message_id)
+        if this_node is None:
+            this_node = new_node()
+            id_table[msg.message_id] = this_node
+        message[this_node] = len(messages_out)
+        messages_out.append(msg)
+
+        # step one (b)
+        prev = -1
+        for ref in msg.references:
+            node = lookup(ref)
+            if node is None:
+                node = new_node()
+                id_table[ref] = node
+
+            if prev != -1:
+                # If they are already linked, don't change the existing links.
+                if parent[node] != -1:
+                    if stats is not None:
+                        stats.existing_parent_links += 1
+                # Don't add link if it would create a loop. `node` is a
+                # root, so this can only happen if `prev` is in its subtree.
+                elif (node == this_node or node == prev or
+                      (first_child[node] != -1 and
+                       is_ancestor(node, prev))):
+                    if stats is not None:
+                        stats.loop_links += 1
+                else:
+                    add_child(prev, node)
+
+            prev = node
+        # 1C
+        if prev != -1:
+            # Don't add link if it would create a loop
+            if not (this_node == prev or
+                    (first_child[this_node] != -1 and
+                     is_ancestor(this_node, prev))):
+                add_child(prev, this_node)
+            elif stats is not None:
+                stats.loop_links += 1
+        elif parent[this_node] != -1:
+            forest.remove_child(this_node)
+
+    if stats is not None:
+        t1 = default_timer()
+        stats.add_time('link', t1 - t0)
+        stats.containers += len(parent)
+        stats.dummies += message.count(-1)
+
+    # step two - find root set, nodes are numbered in insertion order
+    forest.roots = array(NODE_TYPECODE,
+                         [node for node in range(len(parent))
+                          if parent[node] == -1])
+
+    # step three - delete id_table
+    del id_table
+
+    if stats is not None:
+        t2 = default_timer()
+        stats.add_time('root_set', t2 - t1)
+
+    # step four - prune empty containers
+    forest.prune(stats)
+
+    if stats is not None:
+        stats.add_time('prune', default_timer() - t2)
+
+    return forest
@@ -25,11 +25,17 @@ This code is under a BSD-style license; see the LICENSE file for details.
 """
 
 from __future__ import print_function
-from collections import deque, OrderedDict
+import calendar
+from collections import OrderedDict
+from email.utils import parsedate_tz
+from operator import attrgetter
 import re
 import sys
+from timeit import default_timer
 
-__all__ = ['Message', 'thread']
+__all__ = ['Message', 'CompactMessage', 'MessageIdTable', 'thread',
+           'Threader', 'ThreadIndex', 'ThreadNode', 'ThreadingStats',
+           'normalize_subject', 'parse_date', 'sort_threads', 'sort_forest']
 
 __version__ = "0.96"
 
@@ -41,63 +47,38 @@ MSGID_RE = re.compile(r'<([^>]+)>')
 SUBJECT_RE = re.compile(
     r'((Re(\[\d+\])?:) | (\[ [^]]+ \])\s*)+', re.I | re.VERBOSE)
 
+# maximum number of entries of the normalized subject cache
+SUBJECT_CACHE_SIZE = 2**17
+
+# maximum number of entries of the parsed date cache
+DATE_CACHE_SIZE = 2**17
+
 
 #
 # models
 #
 
-class Container(dict):
-    """Contains a tree of objects. Each container is a subclassed dict
-    where the contents are stored.
-
-    Attributes:
-        children ([Container]): Possibly-empty list of child containers
-        parent (Container): Parent container, if any
+class _TreeMixin(object):
+    """Tree algorithms shared by all the container classes, which only
+    rely on the `parent` and `children` attributes.
+
+    The `root`, `current_depth` and `tree_size` of every container of a
+    tree are computed together in a single pass, at the end of thread()
+    or on the first access to `tree_size`, and then cached, making later
+    lookups O(1). The cached values are tagged with the generation of
+    the tree, kept on its root, which add_child and remove_child
+    increment for the trees they change: other trees keep their cache.
+    With a stale cache, `root` and `current_depth` walk up the parents
+    in O(depth), and `tree_size` fills the cache of the whole tree
+    again. Links between containers must therefore only be changed with
+    add_child and remove_child.
     """
-    def __init__(self, **args):
-        dict.__init__(self, **args)
-        self.parent = None
-        self.children = []
-
-    def __repr__(self):
-        return '<%s %x: %r>' % (self.__class__.__name__, id(self),
-                                dict.__repr__(self))
-
-    def __hash__(self):
-        """ Make the container hashable. Care must be taken though not to change
-        the container contents after the initialization as otherwise the hash
-        value will change
-        """
-        return hash(tuple(sorted(self.items())) + (self.parent,))
+    __slots__ = ()
 
     @property
-    def is_dummy(self):
-        """Check if the container has some content."""
-        return not len(self.keys())
-
-    def add_child(self, child):
-        """Add a child to the container
-
-        Parameters
-        ----------
-        child : Container
-           Child to add.
-        """
-        if child.parent:
-            child.parent.remove_child(child)
-        self.children.append(child)
-        child.parent = self
-
-    def remove_child(self, child):
-        """Remove a child from the container
-
-        Parameters
-        ----------
-        child : Container
-           Child to remove.
-        """
-        self.children.remove(child)
-        child.parent = None
+    def has_children(self):
+        """Check if the container has at least one child."""
+        return bool(self.children)
 
     def has_descendant(self, ctr):
         """Check if `ctr` is a descendant of this container.
@@ -111,41 +92,106 @@ class Container(dict):
         -------
         True if `ctr` is a descendant of `self`, else False.
         """
-        # To avoid recursing indefinitely, we'll do a depth-first
-        # search; 'seen' tracks the containers we've already seen,
-        # and 'stack' is a deque containing containers that we need
-        # to look at.
-        stack = deque()
-        stack.append(self)
-        seen = set()
-
-        while stack:
-            node = stack.pop()
-            if node is ctr:
+        # Walk up the ancestors of `ctr`, which takes O(depth) time and no
+        # memory. 'slow' moves at half speed, and is only caught up by
+        # 'node' if the parent links form a loop.
+        node = slow = ctr
+        step = 0
+        while node is not None:
+            if node is self:
                 return True
-            seen.add(node)
-            for child in node.children:
-                if child not in seen:
-                    stack.append(child)
+            node = node.parent
+            step += 1
+            if not step % 2:
+                slow = slow.parent
+            if node is slow:
+                return False
 
         return False
 
+    def walk(self):
+        """ Iterate over the subtree of this container, in depth-first
+        pre-order, without recursion
+
+        Returns
+        -------
+        generator : (Container, int)
+          each container of the subtree and its depth relative to `self`
+        """
+        stack = [(self, 0)]
+        while stack:
+            ctr, depth = stack.pop()
+            yield ctr, depth
+            depth += 1
+            stack.extend([(child, depth) for child in reversed(ctr.children)])
+
+    def iter_subtree(self):
+        """ Iterate over the subtree of this container, in depth-first
+        pre-order, without recursion
+
+        Returns
+        -------
+        generator : Container
+          this container, followed by all its descendants
+        """
+        stack = [self]
+        while stack:
+            ctr = stack.pop()
+            yield ctr
+            stack.extend(reversed(ctr.children))
+
+    def _cache_is_valid(self):
+        """Check if the cached values are up to date, in O(1)"""
+        root = self._cached_root
+        return (root is not None and root.parent is None and
+                self._cache_generation == root._generation)
+
+    def _invalidate_cache(self):
+        """Mark the cached values of the tree of this container as stale,
+        before a link change. A stale container is in a tree which is
+        stale as a whole, and which is left as is."""
+        if self._cache_is_valid():
+            self._cached_root._generation += 1
+
+    def _update_cache(self):
+        """Compute the root, depth and subtree size of all the containers
+        of the tree in one pass"""
+        root = self
+        while root.parent is not None:
+            root = root.parent
+
+        generation = root._generation
+        nodes = []
+        for ctr, depth in root.walk():
+            ctr._cached_root = root
+            ctr._cached_depth = depth
+            ctr._cached_size = 1
+            ctr._cache_generation = generation
+            nodes.append(ctr)
+        for ctr in reversed(nodes):
+            if ctr.parent is not None:
+                ctr.parent._cached_size += ctr._cached_size
+
     @property
     def tree_size(self):
-        """Recursively count the number of children containers.
+        """Count the number of containers in the subtree.
         The current container is also included in the count.
         """
-
-        return 1 + sum([child.tree_size for child in self.children])
+        if not self._cache_is_valid():
+            self._update_cache()
+        return self._cached_size
 
     @property
     def current_depth(self):
         """Compute the depth in the hierarchy of the current container"""
-
-        if self.parent is None:
-            return 0
-        else:
-            return 1 + self.parent.current_depth
+        if not self._cache_is_valid():
+            depth = 0
+            ctr = self.parent
+            while ctr is not None:
+                depth += 1
+                ctr = ctr.parent
+            return depth
+        return self._cached_depth
 
     def flatten(self):
         """ Return a flatten version of the hierarchical tree
@@ -155,11 +201,7 @@ class Container(dict):
         list : Containers
           a flat list of containers
         """
-        from itertools import chain
-
-        in_list = [[self]] + [child.flatten() for child in self.children]
-
-        return list(chain.from_iterable(in_list))
+        return list(self.iter_subtree())
 
     @property
     def root(self):
@@ -169,14 +211,19 @@ class Container(dict):
         -------
         Containe: the top most level container
         """
+        if not self._cache_is_valid():
+            root = self
+            while root.parent is not None:
+                root = root.parent
+            return root
+        return self._cached_root
 
-        if self.parent is None:
-            return self
-        else:
-            return self.parent.root
 
+class _JwzMixin(object):
+    """Methods specific to containers holding a Message, accessed as
+    ``container['message']``."""
+    __slots__ = ()
 
-class JwzContainer(Container):
     def collapse_empty(self, inplace=True):
         """ Collapse empty top level containers.
 
@@ -214,48 +261,292 @@ class JwzContainer(Container):
         # In the following, self.message is None
 
         # make the 1st children the new root container
-        children = self.children
+        children = list(self.children)
 
         new_root = children[0]
-        new_root.parent = None
+        self.remove_child(new_root)
 
         for idx in range(1, len(children)):
-            child = children[idx]
-            child.parent = new_root
-            new_root.children.append(child)
+            new_root.add_child(children[idx])
 
         return new_root
 
     def to_dict(self, include=[]):
         """ Convert a Container tree to a nested dict
         """
-        if 'message' not in self:
-            raise ValueError('This method is currently valid with email'
-                             'threading, please overwrite it for '
-                             'other applications')
+        out = None
+        stack = [(self, None)]
+        while stack:
+            ctr, parent_res = stack.pop()
+
+            if 'message' not in ctr:
+                raise ValueError('This method is currently valid with email'
+                                 'threading, please overwrite it for '
+                                 'other applications')
 
-        if self['message'] is None:
-            raise ValueError('Containers with None messages are not '
-                             'supported:!\n this: {}'.format(self))
+            if ctr['message'] is None:
+                raise ValueError('Containers with None messages are not '
+                                 'supported:!\n this: {}'.format(ctr))
 
-        res = {'id': self['message'].message_idx}
+            res = {'id': ctr['message'].message_idx}
 
-        for key in include:
-            res[key] = getattr(self['message'], key)
+            for key in include:
+                res[key] = getattr(ctr['message'], key)
 
-        if self.parent is not None:
-            if self.parent['message'] is not None:
-                res['parent'] = self.parent['message'].message_idx
+            if ctr.parent is not None:
+                if ctr.parent['message'] is not None:
+                    res['parent'] = ctr.parent['message'].message_idx
+                else:
+                    raise ValueError('Containers with None messages are not '
+                                     'supported:!\n    this: {}\n    '
+                                     'parent: {}'.format(ctr, ctr.parent))
             else:
-                raise ValueError('Containers with None messages are not '
-                                 'supported:!\n    this: {}\n    parent: {}'
-                                 .format(self, self.parent))
+                res['parent'] = None
+
+            res['children'] = []
+            if parent_res is None:
+                out = res
+            else:
+                parent_res['children'].append(res)
+
+            stack.extend([(child, res) for child in reversed(ctr.children)])
+
+        return out
+
+
+class Container(_TreeMixin, dict):
+    """Contains a tree of objects. Each container is a subclassed dict
+    where the contents are stored.
+
+    Attributes:
+        children ([Container]): Possibly-empty list of child containers
+        parent (Container): Parent container, if any
+    """
+    def __init__(self, **args):
+        dict.__init__(self, **args)
+        self.parent = None
+        self.children = []
+        self._generation = 0
+        self._cached_root = None
+        self._cache_generation = -1
+
+    def __repr__(self):
+        return '<%s %x: %r>' % (self.__class__.__name__, id(self),
+                                dict.__repr__(self))
+
+    def __hash__(self):
+        """ Make the container hashable. Care must be taken though not to change
+        the container contents after the initialization as otherwise the hash
+        value will change
+        """
+        return hash(tuple(sorted(self.items())) + (self.parent,))
+
+    @property
+    def is_dummy(self):
+        """Check if the container has some content."""
+        return not len(self.keys())
+
+    def add_child(self, child):
+        """Add a child to the container
+
+        Parameters
+        ----------
+        child : Container
+           Child to add.
+        """
+        self._invalidate_cache()
+        if child.parent is not None:
+            child.parent.remove_child(child)
         else:
-            res['parent'] = None
+            child._invalidate_cache()
+        self.children.append(child)
+        child.parent = self
 
-        res['children'] = [el.to_dict(include=include) for el in self.children]
+    def remove_child(self, child):
+        """Remove a child from the container
 
-        return res
+        Parameters
+        ----------
+        child : Container
+           Child to remove.
+        """
+        self._invalidate_cache()
+        self.children.remove(child)
+        child.parent = None
+
+    def sort_children(self, key=None, reverse=False):
+        """Sort the children in place, as list.sort
+
+        Parameters
+        ----------
+        key : callable
+           function of a child container returning its sort key
+        reverse : bool
+           reverse the order
+        """
+        self.children.sort(key=key, reverse=reverse)
+
+
+class JwzContainer(_JwzMixin, Container):
+    pass
+
+
+class ThreadNode(_JwzMixin, _TreeMixin):
+    """Lightweight container of a Message, used by thread().
+
+    Contrary to JwzContainer, this is not a dict: the message is stored
+    in a slot, which can also be accessed as ``node['message']`` for
+    compatibility. Nodes are hashed by identity, and the children are
+    kept in an intrusive doubly linked list, so that adding or removing
+    a child is O(1) whatever the number of siblings.
+
+    Attributes:
+        message (Message): the message, or None for a dummy node
+        parent (ThreadNode): Parent node, if any
+        children ([ThreadNode]): Possibly-empty list of child nodes,
+            built on access: modifying it does not change the node, use
+            add_child, remove_child and sort_children instead
+    """
+    __slots__ = ('message', 'parent', '_first_child', '_last_child',
+                 '_prev_sibling', '_next_sibling', '_generation',
+                 '_cache_generation', '_cached_root', '_cached_depth',
+                 '_cached_size')
+
+    def __init__(self, message=None):
+        self.message = message
+        self.parent = None
+        self._first_child = None
+        self._last_child = None
+        self._prev_sibling = None
+        self._next_sibling = None
+        self._generation = 0
+        self._cached_root = None
+        self._cache_generation = -1
+
+    def __repr__(self):
+        return '<%s %x: %r>' % (self.__class__.__name__, id(self),
+                                {'message': self.message})
+
+    def __getitem__(self, key):
+        if key != 'message':
+            raise KeyError(key)
+        return self.message
+
+    def __setitem__(self, key, value):
+        if key != 'message':
+            raise KeyError(key)
+        self.message = value
+
+    def __contains__(self, key):
+        return key == 'message'
+
+    def get(self, key, default=None):
+        if key != 'message':
+            return default
+        return self.message
+
+    def keys(self):
+        return ['message']
+
+    @property
+    def is_dummy(self):
+        """Check if the node has no message."""
+        return self.message is None
+
+    @property
+    def has_children(self):
+        """Check if the node has at least one child, in O(1)."""
+        return self._first_child is not None
+
+    @property
+    def children(self):
+        """New list of the child nodes, which is not linked to the node"""
+        return list(self.iter_children())
+
+    def iter_children(self):
+        """Iterate over the child nodes"""
+        child = self._first_child
+        while child is not None:
+            yield child
+            child = child._next_sibling
+
+    def add_child(self, child):
+        """Add a child to the node, in O(1)
+
+        Parameters
+        ----------
+        child : ThreadNode
+           Child to add.
+        """
+        # containers which were never cached are skipped inline, as step 1
+        # links fresh containers only
+        if self._cached_root is not None:
+            self._invalidate_cache()
+        if child.parent is not None:
+            child.parent.remove_child(child)
+        elif child._cached_root is not None:
+            child._invalidate_cache()
+        last = self._last_child
+        if last is None:
+            self._first_child = child
+        else:
+            last._next_sibling = child
+        child._prev_sibling = last
+        self._last_child = child
+        child.parent = self
+
+    def remove_child(self, child):
+        """Remove a child from the node, in O(1)
+
+        Parameters
+        ----------
+        child : ThreadNode
+           Child to remove.
+        """
+        if child.parent is not self:
+            raise ValueError('{!r} is not a child of {!r}'
+                             .format(child, self))
+        if self._cached_root is not None:
+            self._invalidate_cache()
+        prev_sibling = child._prev_sibling
+        next_sibling = child._next_sibling
+        if prev_sibling is None:
+            self._first_child = next_sibling
+        else:
+            prev_sibling._next_sibling = next_sibling
+        if next_sibling is None:
+            self._last_child = prev_sibling
+        else:
+            next_sibling._prev_sibling = prev_sibling
+        child._prev_sibling = child._next_sibling = None
+        child.parent = None
+
+    def sort_children(self, key=None, reverse=False):
+        """Sort the children in place, as list.sort
+
+        The order of the children does not change the cached root, depth
+        and size of the nodes, which stay valid.
+
+        Parameters
+        ----------
+        key : callable
+           function of a child node returning its sort key
+        reverse : bool
+           reverse the order
+        """
+        children = self.children
+        if len(children) < 2:
+            return
+        children.sort(key=key, reverse=reverse)
+        prev = None
+        for child in children:
+            child._prev_sibling = prev
+            if prev is not None:
+                prev._next_sibling = child
+            prev = child
+        prev._next_sibling = None
+        self._first_child = children[0]
+        self._last_child = prev
 
 
 class Message(object):
@@ -269,56 +560,270 @@ class Message(object):
             and References headers.
         message (any): Can contain information for the caller's use
             (e.g. an RFC-822 message object).
+        normalized_subject (str): Subject line without the 'Re:' prefixes
+            and '[list]' tags, computed once and cached.
+        date (int): UNIX timestamp of the Date header, or of the mbox
+            ``From`` line without a valid Date header, None if unknown.
     """
     message = None
     message_id = None
-    references = []
     subject = None
+    date = None
+
+    # subject for which _normalized_subject was computed
+    _normalized_key = None
+    _normalized_subject = None
 
     message_idx = None  # internal message number in the mailbox
 
     def __init__(self, msg=None, message_idx=None, decode_header=False):
+        self.references = []
         if msg is None:
             return
 
         if message_idx is not None:
             self.message_idx = message_idx
 
-        msg_id = MSGID_RE.search(msg.get('Message-ID', ''))
-        if msg_id is None:
-            raise ValueError('Message does not contain a Message-ID: header')
-
+        self._set_headers(msg.get('Message-ID', ''),
+                          msg.get('References', ''),
+                          msg.get('In-Reply-To', ''),
+                          msg.get('Subject', "No subject"),
+                          decode_header=decode_header)
+        self.date = parse_date(msg.get('Date'))
+        if self.date is None and hasattr(msg, 'get_unixfrom'):
+            self.date = parse_date(None, msg.get_unixfrom())
         self.message = msg
-        self.message_id = msg_id.group(1)
-
-        self.references = unique(MSGID_RE.findall(msg.get('References', '')))
-        subject = msg.get('Subject', "No subject")
-        if decode_header:
-            from email.header import decode_header
-            subject, subject_encoding = decode_header(subject)[0]
-            if isinstance(subject, bytes) and subject_encoding is not None:
-                if sys.version_info > (3, 0):
-                    if subject_encoding == 'unknown-8bit':
-                        try:
-                            subject = subject.decode('utf-8')
-                        except:  # noqa
-                            pass
-
-                    else:
-                        subject = subject.decode(subject_encoding)
 
+    @classmethod
+    def from_headers(cls, message_id, references='', in_reply_to='',
+                     subject="No subject", message_idx=None,
+                     decode_header=False, ids=None, date=None,
+                     unixfrom=None):
+        """Create a Message from the raw values of the Message-ID,
+        References, In-Reply-To, Subject and Date headers, without an
+        email object.
+
+        With a MessageIdTable as `ids`, the Message-IDs are interned and
+        `message_id` and `references` hold integers. `unixfrom` is the
+        mbox ``From`` line, used for the date if the Date header is
+        missing or invalid.
+
+        Raises:
+            ValueError: if `message_id` does not contain a Message-ID
+        """
+        msg = cls()
+        if message_idx is not None:
+            msg.message_idx = message_idx
+        msg._set_headers(message_id, references, in_reply_to, subject,
+                         decode_header=decode_header, ids=ids)
+        msg.date = parse_date(date, unixfrom)
+        return msg
+
+    def _set_headers(self, message_id, references, in_reply_to, subject,
+                     decode_header=False, ids=None):
+        """Fill in the attributes from the raw values of the Message-ID,
+        References, In-Reply-To and Subject headers"""
+        self.message_id, self.references, self.subject = _parse_headers(
+            message_id, references, in_reply_to, subject, decode_header,
+            ids)
+
+    @property
+    def normalized_subject(self):
+        subject = self.subject
+        if self._normalized_key is not subject or subject is None:
+            self._normalized_subject = normalize_subject(subject)
+            self._normalized_key = subject
+        return self._normalized_subject
+
+    def __repr__(self):
+        return '<%s: %r>' % (self.__class__.__name__, self.message_id)
+
+
+class CompactMessage(object):
+    """A memory efficient message to be threaded.
+
+    Unlike Message, a CompactMessage has no instance dictionary and does
+    not hold the original email: it can be loaded on demand with the
+    `loader` callback, which is usually shared by all the messages of a
+    mailbox, e.g. the __getitem__ method of a utils.MboxIndex.
+
+    Arguments:
+        message_id (str): Message ID
+        references (tuple): message IDs from the In-Reply-To and
+            References headers
+        subject (str): Subject line of the message
+        message_idx (int): internal message number in the mailbox
+        loader (callable): called with `message_idx`, returns the
+            original message
+        date (int): UNIX timestamp of the message, see Message
+
+    Attributes:
+        normalized_subject (str): Subject line without the 'Re:' prefixes
+            and '[list]' tags, computed at creation.
+        message (any): the original message, as returned by `loader`, or
+            None without a loader
+    """
+    __slots__ = ('message_id', 'references', 'subject', 'normalized_subject',
+                 'message_idx', 'loader', 'date')
+
+    def __init__(self, message_id, references=(), subject=None,
+                 message_idx=None, loader=None, date=None):
+        self.message_id = message_id
+        self.references = tuple(references)
         self.subject = subject
+        self.normalized_subject = normalize_subject(subject)
+        self.message_idx = message_idx
+        self.loader = loader
+        self.date = date
+
+    @classmethod
+    def from_headers(cls, message_id, references='', in_reply_to='',
+                     subject="No subject", message_idx=None,
+                     decode_header=False, ids=None, loader=None, date=None,
+                     unixfrom=None):
+        """Create a CompactMessage from the raw values of the Message-ID,
+        References, In-Reply-To, Subject and Date headers, see
+        Message.from_headers"""
+        message_id, references, subject = _parse_headers(
+            message_id, references, in_reply_to, subject, decode_header, ids)
+        return cls(message_id, references, subject, message_idx, loader,
+                   parse_date(date, unixfrom))
+
+    @classmethod
+    def from_message(cls, msg, loader=None):
+        """Create a CompactMessage with the attributes of a Message"""
+        return cls(msg.message_id, msg.references, msg.subject,
+                   msg.message_idx, loader, msg.date)
 
-        # Get In-Reply-To: header and add it to references
-        msg_id = MSGID_RE.search(msg.get('In-Reply-To', ''))
-        if msg_id:
-            msg_id = msg_id.group(1)
-            if msg_id not in self.references:
-                self.references.append(msg_id)
+    @property
+    def message(self):
+        if self.loader is None:
+            return None
+        return self.loader(self.message_idx)
 
     def __repr__(self):
         return '<%s: %r>' % (self.__class__.__name__, self.message_id)
 
+
+class MessageIdTable(object):
+    """Interning of Message-IDs to dense integers.
+
+    Messages created with a MessageIdTable (see Message.from_headers and
+    the `ids` argument of utils.iter_messages) have integer `message_id`
+    and `references`, which are threaded like string ids, and take much
+    less memory: every reference is a pointer to an int object shared by
+    all the messages.
+
+    The table can be saved to a JSON file, and is pickled as the list
+    of its Message-IDs.
+    """
+
+    def __init__(self, message_ids=()):
+        self._ids = []
+        self._index = {}
+        for message_id in message_ids:
+            self.intern(message_id)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, message_id):
+        return message_id in self._index
+
+    def __getitem__(self, idx):
+        """Message-ID of an integer id"""
+        return self._ids[idx]
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def intern(self, message_id):
+        """Integer id of a Message-ID, assigned on first use"""
+        idx = self._index.get(message_id)
+        if idx is None:
+            idx = self._index[message_id] = len(self._ids)
+            self._ids.append(message_id)
+        return idx
+
+    def get(self, message_id, default=None):
+        """Integer id of a Message-ID, or `default` if it was never seen"""
+        return self._index.get(message_id, default)
+
+    def intern_message(self, msg):
+        """Replace the Message-IDs of a message by their integer ids"""
+        intern = self.intern
+        msg.message_id = intern(msg.message_id)
+        msg.references = msg.references.__class__(
+            [intern(ref) for ref in msg.references])
+        return msg
+
+    def __getstate__(self):
+        return self._ids
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    def save(self, filename):
+        """Write the table to a JSON file"""
+        import json
+        with open(filename, 'w') as fh:
+            json.dump(self._ids, fh)
+
+    @classmethod
+    def load(cls, filename):
+        """Read a table written by save()"""
+        import json
+        with open(filename) as fh:
+            return cls(json.load(fh))
+
+
+class ThreadingStats(object):
+    """Timings and counters collected by thread(), when passed as its
+    `stats` argument.
+
+    The values are added to, so that a single instance can collect the
+    totals of several calls to thread().
+
+    Attributes:
+        times (OrderedDict): step name -> wall time in seconds, for the
+            steps "link" (1), "root_set" (2), "prune" (4),
+            "group_by_subject" (5) and "total"
+        containers (int): containers created in step 1
+        dummies (int): containers without a message after step 1
+        loop_links (int): links not added because they would
+            create a loop
+        existing_parent_links (int): links ignored because the
+            container already had a parent
+        pruned (int): empty containers removed in step 4
+        promoted (int): children promoted in the place of their
+            empty parent in step 4
+        subject_merges (int): root containers merged with another one
+            having the same subject in step 5
+    """
+    counters = ('containers', 'dummies', 'loop_links',
+                'existing_parent_links', 'pruned', 'promoted',
+                'subject_merges')
+
+    def __init__(self):
+        self.times = OrderedDict()
+        for name in self.counters:
+            setattr(self, name, 0)
+
+    def add_time(self, step, seconds):
+        """Add `seconds` to the wall time of `step`"""
+        self.times[step] = self.times.get(step, 0.) + seconds
+
+    def to_dict(self):
+        """Export the timings and counters to a dict"""
+        res = OrderedDict((name, getattr(self, name))
+                          for name in self.counters)
+        res['times'] = OrderedDict(self.times)
+        return res
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, ', '.join(
+            '%s=%d' % (name, getattr(self, name)) for name in self.counters))
+
 #
 # functions
 #
@@ -329,44 +834,201 @@ def unique(alist):
     return [result.setdefault(e, e) for e in alist if e not in result]
 
 
-def prune_container(container):
+def _parse_headers(message_id, references, in_reply_to, subject,
+                   decode_header=False, ids=None):
+    """Extract the Message-ID, the list of references and the subject
+    from the raw values of the Message-ID, References, In-Reply-To and
+    Subject headers, with Message-IDs interned in `ids` if given"""
+    msg_id = MSGID_RE.search(message_id)
+    if msg_id is None:
+        raise ValueError('Message does not contain a Message-ID: header')
+
+    message_id = msg_id.group(1)
+
+    references = unique(MSGID_RE.findall(references))
+    if decode_header:
+        from email.header import decode_header
+        subject, subject_encoding = decode_header(subject)[0]
+        if isinstance(subject, bytes) and subject_encoding is not None:
+            if sys.version_info > (3, 0):
+                if subject_encoding == 'unknown-8bit':
+                    try:
+                        subject = subject.decode('utf-8')
+                    except:  # noqa
+                        pass
+
+                else:
+                    subject = subject.decode(subject_encoding)
+
+    # Get In-Reply-To: header and add it to references
+    msg_id = MSGID_RE.search(in_reply_to)
+    if msg_id:
+        msg_id = msg_id.group(1)
+        if msg_id not in references:
+            references.append(msg_id)
+
+    if ids is not None:
+        intern = ids.intern
+        message_id = intern(message_id)
+        references = [intern(ref) for ref in references]
+
+    return message_id, references, subject
+
+
+# raw subject -> normalized subject, shared by all calls to
+# normalize_subject
+_subject_cache = {}
+# normalized subject -> the same string, so that equal normalized
+# subjects are stored only once
+_normalized_subjects = {}
+
+
+def normalize_subject(subject):
+    """Remove the 'Re:' prefixes and '[list]' tags from a subject line.
+
+    Results are cached, and the returned strings are interned, which
+    makes normalizing the same subject lines over and over again cheap.
+
+    Arguments:
+        subject (str): subject line, or None
+
+    Returns:
+        str: normalized subject, '' for a missing subject
+    """
+    try:
+        return _subject_cache[subject]
+    except KeyError:
+        pass
+    if subject is None:
+        return ''
+    normalized = SUBJECT_RE.sub('', subject).strip()
+    if len(_subject_cache) >= SUBJECT_CACHE_SIZE:
+        _subject_cache.clear()
+        _normalized_subjects.clear()
+    normalized = _normalized_subjects.setdefault(normalized, normalized)
+    _subject_cache[subject] = normalized
+    return normalized
+
+
+# raw Date header or mbox From line -> UNIX timestamp, shared by all
+# calls to parse_date
+_date_cache = {}
+
+
+def _parse_date(value, unixfrom=False):
+    """Parse a Date header value, or an mbox From line, uncached"""
+    if unixfrom:
+        # "From sender asctime-date", where the sender may contain
+        # spaces, e.g. "From user at example.org  Fri Jan  1 ..."
+        value = value.split()[-5:]
+        if len(value) < 5:
+            return None
+        value = ' '.join(value)
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    try:
+        return calendar.timegm(parsed[:9]) - (parsed[9] or 0)
+    except (ValueError, OverflowError, TypeError):
+        return None
+
+
+def parse_date(date, unixfrom=None):
+    """Convert the Date header of a message to a UNIX timestamp.
+
+    Mailing lists repeat the same date formats and often the same
+    values, so results are cached, making parsing the dates of a large
+    archive cheap.
+
+    Arguments:
+        date (str): value of the Date header, or None
+        unixfrom (str): the mbox ``From`` line of the message, used if
+               the Date header is missing or invalid
+
+    Returns:
+        int: seconds since the epoch, or None if no date could be parsed
+    """
+    for value, is_unixfrom in ((date, False), (unixfrom, True)):
+        if not value:
+            continue
+        try:
+            timestamp = _date_cache[value]
+        except KeyError:
+            timestamp = _parse_date(value, is_unixfrom)
+            if len(_date_cache) >= DATE_CACHE_SIZE:
+                _date_cache.clear()
+            _date_cache[value] = timestamp
+        if timestamp is not None:
+            return timestamp
+    return None
+
+
+def prune_container(container, stats=None):
     """Prune a tree of containers.
 
-    Recursively prune a tree of containers, as described in step 4 of
-    the algorithm. Returns a list of the children that should replace
-    this container.
+    Prune a tree of containers, as described in step 4 of the algorithm,
+    visiting the containers in post-order with an explicit stack.
+    Returns a list of the children that should replace this container.
 
     Arguments:
         container (Container): Container to prune
+        stats (ThreadingStats): optional, counts the pruned containers
+            and the promoted children
 
     Returns:
         List of zero or more containers.
     """
-    # Prune children, assembling a new list of children
-    new_children = []
+    # id() of each pruned container -> list of containers replacing it
+    pruned = {}
+    stack = [(container, False)]
+
+    while stack:
+        ctr, children_pruned = stack.pop()
+        if not children_pruned:
+            stack.append((ctr, True))
+            stack.extend([(child, False) for child in reversed(ctr.children)])
+            continue
 
-    for ctr in container.children[:]:  # copy the container.children list
-        pruned_child = prune_container(ctr)
-        new_children.extend(pruned_child)
-        container.remove_child(ctr)
+        # Prune children, assembling a new list of children
+        new_children = []
+
+        for child in list(ctr.children):  # copy the ctr.children list
+            new_children.extend(pruned.pop(id(child)))
+            ctr.remove_child(child)
+
+        for child in new_children:
+            ctr.add_child(child)
+
+        if ctr.get('message') is None and not len(new_children):
+            # step 4 (a) - nuke empty containers
+            pruned[id(ctr)] = []
+            if stats is not None:
+                stats.pruned += 1
+        elif (ctr.get('message') is None and
+              (len(new_children) == 1 or
+               ctr.parent is not None)):
+            # step 4 (b) - promote children
+            for child in new_children:
+                ctr.remove_child(child)
+            pruned[id(ctr)] = new_children
+            if stats is not None:
+                stats.pruned += 1
+                stats.promoted += len(new_children)
+        else:
+            # Leave this node in place
+            pruned[id(ctr)] = [ctr]
 
-    for child in new_children:
-        container.add_child(child)
+    return pruned[id(container)]
 
-    if container.get('message') is None and not len(container.children):
-        # step 4 (a) - nuke empty containers
-        return []
-    elif (container.get('message') is None and
-          (len(container.children) == 1 or
-           container.parent is not None)):
-        # step 4 (b) - promote children
-        children = container.children[:]
-        for child in children:
-            container.remove_child(child)
-        return children
-    else:
-        # Leave this node in place
-        return [container]
+
+def _message_key(key):
+    """Function of a Message returning its sort key, from an attribute
+    name or a function"""
+    if callable(key):
+        return key
+    elif not isinstance(key, (str, type(u''))):
+        raise ValueError('Wrong input argument `sort_by`={}'.format(key))
+    return attrgetter(str(key))
 
 
 def sort_threads(threads, key='message_idx', missing=-1, reverse=False):
@@ -374,35 +1036,277 @@ def sort_threads(threads, key='message_idx', missing=-1, reverse=False):
 
     Arguments:
         messages ([Container]): List of Container items
-        group_by_subject (bool): Group root set by subject
-               step 5 of the JWZ algorithm.
-        key (str or None): optional sorting order for threads
-               Valid values are "message_id", "subject", "message_idx"
+        key (str or callable): optional sorting order for threads,
+               either an attribute of the messages such as "message_id",
+               "subject" or "message_idx", or a function of a Message
         missing (None): if the container has no message,
                replace it with this value
-        reverse (book): reverse the order
+        reverse (bool): reverse the order
     Returns:
         list ([Container]): sorted list of containers
     """
+    get_key = _message_key(key)
 
     def _sort_func(el):
 
         if el.get('message') is None:
             val = missing
         else:
-            val = getattr(el.get('message'), key)
+            val = get_key(el.get('message'))
         if val is None:
             val = missing
         return val
 
-    if key in ['message_id', 'subject', 'message_idx']:
-        threads = sorted(threads, key=_sort_func)
+    return sorted(threads, key=_sort_func, reverse=reverse)
+
+
+def sort_forest(threads, key='message_idx', missing=-1, reverse=False,
+                latest_activity=False):
+    """Sort threaded emails recursively: the threads, and the children
+    of every container.
+
+    The sort key of every container is computed exactly once, and the
+    children lists are sorted in place in a single iterative pass over
+    the forest, which takes O(n log(fan-out)) time.
+
+    Arguments:
+        threads ([Container]): List of Container items
+        key (str or callable): sorting order, either an attribute of
+               the messages such as "message_idx" or "subject", or a
+               function of a Message
+        missing (None): if the container has no message,
+               replace it with this value
+        reverse (bool): reverse the order
+        latest_activity (bool): sort the threads by the largest key
+               in the whole thread instead of the key of the root, e.g.
+               by the date of the latest reply. The children are still
+               sorted by their own key.
+    Returns:
+        list ([Container]): sorted list of the root containers
+    """
+    get_key = _message_key(key)
+    keys = {}
+    root_keys = {}
+    for root in threads:
+        latest = None
+        for ctr in root.iter_subtree():
+            msg = ctr['message']
+            val = None if msg is None else get_key(msg)
+            if val is None:
+                val = missing
+            elif latest is None or val > latest:
+                latest = val
+            keys[id(ctr)] = val
+        if latest_activity:
+            root_keys[id(root)] = missing if latest is None else latest
+        else:
+            root_keys[id(root)] = keys[id(root)]
+
+    def _sort_func(ctr):
+        return keys[id(ctr)]
+
+    for root in threads:
+        stack = [root]
+        while stack:
+            ctr = stack.pop()
+            ctr.sort_children(key=_sort_func, reverse=reverse)
+            stack.extend(ctr.children)
+
+    return sorted(threads, key=lambda ctr: root_keys[id(ctr)],
+                  reverse=reverse)
+
+
+class ThreadIndex(object):
+    """Lookup index over a threaded forest, as returned by thread() or
+    Threader.threads().
+
+    The index is built in a single O(n) pass over the forest: containers
+    are numbered in depth-first pre-order, so that the descendants of a
+    container are the contiguous range that follows it. Messages are
+    then located by Message-ID or message_idx in O(1), and the
+    ancestors, descendants and siblings queries cost O(size of the
+    answer). Dummy containers are in the forest but cannot be looked up.
+
+    The index is a snapshot: it must be rebuilt once the containers are
+    modified, e.g. after adding messages to a Threader.
+
+    Arguments:
+        threads ([Container]): the root containers of the threads
+    """
+
+    def __init__(self, threads):
+        self.threads = threads
+        nodes = self._nodes = []
+        parents = self._parents = []
+        roots = self._roots = []
+        by_id = self._by_id = {}
+        by_idx = self._by_idx = {}
+
+        for root in threads:
+            root_pos = len(nodes)
+            stack = [(root, -1)]
+            while stack:
+                ctr, parent = stack.pop()
+                pos = len(nodes)
+                nodes.append(ctr)
+                parents.append(parent)
+                roots.append(root_pos)
+                msg = ctr['message']
+                if msg is not None:
+                    by_id[msg.message_id] = pos
+                    if msg.message_idx is not None:
+                        by_idx[msg.message_idx] = pos
+                stack.extend((child, pos)
+                             for child in reversed(ctr.children))
+
+        # number of containers in every subtree
+        sizes = self._sizes = [1] * len(nodes)
+        for pos in range(len(nodes) - 1, -1, -1):
+            parent = parents[pos]
+            if parent != -1:
+                sizes[parent] += sizes[pos]
+
+    def __len__(self):
+        """Number of containers in the forest, dummies included"""
+        return len(self._nodes)
+
+    def __contains__(self, message_id):
+        return message_id in self._by_id
+
+    def __getitem__(self, message_id):
+        """Container of a Message-ID, raises KeyError if not found"""
+        return self._nodes[self._by_id[message_id]]
+
+    def get(self, message_id, default=None):
+        """Container of a Message-ID, or `default` if not found"""
+        pos = self._by_id.get(message_id)
+        if pos is None:
+            return default
+        return self._nodes[pos]
+
+    def get_idx(self, message_idx, default=None):
+        """Container of the message with this message_idx, or `default`
+        if not found"""
+        pos = self._by_idx.get(message_idx)
+        if pos is None:
+            return default
+        return self._nodes[pos]
+
+    def root(self, message_id):
+        """Root container of the thread of a Message-ID"""
+        return self._nodes[self._roots[self._by_id[message_id]]]
+
+    def root_idx(self, message_idx):
+        """Root container of the thread of a message_idx"""
+        return self._nodes[self._roots[self._by_idx[message_idx]]]
+
+    def thread_size(self, message_id):
+        """Number of containers in the thread of a Message-ID"""
+        return self._sizes[self._roots[self._by_id[message_id]]]
+
+    def subtree_size(self, message_id):
+        """Number of containers in the subtree of a Message-ID, itself
+        included"""
+        return self._sizes[self._by_id[message_id]]
+
+    def ancestors(self, message_id):
+        """Ancestors of a Message-ID, from its parent up to the root"""
+        nodes = self._nodes
+        parents = self._parents
+        out = []
+        pos = parents[self._by_id[message_id]]
+        while pos != -1:
+            out.append(nodes[pos])
+            pos = parents[pos]
+        return out
+
+    def descendants(self, message_id):
+        """Descendants of a Message-ID, in depth-first pre-order"""
+        pos = self._by_id[message_id]
+        return self._nodes[pos + 1:pos + self._sizes[pos]]
+
+    def siblings(self, message_id):
+        """Other children of the parent of a Message-ID, in order; empty
+        for a root"""
+        pos = self._by_id[message_id]
+        parent = self._parents[pos]
+        if parent == -1:
+            return []
+        ctr = self._nodes[pos]
+        return [child for child in self._nodes[parent].children
+                if child is not ctr]
+
+
+def _link_message(id_table, msg, container_class=ThreadNode, stats=None):
+    """Add a message to the id table, as described in step 1 of the
+    algorithm.
+
+    Arguments:
+        id_table (OrderedDict): Message-ID -> Container mapping
+        msg (Message): message to add
+        container_class (type): class of the new containers
+        stats (ThreadingStats): optional, counts the rejected links
+
+    Returns:
+        the container holding `msg`
+    """
+    # step one (a)
+    this_container = id_table.get(msg.message_id, None)
+    if this_container is not None:
+        this_container['message'] = msg
     else:
-        raise ValueError('Wrong input argument `sort_by`={}'.format(key))
-    return threads
+        this_container = container_class(message=msg)
+        id_table[msg.message_id] = this_container
+
+    # step one (b)
+    prev = None
+    for ref in msg.references:
+        # print "Processing reference for
+        # "+repr(msg.message_id)+": "+repr(ref)
+        container = id_table.get(ref, None)
+        if container is None:
+            container = container_class(message=None)
+            id_table[ref] = container
+
+        if prev is not None:
+            # If they are already linked, don't change the existing links.
+            if container.parent is not None:
+                if stats is not None:
+                    stats.existing_parent_links += 1
+            # Don't add link if it would create a loop. `container` is a
+            # root, so this can only happen if `prev` is in its subtree.
+            elif (container is this_container or container is prev or
+                  (container.has_children and
+                   container.has_descendant(prev))):
+                if stats is not None:
+                    stats.loop_links += 1
+            else:
+                prev.add_child(container)
+
+        prev = container
+        # print "Finished processing reference for
+        # "+repr(msg.message_id)+", container now: "
+        # print_container(container, 0, True)
+    # 1C
+    if prev is not None:
+        # print "Setting parent of "+repr(this_container)+",
+        # to last reference: " + repr (prev)
+        # Don't add link if it would create a loop
+        if not (this_container is prev or
+                (this_container.has_children and
+                 this_container.has_descendant(prev))):
+            prev.add_child(this_container)
+        elif stats is not None:
+            stats.loop_links += 1
+    else:
+        if(this_container.parent):
+            this_container.parent.remove_child(this_container)
 
+    return this_container
 
-def thread(messages, group_by_subject=True):
+
+def thread(messages, group_by_subject=True, backend='dict',
+           container_class=ThreadNode, stats=None, ids=None):
     """Thread a list of mail items.
 
     Takes a list of Message objects, and returns a list of Containers.
@@ -418,57 +1322,69 @@ def thread(messages, group_by_subject=True):
         messages ([Message]): List of Message items
         group_by_subject (bool): Group root set by subject
                (optional) step 5 of the JWZ algorithm.
+        backend (str): "dict" builds one container per Message-ID,
+               "array" runs steps 1-4 over flat integer arrays
+               (see jwzthreading.arrays) and only creates containers
+               for the messages that remain after pruning.
+        container_class (type): class of the returned containers,
+               ThreadNode by default, or e.g. JwzContainer for
+               dict-based containers.
+        stats (ThreadingStats): optional, collects the wall time of every
+               step and counters of the operations on the containers.
+        ids (MessageIdTable): optional, the table which interned the
+               Message-IDs of the messages to integers; the "array"
+               backend then replaces the hash lookups of step 1 by
+               list indexing. Messages with integer ids are threaded
+               by both backends either way.
 
     Returns:
         list of containers, sorted by date
     """
+    if stats is not None:
+        start = default_timer()
+
+    if backend == 'array':
+        from .arrays import thread_arrays
+        root_set = thread_arrays(messages, stats=stats,
+                                 ids=ids).to_containers(container_class)
+    elif backend != 'dict':
+        raise ValueError('Wrong input argument `backend`={}'.format(backend))
+    else:
+        root_set = _thread_containers(messages, container_class, stats)
+
+    if group_by_subject:
+        if stats is not None:
+            t0 = default_timer()
+        root_set = _group_by_subject(root_set, container_class, stats)
+        if stats is not None:
+            stats.add_time('group_by_subject', default_timer() - t0)
+
+    # fill the cached root, depth and size of the containers
+    for container in root_set:
+        container._update_cache()
+
+    if stats is not None:
+        stats.add_time('total', default_timer() - start)
+    return root_set
+
+
+def _thread_containers(messages, container_class=ThreadNode, stats=None):
+    """Run steps 1 to 4 of the algorithm, see thread()"""
+    if stats is not None:
+        t0 = default_timer()
+
     # step one
     id_table = OrderedDict()
 
     for msg in messages:
-        # step one (a)
-        this_container = id_table.get(msg.message_id, None)
-        if this_container is not None:
-            this_container['message'] = msg
-        else:
-            this_container = JwzContainer(message=None)
-            this_container['message'] = msg
-            id_table[msg.message_id] = this_container
+        _link_message(id_table, msg, container_class, stats)
 
-        # step one (b)
-        prev = None
-        for ref in msg.references:
-            # print "Processing reference for
-            # "+repr(msg.message_id)+": "+repr(ref)
-            container = id_table.get(ref, None)
-            if container is None:
-                container = JwzContainer(message=None)
-                id_table[ref] = container
-
-            if prev is not None:
-                # If they are already linked, don't change the existing links.
-                if container.parent is not None:
-                    pass
-                # Don't add link if it would create a loop
-                elif (container is this_container or
-                      container.has_descendant(prev) or
-                      prev.has_descendant(container)):
-                    pass
-                else:
-                    prev.add_child(container)
-
-            prev = container
-            # print "Finished processing reference for
-            # "+repr(msg.message_id)+", container now: "
-            # print_container(container, 0, True)
-        # 1C
-        if prev is not None:
-            # print "Setting parent of "+repr(this_container)+",
-            # to last reference: " + repr (prev)
-            prev.add_child(this_container)
-        else:
-            if(this_container.parent):
-                this_container.parent.remove_child(this_container)
+    if stats is not None:
+        t1 = default_timer()
+        stats.add_time('link', t1 - t0)
+        stats.containers += len(id_table)
+        stats.dummies += sum(1 for container in id_table.values()
+                             if container['message'] is None)
 
     # step two - find root set
     root_set = [container for container in id_table.values()
@@ -477,95 +1393,460 @@ def thread(messages, group_by_subject=True):
     # step three - delete id_table
     del id_table
 
+    if stats is not None:
+        t2 = default_timer()
+        stats.add_time('root_set', t2 - t1)
+
     # step four - prune empty containers
     for container in root_set:
         assert container.parent is None
 
     new_root_set = []
     for container in root_set:
-        new_container = prune_container(container)
+        new_container = prune_container(container, stats)
         new_root_set.extend(new_container)
 
-    root_set = new_root_set
+    if stats is not None:
+        stats.add_time('prune', default_timer() - t2)
 
-    # print '\n\nafter'
-    # for ctr in root_set:
-    # print_container(ctr)
+    return new_root_set
 
-    if not group_by_subject:
-        # skip the following step
-        return root_set
 
-    # step five - group root set by subject
-    subject_table = OrderedDict()
-    for container in root_set:
-        if container['message']:
-            subj = container['message'].subject
-        else:
-            subj = container.children[0]['message'].subject
+def _group_by_subject(root_set, container_class=ThreadNode, stats=None,
+                      subjects=None):
+    """Group a root set by subject, as described in step 5 of the algorithm.
+
+    The result does not depend on the order of the roots, except for the
+    order of the children of the merged containers.
+
+    Arguments:
+        root_set ([Container]): List of pruned root containers
+        container_class (type): class of the new containers
+        stats (ThreadingStats): optional, counts the merged containers
+        subjects ([str]): optional, the normalized subject of every root,
+               if already known
 
-        subj = SUBJECT_RE.sub('', subj)
+    Returns:
+        list of containers, ordered by the first root of each subject
+    """
+    # step five (b) - find the container of every subject: a dummy
+    # container if any, else the message with the fewest 're:' levels,
+    # i.e. the shortest subject. Subjects are normalized once, and roots
+    # without a subject are keyed by id() to keep the ordering.
+    subject_table = OrderedDict()
+    groups = {}
+    if subjects is None:
+        subjects = [_root_subject(container) for container in root_set]
+    for container, subj in zip(root_set, subjects):
         if subj == '':
+            subject_table[id(container)] = container
             continue
-
-        existing = subject_table.get(subj, None)
-        if (existing is None or
-            (existing.message is not None and
-             container.get('message') is None) or
-            (existing.message is not None and
-             container.get('message') is not None and
-             (len(existing.message.subject)
-                 > len(container['message'].subject)))):
+        groups.setdefault(subj, []).append(container)
+        ctr = subject_table.get(subj)
+        if ctr is None:
+            subject_table[subj] = container
+            continue
+        ctr_message = ctr['message']
+        message = container['message']
+        if ctr_message is None:
+            continue
+        if (message is None or
+                len(message.subject) < len(ctr_message.subject)):
             subject_table[subj] = container
 
-    # step five (c)
-    for container in root_set:
-        if container['message']:
-            subj = container['message'].subject
+    # step five (c) - merge the other roots into that container
+    for subj, containers in groups.items():
+        if len(containers) < 2:
+            continue
+        ctr = subject_table[subj]
+        ctr_message = ctr['message']
+        if ctr_message is not None and any(
+                el is not ctr and
+                len(el['message'].subject) == len(ctr_message.subject)
+                for el in containers):
+            # several messages with the fewest levels are siblings
+            ctr = container_class(message=None)
+            subject_table[subj] = ctr
+        for container in containers:
+            if container is ctr:
+                continue
+            if stats is not None:
+                stats.subject_merges += 1
+            if ctr['message'] is None and container['message'] is None:
+                for child in container.children:
+                    ctr.add_child(child)
+            else:
+                ctr.add_child(container)
+
+    return list(subject_table.values())
+
+
+class Threader(object):
+    """Thread messages incrementally.
+
+    Unlike thread(), which discards its id table after step 1, a Threader
+    keeps the id table and the unpruned root set between calls to add().
+    Pruning (step 4) and subject grouping (step 5) are only re-run, when
+    threads() is called, for the threads touched by the messages added
+    or removed since the previous call.
+
+    Note: the containers returned by threads() may be modified by a later
+    call to threads(), and must not be modified by the caller.
+
+    Arguments:
+        group_by_subject (bool): Group root set by subject
+               (optional) step 5 of the JWZ algorithm.
+    """
+    container_class = ThreadNode
+
+    def __init__(self, group_by_subject=True):
+        self.group_by_subject = group_by_subject
+        self._id_table = OrderedDict()
+        # unpruned root containers, keyed by id()
+        self._roots = OrderedDict()
+        # keys of the roots added, removed or modified since the last
+        # call to threads()
+        self._dirty = OrderedDict()
+        # keys of the roots modified since the state was last saved, None
+        # unless the Threader was saved or loaded, see jwzthreading.storage
+        self._modified = None
+        # root key -> [(message, [children], subject)], the pruned root
+        # set of every root, kept so that step 5 can be re-run on fresh
+        # containers
+        self._pruned = {}
+        # keys of self._threads to update from self._pruned: normalized
+        # subjects when grouping, root keys otherwise
+        self._changed = OrderedDict()
+        # root key -> normalized subjects of its pruned roots
+        self._subjects = {}
+        # normalized subject -> OrderedDict of root keys
+        self._groups = {}
+        # root key, or normalized subject when grouping, -> [(position,
+        # Container)], where the position orders the threads as thread()
+        self._threads = OrderedDict()
+        # union-find over the Message-IDs linked by step 1: Message-ID ->
+        # parent Message-ID, and representative -> [(seq, message)] of
+        # the messages of the connected component, see remove()
+        self._components = {}
+        self._members = {}
+        self._n_added = 0
+        # Message-ID -> seq of the message held by its container
+        self._added = {}
+        # Message-ID -> [(seq, message)] of the messages replaced by a
+        # later message with the same Message-ID, replayed by remove()
+        self._replaced = {}
+        # container key -> (seq, position in the message) of the first
+        # occurrence of its Message-ID, i.e. its order in the id table
+        # of thread(), which orders the root set of step 5
+        self._order = {}
+        # Message-IDs dropped from the id table by remove() since the
+        # state was last saved, None like self._modified
+        self._dropped = None
+
+    def __len__(self):
+        """Number of Message-IDs in the id table"""
+        return len(self._id_table)
+
+    @staticmethod
+    def _find_root(container):
+        while container.parent is not None:
+            container = container.parent
+        return container
+
+    def add(self, messages):
+        """Add a batch of messages.
+
+        Arguments:
+            messages ([Message]): List of Message items
+        """
+        for msg in messages:
+            self._add_message(msg, self._n_added)
+            self._n_added += 1
+
+    def _add_message(self, msg, seq):
+        """Run step 1 for a message, the `seq`-th message added"""
+        id_table = self._id_table
+        roots = self._roots
+        dirty = self._dirty
+        modified = self._modified
+
+        this_container = id_table.get(msg.message_id, None)
+        if this_container is not None:
+            # step 1 (c) may move the container away from its parent
+            touched = [this_container.parent]
+            replaced = this_container['message']
         else:
-            subj = container.children[0]['message'].subject
+            touched = []
+            replaced = None
 
-        subj = SUBJECT_RE.sub('', subj)
-        ctr = subject_table.get(subj)
+        this_container = _link_message(id_table, msg, self.container_class)
+        if replaced is not None:
+            self._replaced.setdefault(msg.message_id, []).append(
+                (self._added[msg.message_id], replaced))
 
-        if ctr is None or ctr is container:
-            continue
+        touched.append(this_container)
+        touched.extend(id_table[ref] for ref in msg.references)
+        for container in touched:
+            if container is None:
+                continue
+            key = id(container)
+            if container.parent is not None and key in roots:
+                # this container is not a root anymore
+                del roots[key]
+                dirty[key] = None
+            container = self._find_root(container)
+            key = id(container)
+            roots[key] = container
+            dirty[key] = None
+            if modified is not None:
+                modified[key] = None
+
+        self._index_message(msg, seq)
+
+    def _index_message(self, msg, seq):
+        """Record the order of the containers of a message, the `seq`-th
+        message added, and merge the components of its Message-IDs"""
+        id_table = self._id_table
+        order = self._order
+        for idx, message_id in enumerate([msg.message_id] +
+                                         list(msg.references)):
+            order.setdefault(id(id_table[message_id]), (seq, idx))
+        self._added[msg.message_id] = seq
+
+        # step 1 only links the containers of a message and of its
+        # references, which are therefore in the same component
+        members = self._members
+        component = self._find_component(msg.message_id)
+        members[component].append((seq, msg))
+        for ref in msg.references:
+            other = self._find_component(ref)
+            if other == component:
+                continue
+            if len(members[component]) < len(members[other]):
+                component, other = other, component
+            self._components[other] = component
+            members[component].extend(members.pop(other))
+
+    def _find_component(self, message_id):
+        """Representative of the component of a Message-ID, with path
+        halving"""
+        components = self._components
+        parent = components.get(message_id)
+        if parent is None:
+            components[message_id] = message_id
+            self._members[message_id] = []
+            return message_id
+        while parent != message_id:
+            grandparent = components[parent]
+            components[message_id] = grandparent
+            message_id, parent = grandparent, components[grandparent]
+        return message_id
+
+    def remove(self, message_ids):
+        """Remove messages, as if they had never been added.
+
+        Only the connected components of the removed messages, i.e. the
+        messages linked to them directly or through their references,
+        are threaded again: a removed message whose replies remain is
+        replaced by a dummy container, or by nothing if no remaining
+        message references it, and the links created by its References
+        header are undone. Pruning and subject grouping are re-run for
+        the affected threads on the next call to threads(), which then
+        returns the same threads as threading the remaining messages.
+
+        Arguments:
+            message_ids: Message-IDs of the messages to remove, unknown
+                ids and ids of dummy containers are ignored
+        """
+        id_table = self._id_table
+        removed = set()
+        components = OrderedDict()
+        for message_id in message_ids:
+            container = id_table.get(message_id)
+            if container is None or container['message'] is None:
+                continue
+            removed.add(message_id)
+            components[self._find_component(message_id)] = None
+
+        kept = []
+        for component in components:
+            members = self._members.pop(component)
+            for seq, msg in members:
+                for message_id in [msg.message_id] + list(msg.references):
+                    container = id_table.pop(message_id, None)
+                    self._components.pop(message_id, None)
+                    self._added.pop(message_id, None)
+                    self._replaced.pop(message_id, None)
+                    if container is None:
+                        continue
+                    if self._dropped is not None:
+                        self._dropped[message_id] = None
+                    key = id(container)
+                    del self._order[key]
+                    if key in self._roots:
+                        del self._roots[key]
+                        self._dirty[key] = None
+                        if self._modified is not None:
+                            self._modified[key] = None
+            kept.extend(el for el in members
+                        if el[1].message_id not in removed)
+
+        # thread the remaining messages again, in their original order
+        kept.sort(key=lambda el: el[0])
+        for seq, msg in kept:
+            self._add_message(msg, seq)
+
+    def _update_subject(self, subject):
+        members = self._groups.get(subject)
+        if not members:
+            self._groups.pop(subject, None)
+            self._threads.pop(subject, None)
+            return
+        root_set = []
+        positions = []
+        for key in sorted(members, key=self._order.__getitem__):
+            for idx, (message, children, root_subject) in enumerate(
+                    self._pruned[key]):
+                if root_subject == subject:
+                    root_set.append(_make_root(message, children,
+                                               self.container_class))
+                    positions.append((self._order[key], idx))
+        threads = _group_by_subject(root_set, self.container_class)
+        # roots with a subject are merged at the position of the first
+        # one, roots without a subject are not grouped
+        self._threads[subject] = list(zip(positions, threads))
+
+    def threads(self):
+        """Return the threaded messages.
+
+        Returns:
+            list of containers, in the order of thread()
+        """
+        self._update()
+        return self._sorted(self._threads)
 
-        if ctr.is_dummy and container.is_dummy:
-            for child in ctr.children:
-                container.add_child(child)
-        elif ctr.is_dummy or container.is_dummy:
-            if ctr.is_dummy:
-                ctr.add_child(container)
-            else:
-                container.add_child(ctr)
-        elif len(ctr.message.subject) < len(container['message'].subject):
-            # ctr has fewer levels of 're:' headers
-            ctr.add_child(container)
-        elif len(ctr.message.subject) > len(container['message'].subject):
-            # container has fewer levels of 're:' headers
-            container.add_child(ctr)
+    def updated_threads(self):
+        """Return the threads created or modified since the last call to
+        threads() or updated_threads().
+
+        Returns:
+            list of containers, in the order of thread()
+        """
+        return self._sorted(self._update())
+
+    def _sorted(self, keys):
+        """Containers of the threads of `keys`, sorted by position"""
+        items = [el for key in keys for el in self._threads.get(key, ())]
+        items.sort(key=lambda el: el[0])
+        return [ctr for _, ctr in items]
+
+    def _update_root(self, key):
+        pruned = self._pruned.get(key)
+        if pruned is None:
+            self._threads.pop(key, None)
+            return
+        self._threads[key] = [
+            ((self._order[key], idx),
+             _make_root(message, children, self.container_class))
+            for idx, (message, children, _) in enumerate(pruned)]
+
+    def _set_pruned(self, key, pruned):
+        """Record the pruned root set of a root, given as a list of
+        (message, [children]) pairs"""
+        if self.group_by_subject:
+            # subject of the root, or of its first child for a dummy root
+            pruned = [(message, children, (
+                children[0]['message'] if message is None
+                else message).normalized_subject)
+                for message, children in pruned]
+            subjects = unique([el[2] for el in pruned])
+            self._subjects[key] = subjects
+            for subject in subjects:
+                self._groups.setdefault(subject, OrderedDict())[key] = None
+                self._changed[subject] = None
         else:
-            new = JwzContainer(message=None)
-            new.add_child(ctr)
-            new.add_child(container)
-            subject_table[subj] = new
+            pruned = [(message, children, None)
+                      for message, children in pruned]
+            self._changed[key] = None
+        self._pruned[key] = pruned
+
+    def _prune(self):
+        """Re-run step 4 for the modified threads"""
+        dirty, self._dirty = self._dirty, OrderedDict()
+        for key in dirty:
+            self._pruned.pop(key, None)
+            if self.group_by_subject:
+                for subject in self._subjects.pop(key, ()):
+                    self._groups[subject].pop(key, None)
+                    self._changed[subject] = None
+            else:
+                self._changed[key] = None
+
+            container = self._roots.get(key)
+            if container is not None:
+                # step four - prune a copy of the unpruned tree
+                self._set_pruned(key, [
+                    (ctr['message'], list(ctr.children))
+                    for ctr in prune_container(_copy_tree(container))])
+
+    def _update(self):
+        """Re-run steps 4 and 5 for the modified threads, and return the
+        keys of self._threads that changed"""
+        self._prune()
+        changed, self._changed = self._changed, OrderedDict()
+        for key in changed:
+            if self.group_by_subject:
+                # step five - group the modified subjects
+                self._update_subject(key)
+            else:
+                self._update_root(key)
+        return list(changed)
+
+
+def _copy_tree(container):
+    """Copy a tree of containers, sharing the messages"""
+    container_class = container.__class__
+    new_root = container_class(message=container['message'])
+    stack = [(container, new_root)]
+    while stack:
+        ctr, new_ctr = stack.pop()
+        for child in ctr.children:
+            new_child = container_class(message=child['message'])
+            new_ctr.add_child(new_child)
+            stack.append((child, new_child))
+    return new_root
+
+
+def _make_root(message, children, container_class=ThreadNode):
+    """Create a root container holding `message` and `children`"""
+    container = container_class(message=message)
+    for child in children:
+        container.add_child(child)
+    return container
 
-    return list(subject_table.values())
+
+def _root_subject(container):
+    """Normalized subject of a root container, as used in step 5"""
+    message = container['message']
+    if message is None:
+        message = container.children[0]['message']
+    return message.normalized_subject
 
 
 def print_container(ctr, depth=0, debug=0):
     """Print summary of Thread to stdout."""
-    if 'message' in ctr:
-        if debug:
-            message = (repr(ctr) + ' '
-                       + repr(ctr['message'] and ctr['message'].subject))
+    stack = [(ctr, depth)]
+    while stack:
+        ctr, depth = stack.pop()
+        if 'message' in ctr:
+            if debug:
+                message = (repr(ctr) + ' '
+                           + repr(ctr['message'] and ctr['message'].subject))
+            else:
+                message = str(ctr['message'] and ctr['message'].subject)
         else:
-            message = str(ctr['message'] and ctr['message'].subject)
-    else:
-        message = str(ctr)
+            message = str(ctr)
 
-    print(''.join(['> ' * depth, message]))
+        print(''.join(['> ' * depth, message]))
 
-    for child in ctr.children:
-        print_container(child, depth + 1, debug)
+        stack.extend([(child, depth + 1) for child in reversed(ctr.children)])
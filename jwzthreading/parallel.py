@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+
+"""parallel.py
+
+Threading of large corpora with a pool of worker processes.
+
+Without subject grouping, threads are the connected components of the
+graph linking each Message-ID to its references: step 1 of the
+algorithm only ever links containers of the same component, and the
+links it creates only depend on the order of the messages of that
+component. Almost all the work is done by the worker processes, in
+three rounds:
+
+ 1. the messages are split in as many chunks as processes, and the
+    components of every chunk are found with a union-find;
+ 2. the components sharing Message-IDs with other chunks are merged in
+    the current process, using set operations and a union-find over the
+    components only, and packed into shards of similar sizes; every
+    chunk then lists the positions of its messages in each shard;
+ 3. steps 1 to 4 are run on every shard, and the subjects of the roots
+    are normalized.
+
+The root sets of the shards are then merged in the order they would
+have in a single call to thread(), and step 5 is optionally run on the
+merged root set.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+import gc
+import heapq
+
+from .arrays import NODE_TYPECODE
+from .jwzthreading import (CompactMessage, ThreadNode, prune_container,
+                           thread, _group_by_subject, _link_message,
+                           _root_subject)
+
+__all__ = ['thread_parallel']
+
+# number of shards per worker process, to balance the load
+SHARDS_PER_JOB = 4
+
+# the messages to thread, set in the worker processes
+_messages = None
+
+
+def _init_worker(messages):
+    global _messages
+    _messages = messages
+    # the workers only create long-lived objects, and the collections
+    # would copy the pages of the messages shared with the parent process
+    gc.disable()
+
+
+def _find(parent, node):
+    """Find the representative of a node, with path halving"""
+    while parent[node] != node:
+        parent[node] = parent[parent[node]]
+        node = parent[node]
+    return node
+
+
+def _chunk_components(bounds):
+    """Find the connected components of a chunk of messages, in a worker
+    process.
+
+    Arguments:
+        bounds: (start, stop) positions of the messages of the chunk
+
+    Returns:
+        (labels, message_labels, sizes) where labels maps every
+        Message-ID seen in the chunk to its component, numbered from 0,
+        message_labels is the component of every message of the chunk and
+        sizes the number of messages of every component
+    """
+    start, stop = bounds
+    ids = {}
+    parent = []
+    nodes = []
+    for msg in _messages[start:stop]:
+        node = ids.get(msg.message_id)
+        if node is None:
+            node = ids[msg.message_id] = len(parent)
+            parent.append(node)
+        nodes.append(node)
+        if not msg.references:
+            continue
+        root = _find(parent, node)
+        for ref in msg.references:
+            other = ids.get(ref)
+            if other is None:
+                other = ids[ref] = len(parent)
+                parent.append(root)
+                continue
+            other = _find(parent, other)
+            if other != root:
+                parent[other] = root
+
+    numbers = {}
+    components = [numbers.setdefault(_find(parent, node), len(numbers))
+                  for node in range(len(parent))]
+    labels = dict((message_id, components[node])
+                  for message_id, node in ids.items())
+    message_labels = array(NODE_TYPECODE, [components[node]
+                                           for node in nodes])
+    sizes = [0] * len(numbers)
+    for label in message_labels:
+        sizes[label] += 1
+    return labels, message_labels, sizes
+
+
+def _chunk_shards(args):
+    """List the positions of the messages of a chunk in every shard, in a
+    worker process."""
+    start, message_labels, label_shards, n_shards = args
+    shards = [array(NODE_TYPECODE) for _ in range(n_shards)]
+    appends = [shard.append for shard in shards]
+    for position, label in enumerate(message_labels, start):
+        appends[label_shards[label]](position)
+    return shards
+
+
+def _thread_shard(args):
+    """Run steps 1 to 4 on a shard, in a worker process.
+
+    Arguments:
+        args: (positions, group_by_subject) where positions are the
+            positions of the messages of the shard, in increasing order
+
+    Returns:
+        (keys, sizes, nodes, subjects) describing the pruned trees, where
+        keys gives the order of every tree in the root set of thread(),
+        sizes its number of containers, nodes the (message position or
+        -1, index of the parent in the tree or -1) pairs of its
+        containers, in pre-order, concatenated, and subjects the
+        normalized subject of its root if group_by_subject is set
+    """
+    positions, group_by_subject = args
+    id_table = OrderedDict()
+    # index in the id table of the first Message-ID added by a message,
+    # and the position of that message
+    starts = array(NODE_TYPECODE)
+    start_positions = array(NODE_TYPECODE)
+    # id() of a container -> position of its message
+    position_of = {}
+    for position in positions:
+        n_ids = len(id_table)
+        container = _link_message(id_table, _messages[position])
+        position_of[id(container)] = position
+        if len(id_table) > n_ids:
+            starts.append(n_ids)
+            start_positions.append(position)
+
+    # step two - find the root set before pruning, as step 4 (b)
+    # promotes the children of the dummy roots. A root is ordered by the
+    # position of the message adding its Message-ID to the id table, and
+    # its rank among the Message-IDs added by that message.
+    root_set = []
+    for idx, container in enumerate(id_table.values()):
+        if container.parent is None:
+            message = bisect_right(starts, idx) - 1
+            root_set.append(((start_positions[message], idx - starts[message]),
+                             container))
+    del id_table
+
+    keys = []
+    sizes = array(NODE_TYPECODE)
+    nodes = array(NODE_TYPECODE)
+    subjects = []
+    for key, container in root_set:
+        for idx, ctr in enumerate(prune_container(container)):
+            if group_by_subject:
+                subjects.append(_root_subject(ctr))
+            # pre-order traversal, with the index of the parent in the tree
+            size = 0
+            stack = [(ctr, -1)]
+            while stack:
+                ctr, parent = stack.pop()
+                if ctr.message is None:
+                    nodes.append(-1)
+                else:
+                    nodes.append(position_of[id(ctr)])
+                nodes.append(parent)
+                if ctr.has_children:
+                    stack.extend([(child, size)
+                                  for child in reversed(ctr.children)])
+                size += 1
+            keys.append(key + (idx,))
+            sizes.append(size)
+    return keys, sizes, nodes, subjects
+
+
+def _merge_components(results):
+    """Merge the components of the chunks which share Message-IDs
+
+    Returns:
+        (offsets, components) where the component of the label `label`
+        of the chunk `idx` is ``components[offsets[idx] + label]``
+    """
+    offsets = []
+    n_labels = 0
+    for _, _, sizes in results:
+        offsets.append(n_labels)
+        n_labels += len(sizes)
+    parent = list(range(n_labels))
+
+    # Message-IDs seen by several chunks
+    seen = set()
+    shared = set()
+    for labels, _, _ in results:
+        shared |= seen.intersection(labels)
+        seen.update(labels)
+    del seen
+
+    first = {}
+    for offset, (labels, _, _) in zip(offsets, results):
+        for message_id in shared.intersection(labels):
+            node = _find(parent, offset + labels[message_id])
+            other = _find(parent, first.setdefault(message_id, node))
+            if other != node:
+                parent[node] = other
+    return offsets, [_find(parent, node) for node in range(n_labels)]
+
+
+def thread_parallel(messages, n_jobs=-1, group_by_subject=True,
+                    container_class=ThreadNode):
+    """Thread a list of mail items with a pool of worker processes.
+
+    The result is identical to that of
+    ``thread(messages, group_by_subject, container_class=container_class)``,
+    see the module docstring for details.
+
+    Arguments:
+        messages ([Message]): List of Message items
+        n_jobs (int): number of worker processes, -1 to use all the CPUs
+        group_by_subject (bool): Group root set by subject
+               (optional) step 5 of the JWZ algorithm, run in the
+               current process on the merged root set.
+        container_class (type): class of the returned containers
+
+    Returns:
+        list of containers
+    """
+    import multiprocessing
+
+    messages = list(messages)
+    if n_jobs == -1:
+        n_jobs = multiprocessing.cpu_count()
+    if n_jobs == 1 or len(messages) < n_jobs:
+        return thread(messages, group_by_subject=group_by_subject,
+                      container_class=container_class)
+
+    bounds = [(idx * len(messages) // n_jobs,
+               (idx + 1) * len(messages) // n_jobs) for idx in range(n_jobs)]
+
+    # the messages are inherited by forked worker processes; otherwise,
+    # only their Message-IDs are pickled, once per process
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+        shared = messages
+    else:
+        context = multiprocessing
+        shared = [CompactMessage(msg.message_id, msg.references)
+                  for msg in messages]
+    pool = context.Pool(n_jobs, initializer=_init_worker,
+                        initargs=(shared,))
+    try:
+        results = pool.map(_chunk_components, bounds, chunksize=1)
+        offsets, components = _merge_components(results)
+
+        # size of every component, in messages
+        sizes = {}
+        for offset, (_, _, chunk_sizes) in zip(offsets, results):
+            for label, size in enumerate(chunk_sizes, offset):
+                component = components[label]
+                sizes[component] = sizes.get(component, 0) + size
+
+        # pack the components into shards, largest components first
+        n_shards = min(n_jobs * SHARDS_PER_JOB, len(sizes)) or 1
+        heap = [(0, idx) for idx in range(n_shards)]
+        shard_of = {}
+        for component in sorted(sizes, key=lambda el: (-sizes[el], el)):
+            load, idx = heapq.heappop(heap)
+            shard_of[component] = idx
+            heapq.heappush(heap, (load + sizes[component], idx))
+
+        args = []
+        for (start, _), offset, (_, message_labels, chunk_sizes) in zip(
+                bounds, offsets, results):
+            label_shards = array(NODE_TYPECODE, [
+                shard_of[components[label]]
+                for label in range(offset, offset + len(chunk_sizes))])
+            args.append((start, message_labels, label_shards, n_shards))
+        del results, components, shard_of
+
+        shards = [array(NODE_TYPECODE) for _ in range(n_shards)]
+        for chunk_shards in pool.map(_chunk_shards, args, chunksize=1):
+            for shard, positions in zip(shards, chunk_shards):
+                shard.extend(positions)
+        del args
+
+        results = pool.map(_thread_shard,
+                           [(shard, group_by_subject) for shard in shards],
+                           chunksize=1)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    # the containers are not garbage, collecting while creating them
+    # would repeatedly scan the messages and the results
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        root_set, subjects = _rebuild_trees(messages, results,
+                                            container_class)
+        if group_by_subject:
+            root_set = _group_by_subject(root_set, container_class,
+                                         subjects=subjects)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return root_set
+
+
+def _rebuild_trees(messages, results, container_class):
+    """Create the containers of the pruned trees returned by _thread_shard
+    for every shard, in the order of the root set of thread()
+
+    Returns:
+        (root_set, subjects), subjects being empty unless computed by the
+        worker processes
+    """
+    # the trees of every shard are in the order of the root set, which
+    # is kept by the merge
+    trees = heapq.merge(*[
+        zip(keys, [shard] * len(keys), tree_sizes, range(len(keys)))
+        for shard, (keys, tree_sizes, _, _) in enumerate(results)])
+    starts = [0] * len(results)
+
+    root_set = []
+    subjects = []
+    for _, shard, size, tree in trees:
+        nodes, shard_subjects = results[shard][2:]
+        if shard_subjects:
+            subjects.append(shard_subjects[tree])
+        start = starts[shard]
+        stop = starts[shard] = start + 2 * size
+        position = nodes[start]
+        root = container_class(
+            message=None if position == -1 else messages[position])
+        root_set.append(root)
+        if size == 1:
+            continue
+        containers = [root]
+        for idx in range(start + 2, stop, 2):
+            position = nodes[idx]
+            container = container_class(
+                message=None if position == -1 else messages[position])
+            containers[nodes[idx + 1]].add_child(container)
+            containers.append(container)
+    return root_set, subjects
@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+
+"""storage.py
+
+Persistence of the state of a Threader in a SQLite file, so that
+threading can continue after a restart without re-parsing the archive.
+
+Every container of the id table is stored as one row, including the
+dummy containers of referenced but missing messages:
+
+  seq                 row id of the Message-ID, kept while the
+                      Message-ID is in the id table
+  message_id          the Message-ID, a string or the integer of a
+                      MessageIdTable, stored without type conversion
+  dummy               1 for a container without a message
+  message_idx         Message.message_idx
+  subject             Message.subject
+  normalized_subject  Message.normalized_subject
+  date                Message.date
+  refs                Message.references, as a JSON list
+  added               position of the message in the messages added to
+                      the Threader
+  replaced            messages replaced by a later message with the
+                      same Message-ID, as a JSON list of [added,
+                      message_idx, subject, normalized_subject, date,
+                      refs] lists, NULL if none
+  parent              seq of the parent container, NULL for a root
+  root                seq of the root of the (unpruned) thread
+  position            position of the container among its siblings
+  pruned              for a root, the trees of its pruned root set (step
+                      4), as a JSON list of [seq, index of the parent in
+                      the tree or -1, ...] lists in pre-order, NULL for
+                      the other containers
+
+The `settings` table holds the group_by_subject attribute of the
+Threader.
+
+Only the threading attributes of the messages are stored: the messages
+of a loaded Threader have no `message` attribute. Messages removed with
+Threader.remove are deleted from the file, and only the rows of the
+threads they belonged to are rewritten.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from itertools import islice
+import json
+import sqlite3
+
+from .jwzthreading import Message, Threader
+
+__all__ = ['ThreadStore']
+
+SCHEMA_VERSION = 6
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS containers (
+    seq INTEGER PRIMARY KEY,
+    message_id NOT NULL UNIQUE,
+    dummy INTEGER NOT NULL DEFAULT 1,
+    message_idx INTEGER,
+    subject TEXT,
+    normalized_subject TEXT,
+    date INTEGER,
+    refs TEXT,
+    added INTEGER,
+    replaced TEXT,
+    parent INTEGER,
+    root INTEGER,
+    position INTEGER NOT NULL DEFAULT 0,
+    pruned TEXT
+);
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value
+);
+"""
+
+
+class ThreadStore(object):
+    """SQLite file holding the state of a Threader.
+
+    A Threader is written with save(), and read back with load(). Once a
+    Threader has been saved to, or loaded from, a store, later calls to
+    save() only write the threads modified since the previous call, in
+    a single transaction.
+
+    Arguments:
+        filename (str): path of the SQLite database, created if needed
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        version = self.connection.execute('PRAGMA user_version').fetchone()
+        if version[0] not in (0, SCHEMA_VERSION):
+            raise ValueError('Unsupported schema version {} of {}'.format(
+                             version[0], filename))
+        with self.connection:
+            self.connection.executescript(_SCHEMA)
+            self.connection.execute('PRAGMA user_version = %d'
+                                    % SCHEMA_VERSION)
+        # the Threader in sync with the file, its containers keyed by
+        # id() -> seq, Message-ID -> id() of its container, the number of
+        # its Message-IDs in the file and the next free seq
+        self._threader = None
+        self._seqs = {}
+        self._keys = {}
+        self._n_saved = 0
+        self._next_seq = 0
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        """Number of Message-IDs in the file"""
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM containers').fetchone()[0]
+
+    def lookup(self, message_id):
+        """Get the threading information of a Message-ID.
+
+        Arguments:
+            message_id (str): the Message-ID
+
+        Returns:
+            (message_idx, parent, root, normalized_subject) tuple, where
+            parent and root are Message-IDs (parent is None for a root),
+            or None if the Message-ID is unknown. message_idx and
+            normalized_subject are None for a dummy container.
+        """
+        return self.connection.execute(
+            'SELECT c.message_idx, p.message_id, r.message_id,'
+            ' c.normalized_subject FROM containers c'
+            ' LEFT JOIN containers p ON p.seq = c.parent'
+            ' LEFT JOIN containers r ON r.seq = c.root'
+            ' WHERE c.message_id = ?', (message_id,)).fetchone()
+
+    def save(self, threader):
+        """Write the state of a Threader.
+
+        Arguments:
+            threader (Threader): the threader to save
+        """
+        if threader is not self._threader:
+            # rewrite everything
+            self._threader = threader
+            self._seqs = {}
+            self._keys = {}
+            self._n_saved = 0
+            self._next_seq = 0
+            threader._modified = OrderedDict.fromkeys(threader._roots)
+            threader._dropped = OrderedDict()
+            clear = True
+        else:
+            clear = False
+        id_table = threader._id_table
+        seqs = self._seqs
+        keys = self._keys
+
+        # Message-IDs dropped by Threader.remove: their rows are deleted,
+        # or reused if the Message-ID was added again
+        deletes = []
+        reused = {}
+        dropped, threader._dropped = threader._dropped, OrderedDict()
+        for message_id in dropped:
+            key = keys.pop(message_id, None)
+            if key is None:
+                # not saved yet
+                continue
+            seq = seqs.pop(key)
+            self._n_saved -= 1
+            if message_id in id_table:
+                reused[message_id] = seq
+            else:
+                deletes.append((seq,))
+
+        # Message-IDs added to the id table since the last save, which
+        # follow the saved ones
+        new_ids = {}
+        for message_id, container in islice(id_table.items(),
+                                            self._n_saved, None):
+            seq = reused.pop(message_id, None)
+            if seq is None:
+                seq = self._next_seq
+                self._next_seq += 1
+                new_ids[seq] = message_id
+            seqs[id(container)] = seq
+            keys[message_id] = id(container)
+        self._n_saved = len(id_table)
+
+        def message_seq(msg):
+            return seqs[id(id_table[msg.message_id])]
+
+        # the pruned root sets are stored with the roots, so that load()
+        # does not run step 4 again
+        threader._prune()
+        inserts = []
+        updates = []
+        modified, threader._modified = threader._modified, OrderedDict()
+        for key in modified:
+            root = threader._roots.get(key)
+            if root is None:
+                continue
+            root_seq = seqs[id(root)]
+            pruned = json.dumps([
+                _tree_nodes(root_seq if message is None
+                            else message_seq(message), children, message_seq)
+                for message, children, _ in threader._pruned[key]])
+            stack = [(root, 0)]
+            while stack:
+                container, position = stack.pop()
+                msg = container['message']
+                seq = seqs[id(container)]
+                if container.parent is None:
+                    parent = None
+                else:
+                    parent = seqs[id(container.parent)]
+                if msg is None:
+                    row = (1, None, None, None, None, None, None, None,
+                           parent, root_seq, position)
+                else:
+                    replaced = threader._replaced.get(msg.message_id)
+                    if replaced:
+                        replaced = json.dumps([
+                            [added, old.message_idx, old.subject,
+                             old.normalized_subject, old.date,
+                             list(old.references)]
+                            for added, old in replaced])
+                    row = (0, msg.message_idx, msg.subject,
+                           msg.normalized_subject, msg.date,
+                           json.dumps(list(msg.references)),
+                           threader._added[msg.message_id], replaced,
+                           parent, root_seq, position)
+                row += (pruned if container is root else None,)
+                if seq in new_ids:
+                    inserts.append((seq, new_ids[seq]) + row)
+                else:
+                    updates.append(row + (seq,))
+                stack.extend((child, idx) for idx, child
+                             in enumerate(container.children))
+
+        with self.connection:
+            if clear:
+                self.connection.execute('DELETE FROM containers')
+            self.connection.executemany(
+                'DELETE FROM containers WHERE seq = ?', deletes)
+            self.connection.executemany(
+                'INSERT INTO containers (seq, message_id, dummy,'
+                ' message_idx, subject, normalized_subject, date, refs,'
+                ' added, replaced, parent, root, position, pruned)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                inserts)
+            self.connection.executemany(
+                'UPDATE containers SET dummy = ?, message_idx = ?,'
+                ' subject = ?, normalized_subject = ?, date = ?,'
+                ' refs = ?, added = ?, replaced = ?, parent = ?,'
+                ' root = ?, position = ?, pruned = ? WHERE seq = ?',
+                updates)
+            self.connection.execute(
+                'INSERT OR REPLACE INTO settings (name, value)'
+                ' VALUES (?, ?)',
+                ('group_by_subject', int(threader.group_by_subject)))
+
+    def load(self):
+        """Create a Threader from the file.
+
+        New messages can then be added to the returned Threader, and the
+        modified threads written back with save(). The Threader groups
+        the threads by subject if the saved one did, or if nothing was
+        saved.
+
+        Returns:
+            Threader
+        """
+        setting = self.connection.execute(
+            "SELECT value FROM settings WHERE name = 'group_by_subject'"
+        ).fetchone()
+        threader = Threader(group_by_subject=setting is None or
+                            bool(setting[0]))
+        threader._modified = OrderedDict()
+        threader._dropped = OrderedDict()
+        container_class = threader.container_class
+        id_table = threader._id_table
+
+        containers = {}
+        links = []
+        messages = []
+        root_set = []
+        for (seq, message_id, dummy, message_idx, subject, normalized_subject,
+             date, refs, added, replaced, parent, position,
+             pruned) in self.connection.execute(
+                'SELECT seq, message_id, dummy, message_idx, subject,'
+                ' normalized_subject, date, refs, added, replaced, parent,'
+                ' position, pruned FROM containers ORDER BY seq'):
+            if dummy:
+                msg = None
+            else:
+                msg = _make_message(message_id, message_idx, subject,
+                                    normalized_subject, date,
+                                    json.loads(refs))
+                messages.append((added, msg))
+            if replaced is not None:
+                # the links of the replaced messages are part of the
+                # components used by Threader.remove
+                replaced = [(el[0], _make_message(message_id, *el[1:]))
+                            for el in json.loads(replaced)]
+                threader._replaced[message_id] = replaced
+                messages.extend(replaced)
+            container = container_class(message=msg)
+            id_table[message_id] = container
+            containers[seq] = container
+            if parent is not None:
+                links.append((position, seq, parent))
+            else:
+                root_set.append((container, pruned))
+
+        # children are added in the order of their position
+        links.sort()
+        for _, seq, parent in links:
+            containers[parent].add_child(containers[seq])
+
+        # the order and the components used by Threader.remove
+        messages.sort(key=lambda el: el[0])
+        for added, msg in messages:
+            threader._index_message(msg, added)
+        if messages:
+            threader._n_added = messages[-1][0] + 1
+
+        # the pruned root sets, step 5 is run on the first call to
+        # threads()
+        for container, pruned in root_set:
+            key = id(container)
+            threader._roots[key] = container
+            if pruned is None:
+                threader._dirty[key] = None
+                continue
+            trees = []
+            for nodes in json.loads(pruned):
+                copies = [None]
+                children = []
+                for idx in range(2, len(nodes), 2):
+                    copy = container_class(
+                        message=containers[nodes[idx]]['message'])
+                    if nodes[idx + 1] == 0:
+                        children.append(copy)
+                    else:
+                        copies[nodes[idx + 1]].add_child(copy)
+                    copies.append(copy)
+                trees.append((containers[nodes[0]]['message'], children))
+            threader._set_pruned(key, trees)
+
+        seqs = dict((id(container), seq)
+                    for seq, container in containers.items())
+
+        self._threader = threader
+        self._seqs = seqs
+        self._keys = dict((message_id, id(container))
+                          for message_id, container in id_table.items())
+        self._n_saved = len(id_table)
+        self._next_seq = max(containers) + 1 if containers else 0
+        return threader
+
+
+def _tree_nodes(seq, children, message_seq):
+    """[seq, index of the parent or -1, ...] list of the containers of a
+    pruned tree, in pre-order"""
+    nodes = [seq, -1]
+    stack = [(child, 0) for child in reversed(children)]
+    while stack:
+        container, parent = stack.pop()
+        idx = len(nodes) // 2
+        nodes.extend((message_seq(container['message']), parent))
+        stack.extend((child, idx) for child in reversed(container.children))
+    return nodes
+
+
+def _make_message(message_id, message_idx, subject, normalized_subject, date,
+                  references):
+    """Create a Message from its stored threading attributes"""
+    msg = Message(None)
+    msg.message_id = message_id
+    msg.message_idx = message_idx
+    msg.subject = subject
+    msg.date = date
+    msg.references = references
+    # already normalized subject
+    msg._normalized_key = subject
+    msg._normalized_subject = normalized_subject
+    return msg
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+"""streaming.py
+
+Threading of chronologically ordered archives in bounded memory.
+
+In an archive sorted by date, a thread which has not received a
+message for a while is, in practice, finished. thread_windowed runs
+steps 1 to 4 of the algorithm over a stream of messages, but only keeps
+the open threads in its id table: as soon as the latest message of a
+thread is older than the window, the thread is pruned and yielded, and
+its Message-IDs are evicted. Memory use then depends on the number of
+messages in a window, not on the size of the archive.
+
+A reply arriving after its thread was closed starts a new thread, as
+a message whose parent is missing. Optionally, the most recently closed
+threads are kept, so that such a late reply reopens its thread instead.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+
+from .jwzthreading import (ThreadNode, prune_container, _copy_tree,
+                           _link_message)
+
+__all__ = ['thread_windowed']
+
+
+def thread_windowed(messages, window, late_threads=0,
+                    container_class=ThreadNode):
+    """Thread a stream of messages ordered by date, yielding the threads
+    as soon as they are finished.
+
+    A thread is finished when its latest message is more than `window`
+    seconds older than the current message. Messages without a date are
+    considered sent at the date of the previous message, and messages
+    slightly out of order are threaded as if they were sent at the
+    latest date seen so far.
+
+    Subject grouping (step 5) is not applied, as threads sharing a
+    subject may be finished at different times.
+
+    Arguments:
+        messages: iterable of Message items, ordered by `date`
+        window (int): number of seconds without a new message after
+               which a thread is finished
+        late_threads (int): number of finished threads kept, with
+               their Message-IDs, after they are yielded. A reply to one
+               of these threads reopens it, and the thread is yielded
+               again, with all its messages, when it is finished again.
+        container_class (type): class of the returned containers
+
+    Yields:
+        root containers of the finished threads, as returned by
+        ``thread(messages, group_by_subject=False)`` for the messages of
+        the thread. The remaining threads are yielded at the end of the
+        stream, oldest first.
+    """
+    id_table = {}
+    # id() of a container -> its Message-ID, to evict dummy containers
+    names = {}
+    # id() of an open root -> (root, date of the latest message), ordered
+    # by date of the latest message
+    active = OrderedDict()
+    # id() of a finished root -> (root, Message-IDs), most recent last,
+    # and Message-ID -> id() of its finished root
+    closed = OrderedDict()
+    closed_ids = {}
+    now = None
+
+    def close(key):
+        root, _ = active.pop(key)
+        ids = []
+        for ctr in root.iter_subtree():
+            message_id = names.pop(id(ctr))
+            del id_table[message_id]
+            ids.append(message_id)
+        if late_threads:
+            closed[key] = (root, ids)
+            for message_id in ids:
+                closed_ids[message_id] = key
+            if len(closed) > late_threads:
+                _, (_, old_ids) = closed.popitem(last=False)
+                for message_id in old_ids:
+                    del closed_ids[message_id]
+            # the root is kept unpruned, to be reopened
+            root = _copy_tree(root)
+        return prune_container(root)
+
+    def reopen(key):
+        root, ids = closed.pop(key)
+        for message_id, ctr in zip(ids, root.iter_subtree()):
+            del closed_ids[message_id]
+            id_table[message_id] = ctr
+            names[id(ctr)] = message_id
+        active[key] = (root, now)
+
+    for msg in messages:
+        if msg.date is not None and (now is None or msg.date > now):
+            now = msg.date
+
+        # finish the threads that are idle for longer than the window
+        if now is not None:
+            while active:
+                key, (root, last) = next(iter(active.items()))
+                if last is not None and last >= now - window:
+                    break
+                for ctr in close(key):
+                    yield ctr
+
+        if closed_ids:
+            for message_id in [msg.message_id] + list(msg.references):
+                key = closed_ids.get(message_id)
+                if key is not None and message_id not in id_table:
+                    reopen(key)
+
+        this_container = id_table.get(msg.message_id)
+        touched = [] if this_container is None else [this_container.parent]
+        this_container = _link_message(id_table, msg, container_class)
+        touched.append(this_container)
+        for message_id in [msg.message_id] + list(msg.references):
+            ctr = id_table[message_id]
+            names.setdefault(id(ctr), message_id)
+            touched.append(ctr)
+
+        for ctr in touched:
+            if ctr is None:
+                continue
+            if ctr.parent is not None:
+                # this container is not a root anymore
+                active.pop(id(ctr), None)
+                while ctr.parent is not None:
+                    ctr = ctr.parent
+            # move the root to the end, as the most recently active
+            key = id(ctr)
+            active.pop(key, None)
+            active[key] = (ctr, now)
+
+    while active:
+        for ctr in close(next(iter(active))):
+            yield ctr
@@ -7,14 +7,21 @@ Test script for jwzthreading.
 
 # pylint: disable=c0103,c0111,r0904
 
+import sys
 import textwrap
 from email import message_from_string
 
 import pytest
 
-from jwzthreading import (Message, Container,
-                          unique, prune_container,
-                          thread, sort_threads)
+from jwzthreading import (Message, CompactMessage, MessageIdTable,
+                          Container, JwzContainer, ThreadNode,
+                          print_container,
+                          unique, prune_container, normalize_subject,
+                          parse_date,
+                          thread, sort_threads, sort_forest, Threader,
+                          ThreadIndex,
+                          ThreadingStats,
+                          ThreadStore, thread_parallel, thread_windowed)
 
 
 def test_container():
@@ -25,6 +32,7 @@ def test_container():
     c2 = Container()
     assert c.is_dummy
     assert c.children == []
+    assert not c.has_children
     assert c.parent is None
     assert not c.has_descendant(c2)
     assert len(c2.flatten()) == 1
@@ -35,6 +43,7 @@ def test_container():
     c.add_child(c2)
     c2.add_child(c3)
     assert c.children == [c2]
+    assert c.has_children
     assert c2.parent == c
     assert c.has_descendant(c2)
     assert c.has_descendant(c3)
@@ -105,7 +114,7 @@ def test_email_make_message():
         Message(msg)
 
 
-@pytest.mark.parametrize('decode_header,', [False, True])
+@pytest.mark.parametrize('decode_header', [False, True])
 def test_basic_message(decode_header):
     text = """\
         Subject: random
@@ -124,6 +133,97 @@ def test_basic_message(decode_header):
     repr(m)
 
 
+def test_message_from_headers():
+    m = Message.from_headers('<message1>', '<ref1> <ref2> <ref1>',
+                             '<reply>', 'Re: random', message_idx=3)
+    assert m.message_id == 'message1'
+    assert m.references == ['ref1', 'ref2', 'reply']
+    assert m.subject == 'Re: random'
+    assert m.message_idx == 3
+    assert m.message is None
+    with pytest.raises(ValueError):
+        Message.from_headers('')
+
+    # references are not shared between messages
+    m1, m2 = Message(), Message()
+    m1.references.append('ref1')
+    assert m2.references == []
+
+
+def test_parse_date():
+    assert parse_date('Fri, 1 Jan 2010 09:20:34 +0530') == 1262317834
+    assert parse_date('Fri, 01 Jan 2010 03:50:34 GMT') == 1262317834
+    # cached
+    assert parse_date('Fri, 1 Jan 2010 09:20:34 +0530') == 1262317834
+    assert parse_date('not a date') is None
+    assert parse_date(None) is None
+    unixfrom = 'From someone@example.com Fri Jan  1 03:50:34 2010'
+    assert parse_date(None, unixfrom) == 1262317834
+    assert parse_date('not a date', unixfrom) == 1262317834
+    assert parse_date(None, 'From garbage') is None
+    # pipermail archives obfuscate the sender with spaces
+    assert parse_date(None, 'From user at example.org  '
+                            'Fri Jan 01 00:00:00 2010') == 1262304000
+
+    m = Message.from_headers('<message1>', date='Fri, 1 Jan 2010 09:20:34',
+                             unixfrom=unixfrom)
+    assert m.date == 1262337634
+    assert CompactMessage.from_message(m).date == m.date
+    m = Message(message_from_string('Message-ID: <message1>\n\nBody'))
+    assert m.date is None
+
+
+def test_compact_message():
+    m = CompactMessage.from_headers('<message1>', '<ref1> <ref2>',
+                                    '<reply>', 'Re: random', message_idx=3,
+                                    loader=lambda idx: 'email %d' % idx)
+    assert m.message_id == 'message1'
+    assert m.references == ('ref1', 'ref2', 'reply')
+    assert m.normalized_subject == 'random'
+    assert m.message == 'email 3'
+    assert not hasattr(m, '__dict__')
+    repr(m)
+
+    messages = _make_messages()
+    compact = [CompactMessage.from_message(msg) for msg in messages]
+    assert compact[0].message is None
+    assert ([_tree_repr(el) for el in thread(compact)] ==
+            [_tree_repr(el) for el in thread(messages)])
+
+
+def test_message_id_table(tmpdir):
+    import pickle
+
+    ids = MessageIdTable()
+    m = Message.from_headers('<message1>', '<ref1> <ref2>', '<reply>',
+                             ids=ids)
+    assert m.message_id == 0
+    assert m.references == [1, 2, 3]
+    assert len(ids) == 4
+    assert ids[3] == 'reply'
+    assert ids.intern('ref1') == 1
+    assert ids.get('unknown') is None
+    assert 'message1' in ids
+
+    filename = str(tmpdir.join('ids.json'))
+    ids.save(filename)
+    assert list(MessageIdTable.load(filename)) == list(ids)
+    assert list(pickle.loads(pickle.dumps(ids))) == list(ids)
+
+    # integer ids give the same threads on both backends
+    messages = _make_messages()
+    ids = MessageIdTable()
+    interned = [ids.intern_message(CompactMessage.from_message(msg))
+                for msg in _make_messages()]
+    threads = thread(interned)
+    array_threads = thread(interned, backend='array', ids=ids)
+    for msg in interned:
+        msg.message_id = ids[msg.message_id]
+    expected = [_tree_repr(el) for el in thread(messages)]
+    assert [_tree_repr(el) for el in threads] == expected
+    assert [_tree_repr(el) for el in array_threads] == expected
+
+
 def test_encoded_message():
     text = """\
         Subject: =?UTF-8?B?0L/QtdGA0LXQutC70LDQtA==?=
@@ -204,6 +304,45 @@ def test_sorting():
     d_s = sort_threads(d, key='subject', missing='z')
     assert d_s[0]['message'].message_id == 2
     assert d_s[1]['message'].message_id == 1
+    d_s = sort_threads(d, key='subject', missing='z', reverse=True)
+    assert d_s[2]['message'].message_id == 2
+    d_s = sort_threads(d, key=lambda msg: -(msg.message_id or 0))
+    assert [el['message'].message_id for el in d_s] == [2, 1, None]
+    with pytest.raises(ValueError):
+        sort_threads(d, key=1)
+
+
+@pytest.mark.parametrize('container_class', [ThreadNode, JwzContainer])
+def test_sort_forest(container_class):
+    messages = _make_messages()
+    # newest messages first
+    for idx, msg in enumerate(messages):
+        msg.message_idx = len(messages) - idx
+    threads = thread(messages, group_by_subject=False,
+                     container_class=container_class)
+    threads = sort_forest(threads)
+    assert [_tree_repr(el) for el in threads] == [
+        ('', (('F', ()), ('E', ()))),
+        ('J', (('late', (('I', ()),)),)),
+        ('H', ()),
+        ('A', (('G', ()), ('B', (('D', ()), ('C', ()))))),
+    ]
+    # the cached sizes are still valid
+    assert threads[3].tree_size == 5
+
+    threads = sort_forest(threads, reverse=True)
+    assert [_tree_repr(el) for el in threads] == [
+        ('A', (('B', (('C', ()), ('D', ()))), ('G', ()))),
+        ('H', ()),
+        ('J', (('late', (('I', ()),)),)),
+        ('', (('E', ()), ('F', ()))),
+    ]
+
+    # by the largest key of the thread, i.e. the smallest message_idx;
+    # the dummy root of E and F is ignored
+    threads = sort_forest(threads, key=lambda msg: -msg.message_idx,
+                          latest_activity=True)
+    assert [_tree_repr(el)[0] for el in threads] == ['', 'A', 'H', 'J']
 
 
 def test_thread_single():
@@ -302,3 +441,747 @@ def test_thread_two_missing_parent():
     assert container['message'] is not None
     assert container['message'].message_id == 'First'
     assert container.parent is None
+
+
+def _tree_repr(ctr):
+    """Nested (message_id, children) tuples describing a thread"""
+    msg = ctr['message']
+    return (msg.message_id if msg is not None else '',
+            tuple(_tree_repr(child) for child in ctr.children))
+
+
+def _make_messages():
+    """A small set of messages with missing and lying references"""
+    messages = []
+    for message_id, references in [('A', []),
+                                   ('B', ['A']),
+                                   ('C', ['A', 'B']),
+                                   ('D', ['missing', 'B']),
+                                   ('E', ['parent']),
+                                   ('F', ['parent']),
+                                   ('G', ['C', 'lost', 'A']),
+                                   ('H', ['H']),
+                                   ('I', ['late']),
+                                   ('late', ['J']),
+                                   ('J', [])]:
+        msg = Message(None)
+        msg.subject = msg.message_id = message_id
+        msg.references = references
+        messages.append(msg)
+    return messages
+
+
+def test_thread_index():
+    messages = _make_messages()
+    for idx, msg in enumerate(messages):
+        msg.message_idx = idx
+    threads = thread(messages, group_by_subject=False)
+    index = ThreadIndex(threads)
+
+    def ids(containers):
+        return [ctr['message'].message_id for ctr in containers]
+
+    assert len(index) == sum(ctr.tree_size for ctr in threads)
+    assert 'C' in index and 'missing' not in index
+    assert index['C']['message'] is messages[2]
+    assert index.get('missing') is None
+    assert index.get_idx(3) is index['D']
+    assert index.root('D') is threads[0]
+    assert index.root_idx(8) is threads[3]
+    assert index.root('E') is threads[1]
+    assert index.thread_size('C') == 5
+    assert index.thread_size('E') == 3
+    assert index.subtree_size('B') == 3
+    assert ids(index.ancestors('D')) == ['B', 'A']
+    assert index.ancestors('A') == []
+    assert ids(index.descendants('A')) == ['B', 'C', 'D', 'G']
+    assert index.descendants('G') == []
+    assert ids(index.siblings('C')) == ['D']
+    assert ids(index.siblings('F')) == ['E']
+    assert index.siblings('H') == []
+    with pytest.raises(KeyError):
+        index.ancestors('missing')
+
+
+def test_normalize_subject():
+    """Test the removal of 'Re:' prefixes and list tags."""
+    assert normalize_subject('hello') == 'hello'
+    assert normalize_subject('Re: hello') == 'hello'
+    assert normalize_subject('RE:Re[2]: [list] hello ') == 'hello'
+    assert normalize_subject(None) == ''
+    # equal normalized subjects are interned
+    assert (normalize_subject('Re: ' + 'hello') is
+            normalize_subject('[list] ' + 'hello'))
+
+    m = Message(None)
+    m.subject = 'Re: hello'
+    assert m.normalized_subject == 'hello'
+    m.subject = 'Re: world'
+    assert m.normalized_subject == 'world'
+
+
+@pytest.mark.parametrize('container_class', [JwzContainer, ThreadNode])
+def test_thread_group_by_subject(container_class):
+    """Group threads sharing a subject"""
+    messages = []
+    for message_id, subject, references in [
+            ('A', 'hello', []),
+            ('B', 'Re: hello', ['missing']),
+            ('C', 'Re: Re: other', ['lost']),
+            ('D', 'Re: other', ['lost2']),
+            ('E', '', []),
+            ('F', 'Re: other', ['lost2'])]:
+        msg = Message(None)
+        msg.message_id = message_id
+        msg.subject = subject
+        msg.references = references
+        messages.append(msg)
+
+    d = thread(messages, container_class=container_class)
+    assert [_tree_repr(el) for el in d] == [
+        ('A', (('B', ()),)),
+        ('', (('D', ()), ('F', ()), ('C', ()))),
+        ('E', ())]
+
+
+def _sorted_repr(ctr):
+    """_tree_repr, ignoring the order of the children"""
+    msg = ctr['message']
+    return (msg.message_id if msg is not None else '',
+            tuple(sorted(_sorted_repr(child) for child in ctr.children)))
+
+
+def test_thread_group_by_subject_order():
+    """Step 5 does not depend on the order of the roots"""
+    import itertools
+    import random
+
+    def make(items):
+        messages = []
+        for message_id, subject, references in items:
+            msg = Message(None)
+            msg.message_id = message_id
+            msg.subject = subject
+            msg.references = references
+            messages.append(msg)
+        return messages
+
+    # the message with the fewest 're:' levels is the parent
+    items = [('X1', 'Re: foo', []), ('X2', 'Re: foo', []), ('X3', 'foo', [])]
+    for perm in itertools.permutations(items):
+        assert ([_sorted_repr(el) for el in thread(make(perm))] ==
+                [('X3', (('X1', ()), ('X2', ())))])
+
+    # a dummy root is the parent, messages with the same number of levels
+    # are siblings
+    items += [('Y1', 'Re: foo', ['missing']), ('Y2', 'foo', ['missing']),
+              ('Z1', 'bar', []), ('Z2', 'bar', []), ('Z3', 'Re: bar', [])]
+    ref_foo = ('', (('X1', ()), ('X2', ()), ('X3', ()), ('Y1', ()),
+                    ('Y2', ())))
+    ref_bar = ('', (('Z1', ()), ('Z2', ()), ('Z3', ())))
+    rnd = random.Random(0)
+    for _ in range(50):
+        rnd.shuffle(items)
+        d = [_sorted_repr(el) for el in thread(make(items))]
+        assert sorted(d) == [ref_foo, ref_bar]
+
+
+@pytest.mark.parametrize('group_by_subject', [False, True])
+def test_thread_array_backend(group_by_subject):
+    """The array backend produces the same forest as the dict one."""
+    messages = _make_messages()
+
+    d_ref = thread(messages, group_by_subject=group_by_subject)
+    d = thread(messages, group_by_subject=group_by_subject, backend='array')
+    assert [_tree_repr(el) for el in d] == [_tree_repr(el) for el in d_ref]
+
+    with pytest.raises(ValueError):
+        thread(messages, backend='unknown')
+
+
+@pytest.mark.parametrize('group_by_subject', [False, True])
+def test_threader(group_by_subject):
+    """Threading in batches gives the same threads as a single call."""
+    messages = _make_messages()
+    d_ref = thread(messages, group_by_subject=group_by_subject)
+
+    threader = Threader(group_by_subject=group_by_subject)
+    for idx in range(0, len(messages), 3):
+        threader.add(messages[idx:idx + 3])
+        threader.threads()
+    d = threader.threads()
+    assert [_tree_repr(el) for el in d] == [_tree_repr(el) for el in d_ref]
+
+    threader = Threader(group_by_subject=group_by_subject)
+    threader.add(messages)
+    assert ([_tree_repr(el) for el in threader.threads()] ==
+            [_tree_repr(el) for el in d_ref])
+
+    # only the modified threads are updated
+    assert threader.updated_threads() == []
+    msg = Message(None)
+    msg.subject = msg.message_id = 'K'
+    msg.references = ['J']
+    threader.add([msg])
+    assert ([_tree_repr(el) for el in threader.updated_threads()] ==
+            [('J', (('late', (('I', ()),)), ('K', ())))])
+
+
+@pytest.mark.parametrize('group_by_subject', [False, True])
+def test_threader_remove(group_by_subject):
+    """Removing messages gives the same threads as threading the others"""
+    messages = _make_messages()
+    for msg in messages[3:]:
+        msg.subject = 'Re: ' + msg.subject
+    messages[-1].subject = messages[0].subject
+
+    threader = Threader(group_by_subject=group_by_subject)
+    threader.add(messages)
+    threader.threads()
+    for removed in [['B'], ['unknown', 'missing'], ['late', 'H'], ['A']]:
+        threader.remove(removed)
+        messages = [msg for msg in messages if msg.message_id not in removed]
+        d_ref = thread(messages, group_by_subject=group_by_subject)
+        assert ([_tree_repr(el) for el in threader.threads()] ==
+                [_tree_repr(el) for el in d_ref])
+        assert len(threader) == len(set(
+            [msg.message_id for msg in messages] +
+            [ref for msg in messages for ref in msg.references]))
+
+    # only the affected threads are updated
+    threader.remove(['E'])
+    assert ([_tree_repr(el) for el in threader.updated_threads()] ==
+            [('F', ())])
+    # the changes are only recorded for a ThreadStore
+    assert threader._modified is None
+    assert threader._dropped is None
+
+
+@pytest.mark.parametrize('backend', ['dict', 'array'])
+def test_thread_stats(backend):
+    """Collect timings and counters while threading"""
+    messages = _make_messages()
+    d_ref = thread(messages)
+
+    stats = ThreadingStats()
+    d = thread(messages, backend=backend, stats=stats)
+    assert [_tree_repr(el) for el in d] == [_tree_repr(el) for el in d_ref]
+    assert stats.to_dict() == dict(containers=14, dummies=3, loop_links=2,
+                                   existing_parent_links=2, pruned=2,
+                                   promoted=0, subject_merges=0,
+                                   times=stats.times)
+    assert list(stats.times) == ['link', 'root_set', 'prune',
+                                 'group_by_subject', 'total']
+    repr(stats)
+
+    # counters are summed over calls, E is promoted to the root
+    m1, m2 = Message(), Message()
+    m1.message_id, m1.subject, m1.references = 'E', 'Re: Z', ['parent']
+    m2.message_id, m2.subject = 'F', 'Z'
+    thread([m1, m2], backend=backend, stats=stats)
+    assert stats.containers == 14 + 3
+    assert stats.dummies == 3 + 1
+    assert stats.pruned == 2 + 1
+    assert stats.promoted == 1
+    assert stats.subject_merges == 1
+
+
+@pytest.mark.parametrize('group_by_subject', [False, True])
+def test_thread_parallel(group_by_subject):
+    """Threading connected components in parallel gives the same result"""
+    messages = _make_messages()
+    d_ref = thread(messages, group_by_subject=group_by_subject)
+    d = thread_parallel(messages, n_jobs=2,
+                        group_by_subject=group_by_subject)
+    assert [_tree_repr(el) for el in d] == [_tree_repr(el) for el in d_ref]
+    assert all(el['message'] is el_ref['message']
+               for el, el_ref in zip(d, d_ref))
+
+    # a dummy root promoting its child, which comes later in the id table,
+    # and threads spanning the chunks of the worker processes
+    messages = []
+    for message_id, references in [('A', ['d', 'B']), ('B', ['d']),
+                                   ('C', ['e']), ('D', ['C']), ('E', ['A']),
+                                   ('F', ['e']), ('G', ['x', 'y']),
+                                   ('H', ['y'])]:
+        msg = Message(None)
+        msg.subject = msg.message_id = message_id
+        msg.references = references
+        messages.append(msg)
+    for n_jobs in [2, 3]:
+        d_ref = thread(messages, group_by_subject=group_by_subject)
+        d = thread_parallel(messages, n_jobs=n_jobs,
+                            group_by_subject=group_by_subject)
+        assert ([_tree_repr(el) for el in d] ==
+                [_tree_repr(el) for el in d_ref])
+
+
+def test_thread_windowed():
+    """Threads are yielded once idle for longer than the window"""
+    messages = []
+    for message_id, references, date in [('A', [], 0),
+                                         ('B', ['A'], 5),
+                                         ('C', [], 20),
+                                         ('D', ['A'], 30),
+                                         ('E', ['C'], None)]:
+        msg = Message(None)
+        msg.message_id = message_id
+        msg.references = references
+        msg.date = date
+        messages.append(msg)
+
+    threads = thread_windowed(iter(messages), window=10)
+    assert _tree_repr(next(threads)) == ('A', (('B', ()),))
+    # D is a late reply, starting a new thread
+    assert [_tree_repr(el) for el in threads] == [('D', ()),
+                                                  ('C', (('E', ()),))]
+
+    # the closed thread is reopened by D, and yielded again
+    threads = thread_windowed(messages, window=10, late_threads=1)
+    assert [_tree_repr(el) for el in threads] == [
+        ('A', (('B', ()),)),
+        ('A', (('B', ()), ('D', ()))),
+        ('C', (('E', ()),))]
+
+    d_ref = thread(messages, group_by_subject=False)
+    d = thread_windowed(messages, window=100)
+    assert (sorted(_tree_repr(el) for el in d) ==
+            sorted(_tree_repr(el) for el in d_ref))
+
+
+class _AsyncSource(object):
+    """Asynchronous iterator over a list"""
+    def __init__(self, items):
+        self._items = iter(items)
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        import asyncio
+        future = asyncio.Future()
+        try:
+            future.set_result(next(self._items))
+        except StopIteration:
+            future.set_exception(StopAsyncIteration())  # noqa
+        return future
+
+
+@pytest.mark.skipif(sys.version_info < (3, 6), reason='requires asyncio')
+def test_athread():
+    """Thread messages received from an asynchronous source"""
+    import asyncio
+    from jwzthreading import athread
+
+    messages = _make_messages()
+    d_ref = thread(messages)
+    # some of the messages are received as raw emails
+    items = []
+    for msg in messages:
+        if msg.message_id in 'ACEG':
+            items.append('Message-ID: <%s>\nReferences: %s\nSubject: %s\n\n'
+                         % (msg.message_id,
+                            ' '.join('<%s>' % ref for ref in msg.references),
+                            msg.subject))
+        else:
+            items.append(msg)
+
+    loop = asyncio.new_event_loop()
+    threader = Threader()
+    updates = athread(_AsyncSource(items), threader=threader, max_batch=3)
+    n_updates = 0
+    while True:
+        try:
+            threads = loop.run_until_complete(updates.__anext__())
+        except StopAsyncIteration:  # noqa
+            break
+        assert threads
+        n_updates += 1
+    loop.close()
+
+    assert n_updates >= 1
+    assert (sorted(_tree_repr(el) for el in threader.threads()) ==
+            sorted(_tree_repr(el) for el in d_ref))
+    messages = [ctr['message'] for el in threader.threads()
+                for ctr in el.flatten() if ctr['message'] is not None]
+    assert sorted(msg.message_idx for msg in messages
+                  if isinstance(msg.message, str)) == [0, 1, 2, 3]
+
+
+@pytest.mark.skipif(sys.version_info < (3, 6), reason='requires asyncio')
+def test_athread_errors():
+    """Raw messages without a Message-ID are dropped"""
+    import asyncio
+    import warnings
+    from jwzthreading import athread
+
+    items = ['Message-ID: <a>\n\n', 'Subject: no id\n\n',
+             'Message-ID: <b>\nReferences: <a>\n\n']
+
+    def run(**kwargs):
+        loop = asyncio.new_event_loop()
+        threader = Threader()
+        updates = athread(_AsyncSource(items), threader=threader, **kwargs)
+        try:
+            while True:
+                loop.run_until_complete(updates.__anext__())
+        except StopAsyncIteration:  # noqa
+            pass
+        finally:
+            loop.close()
+        return [_tree_repr(el) for el in threader.threads()]
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        assert run() == [('a', (('b', ()),))]
+    assert len(caught) == 1
+    assert run(errors='skip') == [('a', (('b', ()),))]
+    with pytest.raises(ValueError):
+        run(errors='raise')
+
+
+def test_thread_store(tmpdir):
+    """Save the state of a Threader and continue threading after a restart"""
+    filename = str(tmpdir.join('threads.db'))
+    messages = _make_messages()
+    for idx, msg in enumerate(messages):
+        msg.date = 1262304000 + idx
+    d_ref = thread(messages)
+
+    threader = Threader()
+    with ThreadStore(filename) as store:
+        threader.add(messages[:4])
+        store.save(threader)
+        threader.threads()
+        # only the modified threads are written
+        threader.add(messages[4:7])
+        store.save(threader)
+        assert len(store) == 10
+        assert store.lookup('C') == (None, 'B', 'A', 'C')
+        assert store.lookup('missing') == (None, None, 'missing', None)
+        assert store.lookup('unknown') is None
+
+    with ThreadStore(filename) as store:
+        threader = store.load()
+        assert len(threader) == 10
+        threader.add(messages[7:])
+        store.save(threader)
+
+    with ThreadStore(filename) as store:
+        threader = store.load()
+        # the pruned root sets are loaded, not computed again
+        assert not threader._dirty
+        assert store.lookup('late') == (None, 'J', 'J', 'late')
+        assert ({ctr.message.message_id: ctr.message.date
+                 for ctr in threader._id_table.values() if ctr.message} ==
+                {msg.message_id: msg.date for msg in messages})
+    assert ([_tree_repr(el) for el in threader.threads()] ==
+            [_tree_repr(el) for el in d_ref])
+    # the references of the loaded messages are kept
+    threader.remove(['C'])
+    kept = [msg for msg in messages if msg.message_id != 'C']
+    assert ([_tree_repr(el) for el in threader.threads()] ==
+            [_tree_repr(el) for el in thread(kept)])
+
+    # interned integer ids are stored as integers
+    ids = MessageIdTable()
+    ids_filename = str(tmpdir.join('ids.db'))
+    with ThreadStore(ids_filename) as store:
+        threader = Threader()
+        threader.add([Message.from_headers('<a>', ids=ids)])
+        store.save(threader)
+    with ThreadStore(ids_filename) as store:
+        threader = store.load()
+        assert store.lookup(0) == (None, None, 0, 'No subject')
+        threader.add([Message.from_headers('<b>', '<a>', ids=ids)])
+        assert ([_tree_repr(el) for el in threader.threads()] ==
+                [(0, ((1, ()),))])
+
+    # the grouping by subject is stored
+    no_group_filename = str(tmpdir.join('no_group.db'))
+    with ThreadStore(no_group_filename) as store:
+        threader = Threader(group_by_subject=False)
+        threader.add(messages)
+        store.save(threader)
+    with ThreadStore(no_group_filename) as store:
+        threader = store.load()
+        assert not threader.group_by_subject
+        assert ([_tree_repr(el) for el in threader.threads()] ==
+                [_tree_repr(el)
+                 for el in thread(messages, group_by_subject=False)])
+
+    # removed messages are deleted from the file, the other rows are kept
+    def rows(store):
+        return dict((row[0], row) for row in store.connection.execute(
+            'SELECT message_id, seq, parent, root FROM containers'))
+
+    with ThreadStore(filename) as store:
+        threader = Threader()
+        threader.add(messages)
+        store.save(threader)
+        rows_ref = rows(store)
+        threader.remove(['E', 'F'])
+        threader.remove(['B'])
+        store.save(threader)
+        assert store.lookup('parent') is None
+        assert len(store) == 11
+        rows_new = rows(store)
+        assert set(rows_ref) - set(rows_new) == set(['E', 'F', 'parent'])
+        for message_id in ['H', 'I', 'late', 'J', 'A', 'C', 'G']:
+            assert rows_new[message_id][1] == rows_ref[message_id][1]
+        assert rows_new['J'] == rows_ref['J']
+    with ThreadStore(filename) as store:
+        threader = store.load()
+        kept = [msg for msg in messages
+                if msg.message_id not in ('B', 'E', 'F')]
+        assert ([_tree_repr(el) for el in threader.threads()] ==
+                [_tree_repr(el) for el in thread(kept)])
+        threader.remove(['late'])
+        store.save(threader)
+    with ThreadStore(filename) as store:
+        threader = store.load()
+        kept = [msg for msg in kept if msg.message_id != 'late']
+        assert ([_tree_repr(el) for el in threader.threads()] ==
+                [_tree_repr(el) for el in thread(kept)])
+
+
+def test_thread_store_duplicates(tmpdir):
+    """The links of messages replaced by a duplicate Message-ID are kept"""
+    filename = str(tmpdir.join('threads.db'))
+
+    def make(message_id, references):
+        msg = Message(None)
+        msg.message_id = msg.subject = message_id
+        msg.references = references
+        return msg
+
+    messages = [make('b', ['x', 'y', 'a']), make('b', ['z', 'x', 'w']),
+                make('c', ['p', 'q']), make('c', ['r']), make('d', ['q'])]
+    with ThreadStore(filename) as store:
+        threader = Threader()
+        threader.add(messages[:2])
+        store.save(threader)
+        threader = store.load()
+        threader.add(messages[2:])
+        store.save(threader)
+    with ThreadStore(filename) as store:
+        threader = store.load()
+        assert ([_tree_repr(el) for el in threader.threads()] ==
+                [_tree_repr(el) for el in thread(messages)])
+        threader.remove(['b'])
+        store.save(threader)
+    with ThreadStore(filename) as store:
+        threader = store.load()
+        assert len(threader) == len(store) == 5
+        threader.remove(['d'])
+        kept = messages[2:4]
+        assert len(threader) == 4
+        assert ([_tree_repr(el) for el in threader.threads()] ==
+                [_tree_repr(el) for el in thread(kept)])
+
+    # the order of the Message-IDs only referenced by a replaced message
+    messages = [make('e', ['x']), make('f', []), make('e', ['y']),
+                make('g', ['x'])]
+    with ThreadStore(filename) as store:
+        threader = Threader()
+        threader.add(messages)
+        store.save(threader)
+    with ThreadStore(filename) as store:
+        threader = store.load()
+        assert ([_tree_repr(el) for el in threader.threads()] ==
+                [_tree_repr(el) for el in thread(messages)])
+
+
+@pytest.mark.parametrize('backend', ['dict', 'array'])
+def test_thread_reference_loop(backend):
+    """Messages lying about their references are not lost in a loop."""
+    m1 = Message(None)
+    m1.subject = m1.message_id = 'First'
+    m1.references = ['Second']
+    m2 = Message(None)
+    m2.subject = m2.message_id = 'Second'
+    m2.references = ['First']
+    m3 = Message(None)
+    m3.subject = m3.message_id = 'Self'
+    m3.references = ['Self']
+    d = thread([m1, m2, m3], group_by_subject=False, backend=backend)
+    assert len(d) == 2
+    assert d[0]['message'] == m2
+    assert d[0].children[0]['message'] == m1
+    assert d[1]['message'] == m3
+    assert d[1].children == []
+
+
+def test_deep_reference_chain():
+    """Long reply chains, with all the ancestors in References."""
+    N = 300
+    messages = []
+    for idx in range(N):
+        msg = Message(None)
+        msg.subject = 'chain'
+        msg.message_id = 'chain-%d' % idx
+        msg.references = ['chain-%d' % ref for ref in range(idx)]
+        messages.append(msg)
+
+    # replies listed before the messages they refer to
+    d = thread(messages[::-1], group_by_subject=False)
+    assert len(d) == 1
+    assert d[0]['message'] is messages[0]
+    assert d[0].tree_size == N
+
+
+def test_thread_node():
+    """Test linking of ThreadNodes."""
+    n = ThreadNode()
+    n2 = ThreadNode()
+    n3 = ThreadNode()
+    repr(n)
+    assert n.is_dummy
+    assert n['message'] is None
+    assert 'message' in n
+    assert n.get('other') is None
+
+    assert not n.has_children
+    for child in [n2, n3]:
+        n.add_child(child)
+    assert n.children == [n2, n3]
+    assert n.has_children
+    assert n.has_descendant(n3)
+    # the list of children is a copy
+    n.children.append(ThreadNode())
+    assert n.children == [n2, n3]
+    # identity hashing, which does not depend on the tree structure
+    assert len(set([n, n2, n3])) == 3
+    assert {n2: 1}[n2] == 1
+
+    n.remove_child(n2)
+    assert n.children == [n3]
+    assert n2.parent is None
+    with pytest.raises(ValueError):
+        n.remove_child(n2)
+
+    # re-parenting removes the child from its previous parent
+    n2.add_child(n3)
+    assert n.children == []
+    assert n3.parent is n2
+
+    msg = Message()
+    n['message'] = msg
+    assert n.message is msg
+    assert not n.is_dummy
+
+
+@pytest.mark.parametrize('container_class', [Container, ThreadNode])
+def test_tree_cache(container_class):
+    """Test the cached root, depth and subtree size"""
+    a, b, c, d = [container_class() for _ in range(4)]
+    a.add_child(b)
+    b.add_child(c)
+    a.add_child(d)
+
+    assert a.tree_size == 4
+    # a single access annotates the whole tree
+    assert all(ctr._cache_is_valid() for ctr in [a, b, c, d])
+    assert [ctr.current_depth for ctr in [a, b, c, d]] == [0, 1, 2, 1]
+    assert [ctr.tree_size for ctr in [a, b, c, d]] == [4, 2, 1, 1]
+    assert all(ctr.root is a for ctr in [a, b, c, d])
+
+    # changing a link only invalidates the cached values of its trees
+    e, f = container_class(), container_class()
+    e.add_child(f)
+    assert f.tree_size == 1
+    d.add_child(b)
+    assert not any(ctr._cache_is_valid() for ctr in [a, b, c, d])
+    assert e._cache_is_valid() and f._cache_is_valid()
+    assert [ctr.current_depth for ctr in [a, b, c, d]] == [0, 2, 3, 1]
+    assert [ctr.tree_size for ctr in [a, b, c, d]] == [4, 2, 1, 3]
+
+    # with a stale cache, root and current_depth walk up the parents
+    a.remove_child(d)
+    assert c.root is d
+    assert c.current_depth == 2
+    assert a.tree_size == 1
+    assert d.tree_size == 3
+
+    # moving a subtree invalidates both trees
+    assert a.tree_size == 1
+    a.add_child(e)
+    assert not e._cache_is_valid() and not f._cache_is_valid()
+    assert d._cache_is_valid()
+    assert f.root is a and f.current_depth == 2
+    assert d.tree_size == 3
+    f.add_child(b)
+    assert not a._cache_is_valid() and not d._cache_is_valid()
+    assert [ctr.current_depth for ctr in [a, e, f, b, c]] == [0, 1, 2, 3, 4]
+    assert d.tree_size == 1
+
+    # the threads returned by thread() are annotated
+    d = thread(_make_messages(), group_by_subject=False,
+               container_class=container_class)
+    assert all(ctr._cache_is_valid() for root in d
+               for ctr in root.iter_subtree())
+
+
+def test_thread_wide():
+    """Thread an announcement with many replies."""
+    root = Message(None)
+    root.subject = root.message_id = 'announce'
+    messages = [root]
+    for idx in range(10000):
+        msg = Message(None)
+        msg.subject = 'Re: announce'
+        msg.message_id = 'reply-%d' % idx
+        msg.references = ['announce']
+        messages.append(msg)
+
+    d = thread(messages[::-1], group_by_subject=False)
+    assert len(d) == 1
+    assert isinstance(d[0], ThreadNode)
+    assert len(d[0].children) == 10000
+
+    d = thread(messages, group_by_subject=False,
+               container_class=JwzContainer)
+    assert isinstance(d[0], JwzContainer)
+    assert d[0].tree_size == 10001
+
+
+@pytest.mark.parametrize('container_class', [JwzContainer, ThreadNode])
+def test_very_deep_thread(container_class, capsys):
+    """Reply chains deeper than the recursion limit."""
+    N = 5000
+    messages = []
+    for idx in range(N):
+        msg = Message(None)
+        msg.subject = 'Re: chain'
+        msg.message_id = 'chain-%d' % idx
+        msg.message_idx = idx
+        if idx:
+            msg.references = ['chain-%d' % (idx - 1)]
+        messages.append(msg)
+
+    # a missing message in the middle of the chain is pruned
+    d = thread(messages[:100] + messages[101:], group_by_subject=False,
+               container_class=container_class)
+    assert len(d) == 2
+    assert d[1].tree_size == N - 101
+    d = thread(messages, group_by_subject=False,
+               container_class=container_class)
+    assert len(d) == 1
+
+    root = d[0]
+    assert root.tree_size == N
+    flat = root.flatten()
+    assert [el['message'] for el in flat] == messages
+    assert [depth for _, depth in root.walk()] == list(range(N))
+    assert list(root.iter_subtree()) == flat
+    assert flat[-1].current_depth == N - 1
+    assert flat[-1].root is root
+
+    res = root.to_dict()
+    for idx in range(N - 1):
+        assert res['id'] == idx
+        res, = res['children']
+
+    print_container(root)
+    out, _ = capsys.readouterr()
+    assert len(out.splitlines()) == N
@@ -8,10 +8,14 @@ from __future__ import unicode_literals
 import os
 from unittest import SkipTest
 
-from jwzthreading import (Message, thread, sort_threads)
-from jwzthreading.utils import (parse_mailbox,
-                                parse_mailman_htmlthread,
-                                MAILBOX_DELIMITER)
+import pytest
+
+from jwzthreading import (Message, MessageIdTable, thread, sort_threads,
+                          thread_windowed)
+from jwzthreading.utils import (parse_mailbox, iter_mailbox, MboxIndex,
+                                iter_messages, iter_corpus, parse_headers,
+                                parse_mailman_htmlthread, flatten_tree,
+                                unflatten_tree, MAILBOX_DELIMITER)
 
 BASE_DIR = os.path.dirname(__file__)
 DATA_DIR = os.path.join(BASE_DIR, 'data/fedora-devel-mailman')
@@ -30,6 +34,221 @@ def test_parse_mailbox():
     assert len(msglist) == N_EMAILS_JUNE2010
 
 
+def test_iter_mailbox():
+    """ Test that streaming a mailbox gives the same messages,
+    whatever the size of the blocks read from the file"""
+    filename = os.path.join(DATA_DIR, '2010-January.txt.gz')
+    msglist = parse_mailbox(filename, encoding='latin1')
+
+    for block_size in [100, 4096]:
+        msgiter = iter_mailbox(filename, encoding='latin1',
+                               block_size=block_size)
+        assert ([el.as_string() for el in msgiter] ==
+                [el.as_string() for el in msglist])
+
+
+def test_mbox_index(tmpdir):
+    """ Test random access to an uncompressed mailbox """
+    import gzip
+    import shutil
+
+    filename_gz = os.path.join(DATA_DIR, '2010-January.txt.gz')
+    filename = str(tmpdir.join('2010-January.txt'))
+    with gzip.open(filename_gz, 'rb') as fh_in, open(filename, 'wb') as fh:
+        shutil.copyfileobj(fh_in, fh)
+
+    msglist = parse_mailbox(filename_gz, encoding='latin1')
+
+    with MboxIndex(filename, encoding='latin1') as index:
+        assert len(index) == N_EMAILS_JUNE2010
+        assert os.path.exists(filename + '.idx')
+        assert index[-1].as_string() == msglist[-1].as_string()
+        assert ([el.as_string() for el in index[10:20]] ==
+                [el.as_string() for el in msglist[10:20]])
+        assert index.headers(5)['Subject'] == msglist[5]['Subject']
+        offsets = index.offsets
+
+        messages = index.to_messages()
+        for msg, msg_ref in zip(messages, msglist):
+            assert msg.message_id == Message(msg_ref).message_id
+            assert msg.references == Message(msg_ref).references
+        # only the headers were parsed
+        assert messages[7].message._message is None
+        assert messages[7].message.as_string() == msglist[7].as_string()
+
+    # the saved index is loaded
+    with MboxIndex(filename, encoding='latin1') as index:
+        assert index.offsets == offsets
+
+
+def test_parse_headers():
+    text = ('From someone Thu Jan  7 12:55:58 2010\n'
+            'Subject: a folded\n'
+            '\tsubject\n'
+            'X-Other: <other>\n'
+            'subject: second subject\n'
+            'References: <ref1>\n'
+            ' <ref2>\n'
+            '\n'
+            'Message-ID: <in the body>\n')
+    headers = parse_headers(text)
+    assert headers == {'subject': 'a folded\n\tsubject',
+                       'references': '<ref1>\n <ref2>'}
+
+
+def test_iter_messages():
+    """ Test that extracting the threading headers directly gives the
+    same messages as parsing them with the email package"""
+    filename = os.path.join(DATA_DIR, '2010-January.txt.gz')
+
+    for decode_header in [False, True]:
+        msglist = [Message(el, message_idx=idx, decode_header=decode_header)
+                   for idx, el in enumerate(parse_mailbox(
+                       filename, encoding='latin1', headersonly=True))]
+        messages = list(iter_messages(filename, encoding='latin1',
+                                      decode_header=decode_header))
+        assert len(messages) == N_EMAILS_JUNE2010
+        for msg, msg_ref in zip(messages, msglist):
+            assert msg.message_idx == msg_ref.message_idx
+            assert msg.message_id == msg_ref.message_id
+            assert msg.references == msg_ref.references
+            assert msg.subject == msg_ref.subject
+            assert msg.date == msg_ref.date
+
+    # the full email is parsed on demand
+    assert messages[3].message['From'] == msglist[3].message['From']
+    assert messages[3].message.as_string() == msglist[3].message.as_string()
+
+
+def test_iter_messages_compact():
+    """ Test creating compact messages while reading a mailbox"""
+    filename = os.path.join(DATA_DIR, '2010-January.txt.gz')
+
+    msglist = list(iter_messages(filename, encoding='latin1'))
+    for n_jobs in [1, 2]:
+        messages = list(iter_messages(filename, encoding='latin1',
+                                      n_jobs=n_jobs, compact=True))
+        assert ([(el.message_idx, el.message_id, list(el.references),
+                  el.subject, el.date) for el in messages] ==
+                [(el.message_idx, el.message_id, el.references, el.subject,
+                  el.date) for el in msglist])
+        assert messages[3].message['From'] == msglist[3].message['From']
+
+
+def test_iter_messages_ids():
+    """ Test interning Message-IDs while reading a mailbox"""
+    filename = os.path.join(DATA_DIR, '2010-January.txt.gz')
+
+    msglist = list(iter_messages(filename, encoding='latin1'))
+    for n_jobs in [1, 2]:
+        ids = MessageIdTable()
+        messages = list(iter_messages(filename, encoding='latin1',
+                                      n_jobs=n_jobs, ids=ids))
+        assert ([(ids[el.message_id], [ids[ref] for ref in el.references])
+                 for el in messages] ==
+                [(el.message_id, el.references) for el in msglist])
+        threads = thread(messages, backend='array', ids=ids)
+        assert len(threads) == len(thread(msglist))
+
+
+def test_iter_messages_parallel():
+    """ Test that parsing a mailbox with worker processes gives the
+    same messages, in the same order, as serial parsing"""
+    filename = os.path.join(DATA_DIR, '2010-January.txt.gz')
+
+    msglist = list(iter_messages(filename, encoding='latin1'))
+    messages = list(iter_messages(filename, encoding='latin1',
+                                  n_jobs=2, chunk_size=50))
+
+    assert len(messages) == N_EMAILS_JUNE2010
+    assert ([(el.message_idx, el.message_id, el.references, el.subject)
+             for el in messages] ==
+            [(el.message_idx, el.message_id, el.references, el.subject)
+             for el in msglist])
+    assert messages[3].message['From'] == msglist[3].message['From']
+
+
+def test_iter_corpus(tmpdir):
+    """ Test reading a corpus split into mailboxes and a Maildir folder"""
+    import gzip
+    from jwzthreading.utils import _iter_raw_messages, _open_mailbox
+
+    filename = os.path.join(DATA_DIR, '2010-January.txt.gz')
+    with _open_mailbox(filename) as fh:
+        raw_messages = [raw for _, raw in _iter_raw_messages(fh)]
+
+    # two mailboxes, and a Maildir folder in a nested directory
+    for name, start, stop in [('a.txt.gz', 0, 100), ('b.txt', 100, 150)]:
+        fopen = gzip.open if name.endswith('.gz') else open
+        with fopen(str(tmpdir.join(name)), 'wb') as fh:
+            fh.write(b''.join(raw_messages[start:stop]))
+    maildir = tmpdir.mkdir('c').mkdir('maildir')
+    maildir.mkdir('tmp')
+    for sub, start, stop in [('cur', 150, 250),
+                             ('new', 250, N_EMAILS_JUNE2010)]:
+        subdir = maildir.mkdir(sub)
+        for idx in range(start, stop):
+            # drop the unix-from line
+            raw = raw_messages[idx].split(b'\n', 1)[1]
+            subdir.join('%04d.host' % idx).write_binary(raw)
+
+    msglist = list(iter_messages(filename, encoding='latin1'))
+    for paths in [str(tmpdir), [str(tmpdir.join('*.txt*')), str(maildir)]]:
+        messages = list(iter_corpus(paths, encoding='latin1', n_threads=2,
+                                    chunk_size=30))
+        assert ([(el.message_idx, el.message_id, el.references, el.subject)
+                 for el in messages] ==
+                [(el.message_idx, el.message_id, el.references, el.subject)
+                 for el in msglist])
+    assert messages[3].message['From'] == msglist[3].message['From']
+    assert messages[-1].message['From'] == msglist[-1].message['From']
+
+    # replies are threaded across files
+    threads_ref = thread(msglist, group_by_subject=False)
+    threads = thread(messages, group_by_subject=False)
+    assert ([[el['message'] and el['message'].message_idx
+              for el in container.flatten()] for container in threads] ==
+            [[el['message'] and el['message'].message_idx
+              for el in container.flatten()] for container in threads_ref])
+
+
+def test_iter_messages_errors(tmpdir):
+    """ Test skipping messages without a Message-ID"""
+    import warnings
+
+    filename = str(tmpdir.join('mbox.txt'))
+    with open(filename, 'wb') as fh:
+        for message_id in ['<a>', '', '<c>']:
+            fh.write('From someone Fri Jan  1 00:00:00 2010\n'
+                     'Message-ID: {}\n'
+                     'Subject: test\n\n'
+                     'Body.\n'.format(message_id).encode('ascii'))
+    assert len(parse_mailbox(filename)) == 3
+
+    readers = [lambda **kwargs: iter_messages(filename, **kwargs),
+               lambda **kwargs: iter_messages(filename, n_jobs=2, **kwargs),
+               lambda **kwargs: iter_corpus(filename, **kwargs)]
+    for reader in readers:
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            messages = list(reader())
+        assert [msg.message_id for msg in messages] == ['a', 'c']
+        assert len(caught) == 1
+        messages = list(reader(errors='skip'))
+        assert [msg.message_id for msg in messages] == ['a', 'c']
+        with pytest.raises(ValueError):
+            list(reader(errors='raise'))
+
+    with MboxIndex(filename) as index:
+        messages = index.to_messages(errors='skip')
+        assert [msg.message_idx for msg in messages] == [0, 2]
+        # the date is read from the "From " line, without parsing the body
+        assert messages[0].date == 1262304000
+        assert messages[0].message._message is None
+        with pytest.raises(ValueError):
+            index.to_messages(errors='raise')
+
+
 def test_parse_mailman_htmlthread():
     """ Test that we can parse mailman html thread """
     try:
@@ -159,3 +378,98 @@ def test_empty_collapsing_fedora_June2010():
     assert sum([el.get('message') is None for el in threads]) == 0
 
     assert sum([el.parent is None for el in threads]) == len(threads)
+
+
+def test_threading_array_backend_fedora_June2010():
+    """ Check that the array backend threads the fedora-devel mailing list
+    exactly like the dict one"""
+    from jwzthreading.arrays import thread_arrays
+
+    msglist = parse_mailbox(os.path.join(DATA_DIR, '2010-January.txt.gz'),
+                            encoding='latin1', headersonly=True)
+    msglist = [Message(el, message_idx=idx) for idx, el in enumerate(msglist)]
+
+    threads_ref = thread(msglist, group_by_subject=False)
+    forest = thread_arrays(msglist)
+    threads = forest.to_containers()
+
+    assert len(forest) == len(threads_ref)
+    assert len(threads) == len(threads_ref)
+    for container, container_ref in zip(threads, threads_ref):
+        assert ([el['message'] for el in container.flatten()] ==
+                [el['message'] for el in container_ref.flatten()])
+        assert ([el.current_depth for el in container.flatten()] ==
+                [el.current_depth for el in container_ref.flatten()])
+
+
+def test_flatten_tree_fedora_June2010():
+    """ Convert the threads of the fedora-devel mailing list to arrays
+    and back"""
+    try:
+        import numpy as np
+    except ImportError:
+        raise SkipTest
+
+    msglist = parse_mailbox(os.path.join(DATA_DIR, '2010-January.txt.gz'),
+                            encoding='latin1', headersonly=True)
+    msglist = [Message(el, message_idx=idx) for idx, el in enumerate(msglist)]
+    threads = thread(msglist)
+
+    forest = flatten_tree(threads)
+    assert len(forest.parent) == N_EMAILS_JUNE2010
+    assert forest.size.sum() == N_EMAILS_JUNE2010
+    assert len(forest.size) == len(threads)
+    assert (np.bincount(forest.thread) == forest.size).all()
+
+    for thread_idx, container in enumerate(threads):
+        messages = [el['message'] for el in container.flatten()
+                    if el['message'] is not None]
+        for ctr in container.flatten():
+            if ctr['message'] is None:
+                continue
+            msg_idx = ctr['message'].message_idx
+            assert forest.thread[msg_idx] == thread_idx
+            assert forest.root[msg_idx] == messages[0].message_idx
+            assert forest.depth[msg_idx] == ctr.current_depth
+            if ctr.parent is None or ctr.parent['message'] is None:
+                assert forest.parent[msg_idx] == -1
+            else:
+                assert (forest.parent[msg_idx] ==
+                        ctr.parent['message'].message_idx)
+
+    threads_2 = unflatten_tree(forest, msglist)
+    assert len(threads_2) == len(threads)
+    for container, container_ref in zip(threads_2, threads):
+        assert ([el['message'] for el in container.flatten()] ==
+                [el['message'] for el in container_ref.flatten()])
+        assert ([el.current_depth for el in container.flatten()] ==
+                [el.current_depth for el in container_ref.flatten()])
+
+
+def test_thread_windowed_fedora_June2010():
+    """ Test threading the mailbox sorted by date with a time window"""
+    filename = os.path.join(DATA_DIR, '2010-January.txt.gz')
+    messages = sorted(iter_messages(filename, encoding='latin1'),
+                      key=lambda msg: msg.date)
+
+    def messages_of(ctr):
+        return frozenset(el['message'].message_id for el in ctr.flatten()
+                         if el['message'] is not None)
+
+    threads_ref = set(messages_of(ctr)
+                      for ctr in thread(messages, group_by_subject=False))
+
+    # one day splits long threads
+    threads = [messages_of(ctr)
+               for ctr in thread_windowed(messages, 24 * 3600)]
+    assert len(threads) > len(threads_ref)
+    assert sum(len(el) for el in threads) == N_EMAILS_JUNE2010
+
+    # unless late replies reopen them, the last version of every
+    # reopened thread is then the same as without a window
+    threads = [messages_of(ctr)
+               for ctr in thread_windowed(messages, 24 * 3600,
+                                          late_threads=100)]
+    threads = [el for idx, el in enumerate(threads)
+               if not any(el <= other for other in threads[idx + 1:])]
+    assert set(threads) == threads_ref
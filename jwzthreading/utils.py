@@ -6,9 +6,135 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import os
+import re
 import sys
+import warnings
+from array import array
+from collections import namedtuple
 
-MAILBOX_DELIMITER = '^From .*\d\d \d\d\d\d$'
+MAILBOX_DELIMITER = r'^From .*\d\d \d\d\d\d$'
+# same delimiter, matched over the raw bytes of a mailbox
+_MAILBOX_DELIMITER_RE = re.compile(MAILBOX_DELIMITER.encode('ascii'),
+                                   re.MULTILINE)
+
+# size of the blocks read from a mailbox file
+MAILBOX_BLOCK_SIZE = 2 ** 20
+
+# accepted values of the `errors` argument, for messages that cannot be
+# threaded, e.g. without a Message-ID
+ERRORS = ('warn', 'skip', 'raise')
+
+
+def _open_mailbox(filename):
+    """Open a mailbox file, possibly gzipped, in binary mode"""
+    if filename.endswith('.gz'):
+        import gzip
+        fopen = gzip.open
+    else:
+        fopen = open
+    return fopen(filename, 'rb')
+
+
+def _iter_raw_messages(fh, block_size=MAILBOX_BLOCK_SIZE):
+    """ Split a mailbox into messages
+
+    The file is read in blocks of `block_size` bytes that are scanned for
+    the ``From `` delimiter lines, so that at most one message and one
+    block are held in memory at any time.
+
+    Parameters
+    ----------
+    fh : file
+      mailbox opened in binary mode
+    block_size : int
+      number of bytes read at once
+
+    Returns
+    -------
+
+    response : generator
+      (offset, raw bytes) of each message
+    """
+    buf = bytearray()
+    offset = 0  # offset of buf in the file
+    start = 0  # start of the current message in buf
+    scanned = 0  # buf[:scanned] only contains complete, scanned lines
+
+    while True:
+        block = fh.read(block_size)
+        buf.extend(block)
+        if block:
+            end = buf.rfind(b'\n') + 1
+        else:
+            end = len(buf)
+
+        if end > scanned:
+            for match in _MAILBOX_DELIMITER_RE.finditer(buf, scanned, end):
+                pos = match.start()
+                if pos > start:
+                    yield offset + start, bytes(buf[start:pos])
+                start = pos
+            scanned = end
+
+        if not block:
+            break
+
+        if start:
+            del buf[:start]
+            offset += start
+            scanned -= start
+            start = 0
+
+    if len(buf) > start:
+        yield offset + start, bytes(buf[start:])
+
+
+def iter_mailbox(filename, encoding='utf-8', headersonly=False,
+                 block_size=MAILBOX_BLOCK_SIZE):
+    """ Iterate over the emails of a mailbox, possibly gzipped
+
+    This is the streaming version of `parse_mailbox`: messages are
+    split on the raw bytes and only decoded and parsed one at a time,
+    so that memory usage is bounded by the size of the largest message.
+    To thread the result, use e.g.
+    ``[Message(el, message_idx=idx) for idx, el in enumerate(...)]``
+
+    Parameters
+    ----------
+    filename : str
+      path to the filename
+    encoding : str
+      filename encoding
+    headersonly : bool
+      whether only headers should be parsed
+    block_size : int
+      number of bytes read at once
+
+    Returns
+    -------
+
+    response : generator
+      email.Message objects
+    """
+    from email.parser import Parser
+
+    parser = Parser()
+
+    with _open_mailbox(filename) as fh:
+        for _, message in _iter_raw_messages(fh, block_size):
+            yield _parse_raw_message(message, encoding, headersonly, parser)
+
+
+def _parse_raw_message(message, encoding='utf-8', headersonly=False,
+                       parser=None):
+    """Decode and parse the raw bytes of a single message"""
+    if parser is None:
+        from email.parser import Parser
+        parser = Parser()
+    message = message.decode(encoding)
+    if sys.version_info < (3, 0) and encoding != 'utf-8':
+        message = message.encode('utf-8')
+    return parser.parsestr(message, headersonly=headersonly)
 
 
 def parse_mailbox(filename, encoding='utf-8', headersonly=False):
@@ -30,41 +156,827 @@ def parse_mailbox(filename, encoding='utf-8', headersonly=False):
     response : list
       a list of email.Message objects
     """
+    return list(iter_mailbox(filename, encoding=encoding,
+                             headersonly=headersonly))
 
-    from email.parser import Parser
-    import sys
-    import re
 
-    mailbox = []
-    container = []
+# end of the header block of a message
+_HEADERS_END_RE = re.compile(br'\n\r?\n')
 
-    if filename.endswith('.gz'):
-        import gzip
-        fopen = gzip.open
+# array typecode used for the byte offsets of an MboxIndex
+try:
+    array(str('q'))
+    OFFSET_TYPECODE = str('q')
+except ValueError:  # Python 2
+    OFFSET_TYPECODE = str('l')
+
+
+class LazyEmail(object):
+    """ An email message that is only parsed on demand
+
+    Header lookups (``get``, ``[]``, ``in``, ``keys``, ``get_unixfrom``)
+    only parse the header block of the message, any other attribute is
+    looked up on the fully parsed email.Message, which is parsed on first
+    access.
+
+    Parameters
+    ----------
+    source : MboxIndex or MailboxFile
+      the mailbox the message belongs to, providing ``headers(idx)``
+      and ``source[idx]``
+    idx : int
+      position of the message in the mailbox
+    """
+    def __init__(self, source, idx):
+        self._source = source
+        self._idx = idx
+        self._headers = None
+        self._message = None
+
+    def __repr__(self):
+        return '<%s %d of %r>' % (self.__class__.__name__, self._idx,
+                                  self._source.filename)
+
+    @property
+    def headers(self):
+        """email.Message with only the headers parsed"""
+        if self._headers is None:
+            if self._message is not None:
+                self._headers = self._message
+            else:
+                self._headers = self._source.headers(self._idx)
+        return self._headers
+
+    @property
+    def message(self):
+        """fully parsed email.Message"""
+        if self._message is None:
+            self._message = self._source[self._idx]
+        return self._message
+
+    def get(self, name, failobj=None):
+        return self.headers.get(name, failobj)
+
+    def keys(self):
+        return self.headers.keys()
+
+    def __getitem__(self, name):
+        return self.headers[name]
+
+    def __contains__(self, name):
+        return name in self.headers
+
+    def get_unixfrom(self):
+        return self.headers.get_unixfrom()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.message, name)
+
+
+class MboxIndex(object):
+    """ Byte offset index of the messages in an (uncompressed) mailbox
+
+    Message boundaries are found once by scanning a memory map of the
+    file for the `MAILBOX_DELIMITER` lines, and saved next to the
+    mailbox, so that later runs can access any message directly.
+    The saved index is rebuilt when the size of the mailbox changes or
+    when the mailbox is more recent than the index.
+
+    Parameters
+    ----------
+    filename : str
+      path to the mailbox
+    encoding : str
+      mailbox encoding
+    index_filename : str
+      path to the saved index, by default `filename` + ".idx"
+    save : bool
+      whether the index should be saved to disk after being built
+
+    Attributes
+    ----------
+    offsets : array
+      byte offset of the start of each message, followed by the size of
+      the mailbox
+    """
+    def __init__(self, filename, encoding='utf-8', index_filename=None,
+                 save=True):
+        import mmap
+
+        if filename.endswith('.gz'):
+            raise ValueError('MboxIndex requires an uncompressed mailbox, '
+                             'got {}'.format(filename))
+        if index_filename is None:
+            index_filename = filename + '.idx'
+
+        self.filename = filename
+        self.encoding = encoding
+        self.index_filename = index_filename
+
+        self._fh = open(filename, 'rb')
+        size = os.fstat(self._fh.fileno()).st_size
+        if size:
+            self._mmap = mmap.mmap(self._fh.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        else:  # empty files cannot be memory mapped
+            self._mmap = b''
+
+        self.offsets = self._load_offsets(size)
+        if self.offsets is None:
+            self.offsets = self._build_offsets(size)
+            if save:
+                self._save_offsets(size)
+
+    def _build_offsets(self, size):
+        offsets = array(OFFSET_TYPECODE)
+        if not size:
+            return offsets
+        offsets.append(0)
+        for match in _MAILBOX_DELIMITER_RE.finditer(self._mmap):
+            if match.start() > 0:
+                offsets.append(match.start())
+        offsets.append(size)
+        return offsets
+
+    def _load_offsets(self, size):
+        if not os.path.exists(self.index_filename):
+            return None
+        if (os.path.getmtime(self.index_filename) <
+                os.path.getmtime(self.filename)):
+            return None
+        offsets = array(OFFSET_TYPECODE)
+        with open(self.index_filename, 'rb') as fh:
+            data = fh.read()
+        if len(data) % offsets.itemsize:
+            return None
+        if sys.version_info < (3, 0):
+            offsets.fromstring(data)
+        else:
+            offsets.frombytes(data)
+        # the first value is the size of the indexed mailbox
+        if not offsets or offsets[0] != size:
+            return None
+        return offsets[1:]
+
+    def _save_offsets(self, size):
+        data = array(OFFSET_TYPECODE, [size])
+        data.extend(self.offsets)
+        with open(self.index_filename, 'wb') as fh:
+            data.tofile(fh)
+
+    def close(self):
+        """Close the memory map of the mailbox"""
+        if not isinstance(self._mmap, bytes):
+            self._mmap.close()
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return max(len(self.offsets) - 1, 0)
+
+    def _check_idx(self, idx):
+        n_messages = len(self)
+        if idx < 0:
+            idx += n_messages
+        if not 0 <= idx < n_messages:
+            raise IndexError('message index out of range')
+        return idx
+
+    def raw(self, idx):
+        """Raw bytes of a message"""
+        idx = self._check_idx(idx)
+        return self._mmap[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def headers(self, idx):
+        """ Parse the headers of a message
+
+        Only the header block is read from the mailbox.
+
+        Returns
+        -------
+        email.Message
+        """
+        idx = self._check_idx(idx)
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        match = _HEADERS_END_RE.search(self._mmap, start, end)
+        if match is not None:
+            end = match.end()
+        return _parse_raw_message(self._mmap[start:end], self.encoding,
+                                  headersonly=True)
+
+    def __getitem__(self, idx):
+        """ Parse a message, or a list of messages for a slice
+
+        Returns
+        -------
+        email.Message
+        """
+        if isinstance(idx, slice):
+            return [self[el] for el in range(*idx.indices(len(self)))]
+        return _parse_raw_message(self.raw(idx), self.encoding)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def lazy(self, idx):
+        """Lazily parsed message, see LazyEmail"""
+        return LazyEmail(self, self._check_idx(idx))
+
+    def to_messages(self, decode_header=False, errors='warn'):
+        """ Create the Message objects used for threading
+
+        The `message` attribute of each Message is a LazyEmail, so that
+        message bodies are only parsed on demand.
+
+        Parameters
+        ----------
+        decode_header : bool
+          decode RFC 2047 encoded subjects
+        errors : str
+          messages without a Message-ID are skipped with a warning
+          ('warn'), silently ('skip'), or raise a ValueError ('raise')
+
+        Returns
+        -------
+        list : Message
+          with `message_idx` the position of the message in the mailbox
+        """
+        from .jwzthreading import Message
+
+        _check_errors(errors)
+        messages = []
+        for idx in range(len(self)):
+            try:
+                messages.append(Message(self.lazy(idx), message_idx=idx,
+                                        decode_header=decode_header))
+            except ValueError as exc:
+                _skip_message(idx, exc, errors)
+        return messages
+
+
+# headers used for threading
+THREADING_HEADERS = ('message-id', 'references', 'in-reply-to', 'subject')
+
+# headers stored on the Message objects
+MESSAGE_HEADERS = THREADING_HEADERS + ('date',)
+
+# header lines, as recognized by email.feedparser
+_HEADER_LINE_RE = re.compile(r'^(From |[\041-\071\073-\176]*:|[\t ])')
+_LINE_RE = re.compile(r'[^\r\n]*(?:\r\n|\r|\n|$)')
+
+
+def parse_headers(text, names=THREADING_HEADERS):
+    """ Extract a few headers from the header block of a message
+
+    This follows the rules of the email package parser (header
+    continuation lines are kept, a leading unix-from line is skipped and
+    the header block ends at the first line that is not a header) but
+    only stores the requested headers, and never builds an
+    email.Message.
+
+    Parameters
+    ----------
+    text : str
+      the decoded message, or its header block
+    names : tuple
+      lower case names of the headers to extract
+
+    Returns
+    -------
+
+    headers : dict
+      lower case header name -> value of its first occurrence, as
+      returned by email.Message.get
+    """
+    headers = {}
+    name = None
+    value = []
+    for lineno, match in enumerate(_LINE_RE.finditer(text)):
+        line = match.group()
+        if not line.strip('\r\n') or not _HEADER_LINE_RE.match(line):
+            break
+        if line[0] in ' \t':
+            # continuation line
+            if name is not None:
+                value.append(line)
+            continue
+        if name is not None:
+            headers[name] = ''.join(value).rstrip('\r\n')
+            name = None
+        if line.startswith('From '):
+            # unix-from or misplaced envelope header
+            continue
+        idx = line.find(':')
+        if idx <= 0:
+            continue
+        key = line[:idx].lower()
+        if key in names and key not in headers:
+            name = key
+            value = [line[idx + 1:].lstrip(' \t')]
+    if name is not None:
+        headers[name] = ''.join(value).rstrip('\r\n')
+    return headers
+
+
+class MailboxFile(object):
+    """ Messages of a mailbox file, possibly gzipped, accessed by
+    their byte offset
+
+    This is the source of the LazyEmail objects created by
+    `iter_messages`: the offsets of the messages are recorded while the
+    mailbox is streamed, and a message is read again from the file when
+    it is needed. Random access to a gzipped file requires decompressing
+    it up to the message, use MboxIndex for uncompressed mailboxes.
+
+    Parameters
+    ----------
+    filename : str
+      path to the mailbox
+    encoding : str
+      mailbox encoding
+    """
+    def __init__(self, filename, encoding='utf-8'):
+        self.filename = filename
+        self.encoding = encoding
+        self.starts = array(OFFSET_TYPECODE)
+        self.ends = array(OFFSET_TYPECODE)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def append(self, start, end):
+        """Record the byte offsets of a message, returns its position"""
+        self.starts.append(start)
+        self.ends.append(end)
+        return len(self.starts) - 1
+
+    def raw(self, idx):
+        """Raw bytes of a message"""
+        with _open_mailbox(self.filename) as fh:
+            fh.seek(self.starts[idx])
+            return fh.read(self.ends[idx] - self.starts[idx])
+
+    def headers(self, idx):
+        """Parse the headers of a message"""
+        return _parse_raw_message(self.raw(idx), self.encoding,
+                                  headersonly=True)
+
+    def __getitem__(self, idx):
+        """Parse a message"""
+        return _parse_raw_message(self.raw(idx), self.encoding)
+
+
+def _check_errors(errors):
+    if errors not in ERRORS:
+        raise ValueError('Wrong input argument `errors`={}'.format(errors))
+
+
+def _skip_message(idx, exc, errors):
+    """Handle a message that cannot be threaded, according to `errors`"""
+    if errors == 'raise':
+        raise exc
+    elif errors == 'warn':
+        warnings.warn('Skipping message {}: {}'.format(idx, exc))
+
+
+def _make_message(raw, encoding, message_idx=None, decode_header=False,
+                  message_class=None, **kwargs):
+    """Build a Message, or an instance of `message_class`, from the raw
+    bytes of an email, without parsing it with the email package"""
+    if message_class is None:
+        from .jwzthreading import Message as message_class
+
+    match = _HEADERS_END_RE.search(raw)
+    if match is not None:
+        raw = raw[:match.end()]
+    text = raw.decode(encoding)
+    headers = parse_headers(text, MESSAGE_HEADERS)
+
+    if text.startswith('From '):
+        unixfrom = text[:text.find('\n')].rstrip('\r')
     else:
-        fopen = open
+        unixfrom = None
+
+    return message_class.from_headers(headers.get('message-id', ''),
+                                      headers.get('references', ''),
+                                      headers.get('in-reply-to', ''),
+                                      headers.get('subject', "No subject"),
+                                      message_idx=message_idx,
+                                      decode_header=decode_header,
+                                      date=headers.get('date'),
+                                      unixfrom=unixfrom, **kwargs)
 
-    with fopen(filename, 'rb') as fh:
-        for idx, line in enumerate(fh):
-            line = line.decode(encoding)
-            # if line.startswith('From ') and '@' in line:
-            if re.match(MAILBOX_DELIMITER, line):
-                if container:
-                    mailbox.append(''.join(container))
-                container = []
-            container.append(line)
-
-        if container:
-            mailbox.append(''.join(container))
+
+def _extract_headers(header_blocks, encoding, decode_header, first_idx):
+    """ Extract the threading headers of a chunk of messages
+
+    This runs in the worker processes of `iter_messages`, and only
+    returns compact (message_id, references, subject, message_idx, date)
+    tuples to the parent process. For a message that cannot be threaded,
+    message_id is None and references is the error message, so that the
+    parent process handles the error.
+    """
     out = []
-    for message in mailbox:
-        if sys.version_info < (3, 0) and encoding != 'utf-8':
-            message = message.encode('utf-8')
-        msg_obj = Parser().parsestr(message, headersonly=headersonly)
-        out.append(msg_obj)
+    for idx, raw in enumerate(header_blocks, first_idx):
+        try:
+            msg = _make_message(raw, encoding, message_idx=idx,
+                                decode_header=decode_header)
+        except ValueError as exc:
+            out.append((None, str(exc), None, idx, None))
+            continue
+        out.append((msg.message_id, msg.references, msg.subject, idx,
+                    msg.date))
     return out
 
 
+def _iter_header_chunks(fh, source, block_size, chunk_size):
+    """Split a mailbox into chunks of `chunk_size` header blocks"""
+    chunk = []
+    first_idx = 0
+    for offset, raw in _iter_raw_messages(fh, block_size):
+        idx = source.append(offset, offset + len(raw))
+        match = _HEADERS_END_RE.search(raw)
+        if match is not None:
+            raw = raw[:match.end()]
+        if not chunk:
+            first_idx = idx
+        chunk.append(raw)
+        if len(chunk) >= chunk_size:
+            yield first_idx, chunk
+            chunk = []
+    if chunk:
+        yield first_idx, chunk
+
+
+def iter_messages(filename, encoding='utf-8', decode_header=False,
+                  block_size=MAILBOX_BLOCK_SIZE, n_jobs=1, chunk_size=1000,
+                  compact=False, ids=None, errors='warn'):
+    """ Iterate over the messages of a mailbox, ready for threading
+
+    The Message-ID, References, In-Reply-To and Subject headers are
+    extracted directly from the raw header block of each message with
+    `parse_headers`, which is much faster than parsing the messages
+    with the email package. The `message` attribute of each Message is
+    a LazyEmail that reads and parses the email again when used.
+
+    With ``n_jobs > 1``, the mailbox is split at message boundaries in
+    the current process, and the header blocks are sent, in chunks of
+    `chunk_size` messages, to a pool of worker processes. The messages
+    are yielded in the same order, and are the same, as in serial mode.
+
+    Parameters
+    ----------
+    filename : str
+      path to the filename
+    encoding : str
+      filename encoding
+    decode_header : bool
+      decode RFC 2047 encoded subjects
+    block_size : int
+      number of bytes read at once
+    n_jobs : int
+      number of worker processes, -1 to use all the CPUs
+    chunk_size : int
+      number of messages sent at once to a worker process
+    compact : bool
+      yield CompactMessage objects, which load the email with
+      ``source[message_idx]`` instead of holding a LazyEmail
+    ids : MessageIdTable
+      if given, Message-IDs are interned in this table, and the
+      `message_id` and `references` of the messages are integers
+    errors : str
+      messages without a Message-ID are skipped with a warning
+      ('warn'), silently ('skip'), or raise a ValueError ('raise')
+
+    Returns
+    -------
+
+    response : generator
+      Message objects, with `message_idx` the position of the message in
+      the mailbox
+    """
+    from .jwzthreading import Message, CompactMessage
+
+    _check_errors(errors)
+    source = MailboxFile(filename, encoding)
+
+    if n_jobs == -1:
+        import multiprocessing
+        n_jobs = multiprocessing.cpu_count()
+
+    if n_jobs == 1:
+        with _open_mailbox(filename) as fh:
+            for offset, raw in _iter_raw_messages(fh, block_size):
+                idx = source.append(offset, offset + len(raw))
+                try:
+                    if compact:
+                        msg = _make_message(raw, encoding, message_idx=idx,
+                                            decode_header=decode_header,
+                                            message_class=CompactMessage,
+                                            ids=ids,
+                                            loader=source.__getitem__)
+                    else:
+                        msg = _make_message(raw, encoding, message_idx=idx,
+                                            decode_header=decode_header,
+                                            ids=ids)
+                        msg.message = LazyEmail(source, idx)
+                except ValueError as exc:
+                    _skip_message(idx, exc, errors)
+                    continue
+                yield msg
+        return
+
+    from collections import deque
+    from multiprocessing import Pool
+
+    def make_messages(result):
+        for message_id, references, subject, idx, date in result:
+            if message_id is None:
+                _skip_message(idx, ValueError(references), errors)
+                continue
+            if ids is not None:
+                # interned in the parent, so that ids are shared
+                message_id = ids.intern(message_id)
+                references = [ids.intern(ref) for ref in references]
+            if compact:
+                yield CompactMessage(message_id, references, subject, idx,
+                                     loader=source.__getitem__, date=date)
+                continue
+            msg = Message()
+            msg.message_id = message_id
+            msg.references = references
+            msg.subject = subject
+            msg.message_idx = idx
+            msg.date = date
+            msg.message = LazyEmail(source, idx)
+            yield msg
+
+    pool = Pool(n_jobs)
+    try:
+        # bound the number of chunks held in memory
+        pending = deque()
+        with _open_mailbox(filename) as fh:
+            for first_idx, chunk in _iter_header_chunks(fh, source,
+                                                        block_size,
+                                                        chunk_size):
+                pending.append(pool.apply_async(
+                    _extract_headers,
+                    (chunk, encoding, decode_header, first_idx)))
+                if len(pending) > 2 * n_jobs:
+                    for msg in make_messages(pending.popleft().get()):
+                        yield msg
+        while pending:
+            for msg in make_messages(pending.popleft().get()):
+                yield msg
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# file name patterns of the mailboxes found by iter_corpus in directories
+MBOX_PATTERNS = ('*.txt', '*.txt.gz', '*.mbox', '*.mbox.gz')
+
+
+class MaildirFiles(object):
+    """ Messages stored one per file, as in a Maildir folder
+
+    This is the source of the LazyEmail objects created by
+    `iter_corpus` for Maildir folders.
+
+    Parameters
+    ----------
+    filename : str
+      path to the Maildir folder
+    filenames : list
+      paths to the message files
+    encoding : str
+      encoding of the messages
+    """
+    def __init__(self, filename, filenames, encoding='utf-8'):
+        self.filename = filename
+        self.filenames = filenames
+        self.encoding = encoding
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def raw(self, idx):
+        """Raw bytes of a message"""
+        with open(self.filenames[idx], 'rb') as fh:
+            return fh.read()
+
+    def headers(self, idx):
+        """Parse the headers of a message"""
+        return _parse_raw_message(self.raw(idx), self.encoding,
+                                  headersonly=True)
+
+    def __getitem__(self, idx):
+        """Parse a message"""
+        return _parse_raw_message(self.raw(idx), self.encoding)
+
+
+def _is_maildir(path):
+    return all(os.path.isdir(os.path.join(path, sub))
+               for sub in ('cur', 'new'))
+
+
+def _maildir_files(path):
+    """Message files of a Maildir folder, in a stable order"""
+    filenames = []
+    for sub in ('cur', 'new'):
+        dirname = os.path.join(path, sub)
+        filenames.extend(os.path.join(dirname, name)
+                         for name in sorted(os.listdir(dirname))
+                         if not name.startswith('.'))
+    return filenames
+
+
+def _find_sources(paths):
+    """ List the mailboxes and Maildir folders of a corpus
+
+    Returns a list of ('mbox', filename) and ('maildir', dirname) tuples,
+    directories are searched recursively, in sorted order.
+    """
+    import fnmatch
+    import glob
+
+    if not isinstance(paths, (list, tuple)):
+        paths = [paths]
+
+    expanded = []
+    for path in paths:
+        if glob.has_magic(path):
+            expanded.extend(sorted(glob.glob(path)))
+        elif not os.path.exists(path):
+            raise IOError('No such file or directory: {}'.format(path))
+        else:
+            expanded.append(path)
+
+    sources = []
+    for path in expanded:
+        if not os.path.isdir(path):
+            sources.append(('mbox', path))
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            if _is_maildir(dirpath):
+                sources.append(('maildir', dirpath))
+                # cur, new and tmp are not nested folders
+                dirnames[:] = [name for name in dirnames
+                               if name not in ('cur', 'new', 'tmp')]
+            for name in sorted(filenames):
+                if any(fnmatch.fnmatch(name, pattern)
+                       for pattern in MBOX_PATTERNS):
+                    sources.append(('mbox', os.path.join(dirpath, name)))
+    return sources
+
+
+def _read_mailbox(filename, encoding, decode_header, block_size):
+    """Read the messages of a mailbox, in a worker thread of iter_corpus
+
+    Returns the messages, and the (description, error) of the messages
+    that cannot be threaded"""
+    source = MailboxFile(filename, encoding)
+    messages = []
+    skipped = []
+    with _open_mailbox(filename) as fh:
+        for offset, raw in _iter_raw_messages(fh, block_size):
+            idx = source.append(offset, offset + len(raw))
+            try:
+                msg = _make_message(raw, encoding,
+                                    decode_header=decode_header)
+            except ValueError as exc:
+                skipped.append(('{} of {}'.format(idx, filename), exc))
+                continue
+            msg.message = LazyEmail(source, idx)
+            messages.append(msg)
+    return messages, skipped
+
+
+def _read_message_files(source, start, stop, decode_header):
+    """Read messages stored one per file, in a worker thread of
+    iter_corpus, see _read_mailbox"""
+    messages = []
+    skipped = []
+    for idx in range(start, stop):
+        try:
+            msg = _make_message(source.raw(idx), source.encoding,
+                                decode_header=decode_header)
+        except ValueError as exc:
+            skipped.append((source.filenames[idx], exc))
+            continue
+        msg.message = LazyEmail(source, idx)
+        messages.append(msg)
+    return messages, skipped
+
+
+def iter_corpus(paths, encoding='utf-8', decode_header=False, n_threads=4,
+                chunk_size=1000, block_size=MAILBOX_BLOCK_SIZE, ids=None,
+                errors='warn'):
+    """ Iterate over the messages of many mailboxes and Maildir folders
+
+    The files are read, decompressed and their threading headers
+    extracted concurrently by a pool of threads, each task being either
+    a whole mailbox or `chunk_size` files of a Maildir folder. At most
+    ``2 * n_threads`` tasks are in flight, so that memory use does not
+    depend on the size of the corpus.
+
+    Messages are yielded in a stable order: sources sorted by path,
+    messages of a mailbox in file order, and those of a Maildir folder
+    sorted by file name (``cur`` then ``new``), so that `message_idx` is
+    the same from one run to another. Feed the messages to a single
+    call of `thread` or `Threader.add` to thread replies across files.
+
+    Parameters
+    ----------
+    paths : str or list
+      mailbox files, directories or glob patterns. Directories are
+      searched recursively for Maildir folders and for files matching
+      MBOX_PATTERNS
+    encoding : str
+      encoding of the messages
+    decode_header : bool
+      decode RFC 2047 encoded subjects
+    n_threads : int
+      number of reading threads
+    chunk_size : int
+      number of Maildir files read by a single task
+    block_size : int
+      number of bytes read at once from a mailbox
+    ids : MessageIdTable
+      if given, Message-IDs are interned in this table (in the calling
+      thread), and the `message_id` and `references` of the messages
+      are integers
+    errors : str
+      messages without a Message-ID are skipped with a warning
+      ('warn'), silently ('skip'), or raise a ValueError ('raise')
+
+    Returns
+    -------
+
+    response : generator
+      Message objects, with consecutive `message_idx` starting at 0
+    """
+    from collections import deque
+    from multiprocessing.pool import ThreadPool
+
+    def iter_tasks():
+        for kind, path in _find_sources(paths):
+            if kind == 'mbox':
+                yield _read_mailbox, (path, encoding, decode_header,
+                                      block_size)
+                continue
+            source = MaildirFiles(path, _maildir_files(path), encoding)
+            for start in range(0, len(source), chunk_size):
+                yield _read_message_files, (
+                    source, start, min(start + chunk_size, len(source)),
+                    decode_header)
+
+    _check_errors(errors)
+
+    def number(messages, first_idx):
+        for message_idx, msg in enumerate(messages, first_idx):
+            msg.message_idx = message_idx
+            if ids is not None:
+                ids.intern_message(msg)
+            yield msg
+
+    message_idx = 0
+    pool = ThreadPool(n_threads)
+    try:
+        pending = deque()
+        for func, args in iter_tasks():
+            pending.append(pool.apply_async(func, args))
+            while len(pending) > 2 * n_threads or (
+                    pending and pending[0].ready()):
+                messages, skipped = pending.popleft().get()
+                for name, exc in skipped:
+                    _skip_message(name, exc, errors)
+                for msg in number(messages, message_idx):
+                    yield msg
+                message_idx += len(messages)
+        while pending:
+            messages, skipped = pending.popleft().get()
+            for name, exc in skipped:
+                _skip_message(name, exc, errors)
+            for msg in number(messages, message_idx):
+                yield msg
+            message_idx += len(messages)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 def parse_mailman_htmlthread(filename):
     """ Parse a gzipped files with multiple concatenaged emails
     that can be downloaded from mailman.
@@ -134,53 +1046,138 @@ def parse_mailman_htmlthread(filename):
 
     return threads
 
-# Not used or extensively tested, comment out for now
-#
-# def flatten_tree(containers):
-#    """ Flatten a tree structure
-#
-#    Parameters
-#    ----------
-#    container : list
-#      a list of Containers
-#
-#    Returns
-#    -------
-#    tree : array
-#      an array with the parent id for each element
-#    root_id : array
-#      an array with the root id for each element
-#    """
-#    import numpy as np
-#    INT_NAN = -99999
-#
-#    N = sum([el.size for el in containers])
-#
-#    tree = np.ones(N, dtype='int')*INT_NAN
-#    root_id = np.ones(N, dtype='int')*INT_NAN
-#
-#    for root_container in containers:
-#        if root_container.message is not None:
-#            root_message_idx = root_container.message.message_idx
-#        elif root_container.children and \
-#            root_container.children[0].message is not None:
-#            root_message_idx = root_container.children[0].message.message_idx
-#        else:
-#            raise ValueError('Container {} has a None'
-#                             'root and None first children.',
-#                   '\nThis should not be happening')
-#
-#        for cont in root_container.flatten():
-#            if cont.message is None:
-#                continue
-#            msg_idx = cont.message.message_idx
-#            root_id[msg_idx] = root_message_idx
-#
-#            if cont.parent is None:
-#                tree[msg_idx] = INT_NAN
-#            elif cont.parent.message is None:
-#                tree[msg_idx] = root_message_idx
-#            else:
-#                tree[msg_idx] = cont.parent.message.message_idx
-#
-#    return tree, root_id
+
+# integer type of the arrays returned by flatten_tree
+FOREST_DTYPE = 'int32'
+
+FlatForest = namedtuple('FlatForest',
+                        ['parent', 'root', 'depth', 'thread', 'size', 'order'])
+
+
+def flatten_tree(containers, n_messages=None):
+    """ Flatten a forest of threads to NumPy arrays
+
+    The arrays are indexed by the `message_idx` of the messages, and
+    hold -1 for the messages that are not in the forest.
+
+    Parameters
+    ----------
+    containers : list
+      a list of root Containers, e.g. as returned by `thread`
+    n_messages : int
+      length of the arrays, by default one more than the largest
+      `message_idx`
+
+    Returns
+    -------
+    forest : FlatForest
+      a named tuple of integer arrays
+
+      - parent : `message_idx` of the nearest ancestor holding a message,
+        -1 for a root or a child of a dummy root
+      - root : `message_idx` of the first message of the thread, in
+        depth-first order, i.e. its root message unless the root
+        container is a dummy one
+      - depth : depth of the container of the message, a dummy root
+        being at depth 0
+      - thread : index of the thread in `containers`
+      - size : number of messages of every thread, indexed by thread
+      - order : `message_idx` of all the messages of the forest, in
+        depth-first pre-order
+    """
+    import numpy as np
+
+    order = []
+    parents = []
+    depths = []
+    roots = []
+    threads = []
+    sizes = []
+
+    for thread_idx, root_container in enumerate(containers):
+        start = len(order)
+        stack = [(root_container, -1, 0)]
+        while stack:
+            ctr, parent_idx, depth = stack.pop()
+            msg = ctr['message']
+            if msg is not None:
+                msg_idx = msg.message_idx
+                if msg_idx is None:
+                    raise ValueError('Message {} has no message_idx'
+                                     .format(msg))
+                order.append(msg_idx)
+                parents.append(parent_idx)
+                depths.append(depth)
+                parent_idx = msg_idx
+            stack.extend([(child, parent_idx, depth + 1)
+                          for child in reversed(ctr.children)])
+        size = len(order) - start
+        if size:
+            roots.extend([order[start]] * size)
+            threads.extend([thread_idx] * size)
+        sizes.append(size)
+
+    order = np.array(order, dtype=FOREST_DTYPE)
+    if n_messages is None:
+        n_messages = int(order.max()) + 1 if len(order) else 0
+
+    arrays = []
+    for values in (parents, roots, depths, threads):
+        arr = np.full(n_messages, -1, dtype=FOREST_DTYPE)
+        arr[order] = values
+        arrays.append(arr)
+    parent, root, depth, thread = arrays
+
+    return FlatForest(parent, root, depth, thread,
+                      np.array(sizes, dtype=FOREST_DTYPE), order)
+
+
+def unflatten_tree(forest, messages, container_class=None):
+    """ Build a forest of threads from the arrays of `flatten_tree`
+
+    Dummy containers are only created for the roots of the threads, so
+    the result is identical to the forest given to `flatten_tree` as
+    long as it has no other dummy container, e.g. when it is returned
+    by `thread`.
+
+    Parameters
+    ----------
+    forest : FlatForest
+      the flattened forest
+    messages : list
+      the messages, indexed by `message_idx`
+    container_class : type
+      class of the containers, ThreadNode by default
+
+    Returns
+    -------
+    containers : list
+      a list of root containers, in the order of the threads
+    """
+    if container_class is None:
+        from .jwzthreading import ThreadNode
+        container_class = ThreadNode
+
+    parent = forest.parent.tolist()
+    depth = forest.depth.tolist()
+    thread = forest.thread.tolist()
+
+    nodes = {}
+    out = []
+    dummy_thread = -1
+    for msg_idx in forest.order.tolist():
+        container = container_class(message=messages[msg_idx])
+        nodes[msg_idx] = container
+        parent_idx = parent[msg_idx]
+        if parent_idx != -1:
+            nodes[parent_idx].add_child(container)
+        elif depth[msg_idx] == 0:
+            out.append(container)
+        else:
+            # child of a dummy root
+            if thread[msg_idx] != dummy_thread:
+                dummy_thread = thread[msg_idx]
+                dummy = container_class(message=None)
+                out.append(dummy)
+            dummy.add_child(container)
+    return out